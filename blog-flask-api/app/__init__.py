@@ -9,14 +9,12 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
 from flask_cors import CORS
 from flask_marshmallow import Marshmallow
-from redis import Redis
-import rq
 from config import Config
+from app import admission, archive, clients, replicas, snowflake, sqlite
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': replicas.RoutingSession})
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -29,14 +27,38 @@ cors = CORS()
 ma = Marshmallow()
 
 
+class Microblog(Flask):
+    # clients of external services are created when first used, so that
+    # starting a process stays cheap and forked processes get their own
+    elasticsearch = clients.LazyClient(clients.create_elasticsearch)
+    redis = clients.LazyClient(clients.create_redis)
+    task_queue = clients.LazyClient(clients.create_task_queue)
+    async_elasticsearch = clients.LazyClient(
+        clients.create_async_elasticsearch)
+    async_redis = clients.LazyClient(clients.create_async_redis)
+
+    def async_to_sync(self, func):
+        # async views share one event loop per process instead of getting a
+        # new loop per request, so that async connection pools are reused
+        from app.aio import async_to_sync
+        return async_to_sync(func)
+
+
 def get_locale():
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
 def create_app(config_class=Config):
-    app = Flask(__name__)
+    app = Microblog(__name__)
     app.config.from_object(config_class)
+    snowflake.check_config(app)
 
+    replicas.init_app(app, db)
+    archive.init_app(app)
+    sqlite.configure(app)
     db.init_app(app)
+    replicas.drop_replica_metadatas(db)
+    archive.drop_archive_metadata(db)
+    sqlite.init_app(app, db)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
@@ -44,13 +66,9 @@ def create_app(config_class=Config):
     moment.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
     ma.init_app(app)
+    admission.init_app(app)
     if app.config['USE_CORS']:
         cors.init_app(app)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None
-    app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
-
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
 
@@ -63,6 +81,12 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    from app.async_api import bp as async_api_bp
+    app.register_blueprint(async_api_bp, url_prefix='/api/async')
+
+    from app import outbox
+    outbox.init_app(app)
+
 
     # if not app.debug and not app.testing:
     #     if app.config['MAIL_SERVER']:
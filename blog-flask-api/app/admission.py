@@ -0,0 +1,281 @@
+import math
+import threading
+import time
+import uuid
+from fnmatch import fnmatchcase
+from flask import current_app, g, request, session
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from app.cache import TTLCache
+
+
+class MemoryLimiter(object):
+    """Token buckets and in-flight counters of a single process."""
+
+    def __init__(self, maxsize=100000):
+        self.lock = threading.Lock()
+        self.buckets = TTLCache(maxsize)
+        self.in_flight = {}
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket ``key``. Return 0 when there was
+        one, or else the seconds until there is one."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            # a bucket that refilled completely is the same as a new one
+            self.buckets.set(key, (tokens, now), burst / rate + 1)
+        return wait
+
+    def acquire(self, key, limit):
+        """Take one of the ``limit`` slots of ``key`` and return its id, or
+        None when all are taken."""
+        with self.lock:
+            count = self.in_flight.get(key, 0)
+            if count >= limit:
+                return None
+            self.in_flight[key] = count + 1
+        return key
+
+    def release(self, key, slot):
+        with self.lock:
+            count = self.in_flight.get(key, 0) - 1
+            if count > 0:
+                self.in_flight[key] = count
+            else:
+                self.in_flight.pop(key, None)
+
+    def in_flight_count(self, key):
+        return self.in_flight.get(key, 0)
+
+
+TAKE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated',
+           tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+ACQUIRE_SCRIPT = '''
+local clock = redis.call('TIME')
+local now = tonumber(clock[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[3]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[2])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+return 1
+'''
+
+
+class RedisLimiter(object):
+    """Token buckets and in-flight counters shared by all processes.
+
+    A slot is held in a sorted set until it is released, or until it is
+    ``slot_timeout`` seconds old in case its process died.
+    """
+
+    def __init__(self, redis, slot_timeout):
+        self.redis = redis
+        self.slot_timeout = slot_timeout
+        self.take_script = redis.register_script(TAKE_SCRIPT)
+        self.acquire_script = redis.register_script(ACQUIRE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self.take_script(keys=['admission-rate:' + key],
+                                      args=[rate, burst]))
+
+    def acquire(self, key, limit):
+        slot = uuid.uuid4().hex
+        if self.acquire_script(keys=['admission-slots:' + key],
+                               args=[limit, slot, self.slot_timeout]):
+            return slot
+
+    def release(self, key, slot):
+        self.redis.zrem('admission-slots:' + key, slot)
+
+    def in_flight_count(self, key):
+        return self.redis.zcard('admission-slots:' + key)
+
+
+class AdmissionControl(object):
+    """Per-endpoint limits checked before the view functions run.
+
+    ``limits`` maps endpoint names, or patterns such as ``api.*``, to a dict
+    with any of ``concurrency`` (requests in flight), ``rate`` and ``burst``
+    (token bucket shared by all clients) and ``user_rate`` and
+    ``user_burst`` (token bucket of each client). The first pattern that
+    matches an endpoint wins.
+
+    Web requests are checked before the view runs, with the client taken
+    from the session or the address. API requests carry a token that only
+    the view verifies, so their clients are checked by :func:`admit_user`
+    once the token is known to be good.
+    """
+
+    def __init__(self, limiter, limits, retry_after):
+        self.limiter = limiter
+        self.limits = limits
+        self.retry_after = retry_after
+        self.endpoint_limits = {}
+        self.lock = threading.Lock()
+        self.rejected = {}
+
+    def limits_for(self, endpoint):
+        if endpoint not in self.endpoint_limits:
+            self.endpoint_limits[endpoint] = next(
+                (limits for pattern, limits in self.limits.items()
+                 if fnmatchcase(endpoint, pattern)), None)
+        return self.endpoint_limits[endpoint]
+
+    def _reject(self, endpoint, error):
+        with self.lock:
+            self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+        raise error
+
+    def _take(self, endpoint, key, rate, burst):
+        wait = self.limiter.take(key, rate, burst or max(1, rate))
+        if wait:
+            self._reject(endpoint, TooManyRequests(
+                retry_after=max(1, math.ceil(wait))))
+
+    def admit(self, endpoint, client=None):
+        """Raise a 429 or 503 error if the request cannot run now, or else
+        return the concurrency slot it holds, if any.
+
+        The limit of ``client`` is left out when it is None, for
+        :meth:`admit_client` to check later.
+        """
+        limits = self.limits_for(endpoint)
+        if not limits:
+            return None
+        if client is not None:
+            self.admit_client(endpoint, client)
+        if limits.get('rate'):
+            self._take(endpoint, endpoint, limits['rate'],
+                       limits.get('burst'))
+        if limits.get('concurrency'):
+            slot = self.limiter.acquire(endpoint, limits['concurrency'])
+            if slot is None:
+                self._reject(endpoint, ServiceUnavailable(
+                    retry_after=self.retry_after))
+            return slot
+
+    def admit_client(self, endpoint, client):
+        """Raise a 429 error if ``client`` used up its requests to
+        ``endpoint``."""
+        limits = self.limits_for(endpoint)
+        if limits and limits.get('user_rate'):
+            self._take(endpoint, '{}:{}'.format(endpoint, client),
+                       limits['user_rate'], limits.get('user_burst'))
+
+    def release(self, endpoint, slot):
+        self.limiter.release(endpoint, slot)
+
+    def stats(self):
+        with self.lock:
+            rejected = dict(self.rejected)
+        return {endpoint: {
+            'in_flight': self.limiter.in_flight_count(endpoint),
+            'rejected': rejected.get(endpoint, 0)}
+            for endpoint, limits in self.endpoint_limits.items() if limits}
+
+
+def get_admission_control():
+    """Return the admission control, or None when it is disabled."""
+    if 'admission_control' not in current_app.extensions:
+        backend = current_app.config['ADMISSION_BACKEND']
+        if backend == 'redis':
+            limiter = RedisLimiter(
+                current_app.redis, current_app.config['ADMISSION_SLOT_TIMEOUT'])
+        elif backend == 'memory':
+            limiter = MemoryLimiter()
+        else:
+            limiter = None
+        current_app.extensions['admission_control'] = AdmissionControl(
+            limiter, current_app.config['ADMISSION_LIMITS'],
+            current_app.config['ADMISSION_RETRY_AFTER']) if limiter else None
+    return current_app.extensions['admission_control']
+
+
+# blueprints whose views authenticate with a token, see admit_user()
+TOKEN_AUTH_BLUEPRINTS = ('api', 'async_api')
+
+
+def _client_key():
+    if session.get('_user_id'):
+        return 'user:{}'.format(session['_user_id'])
+    return 'ip:{}'.format(request.remote_addr)
+
+
+def _admit():
+    admission = get_admission_control()
+    if admission is None or request.endpoint is None or \
+            request.method == 'OPTIONS':
+        return
+    # anyone can send a made up Authorization header, so API clients are
+    # only told apart once their token has been verified
+    client = None if request.blueprint in TOKEN_AUTH_BLUEPRINTS \
+        else _client_key()
+    try:
+        slot = admission.admit(request.endpoint, client)
+    except (TooManyRequests, ServiceUnavailable):
+        raise
+    except Exception:
+        # an unreachable backend must not take the endpoints down with it
+        current_app.logger.warning('Admission control failed, request let in',
+                                   exc_info=True)
+        return
+    if slot is not None:
+        g._admission_slot = (request.endpoint, slot)
+
+
+def admit_user(user):
+    """Check the per-client limit of an API request against ``user``, who
+    the request was just authenticated as."""
+    admission = get_admission_control()
+    if admission is None or request.endpoint is None or \
+            request.blueprint not in TOKEN_AUTH_BLUEPRINTS:
+        return
+    try:
+        admission.admit_client(request.endpoint, 'user:{}'.format(user.id))
+    except TooManyRequests:
+        raise
+    except Exception:
+        current_app.logger.warning('Admission control failed, request let in',
+                                   exc_info=True)
+
+
+def _release(exc):
+    slot = g.pop('_admission_slot', None)
+    if slot is not None:
+        try:
+            get_admission_control().release(*slot)
+        except Exception:
+            current_app.logger.warning('Admission slot release failed',
+                                       exc_info=True)
+
+
+def init_app(app):
+    app.before_request(_admit)
+    app.teardown_request(_release)
@@ -0,0 +1,142 @@
+"""Support for the async views of the ``/api/async`` blueprint.
+
+Flask is still a WSGI application, also under the ASGI server of asgi.py,
+so every request, async or not, holds a thread of the WSGI pool until its
+view returns. An async view only waits on the shared event loop of this
+module instead of on the database, and the number of requests a process
+serves at once is still capped by its threads. The benchmark in
+benchmarks/async_api.py shows no throughput gain over the sync API, about
+145 requests per second for both at 100 concurrent clients on one core.
+What the async path does provide is async engines and clients whose
+connection pools outlive the request. Raising concurrency beyond the thread
+count would need an ASGI framework that runs the views on the loop itself.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+from functools import wraps
+from flask import current_app
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from app import sqlite
+from app.archive import ARCHIVE_BIND_KEY
+from app.replicas import _replica_bind_key
+
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg',
+                 'mysql': 'aiomysql'}
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Return the event loop that runs the async views of this process.
+
+    The loop runs in a thread of its own for as long as the process lives,
+    so the async engines and clients keep their connections from one
+    request to the next.
+    """
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            # a forked process does not have the thread of its parent
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name='async-views',
+                             daemon=True).start()
+        return _loop
+
+
+def _copy_result(task, future):
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+def async_to_sync(func):
+    """Return a function that runs the coroutine function ``func`` on the
+    shared event loop and waits for its result.
+
+    The coroutine runs in a copy of the caller's context, so it sees the
+    application and request contexts of the thread that called it.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        loop = get_loop()
+        context = contextvars.copy_context()
+        future = concurrent.futures.Future()
+
+        def start():
+            task = loop.create_task(func(*args, **kwargs), context=context)
+            task.add_done_callback(lambda task: _copy_result(task, future))
+
+        loop.call_soon_threadsafe(start)
+        return future.result()
+    return wrapper
+
+
+def async_database_url(url):
+    url = sa.engine.make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError('No async driver for {} databases'.format(backend))
+    return url.set(drivername='{}+{}'.format(backend, ASYNC_DRIVERS[backend]))
+
+
+def _create_async_engine(app, url):
+    options = {}
+    profile = False
+    if sqlite.is_file_database(url):
+        # aiosqlite opens a connection, and a thread, per session otherwise
+        options['poolclass'] = sa.pool.AsyncAdaptedQueuePool
+        profile = app.config['SQLITE_PERFORMANCE_PROFILE']
+    if profile:
+        timeout = app.config['SQLITE_BUSY_TIMEOUT'] / 1000
+        options.update({'pool_size': app.config['SQLITE_POOL_SIZE'],
+                        'max_overflow': app.config['SQLITE_POOL_SIZE'],
+                        'pool_timeout': timeout,
+                        'connect_args': {'timeout': timeout}})
+    engine = create_async_engine(async_database_url(url), **options)
+    if profile:
+        sqlite.add_pragmas(app, engine.sync_engine)
+    return engine
+
+
+def get_async_engine(bind_key=None):
+    """Return the async engine of a database of the application.
+
+    An in-memory SQLite database is private to its connection, so the async
+    engine of one does not see the tables of the regular engine.
+    """
+    from app import db
+    entry = current_app.extensions.get('async_engines')
+    if entry is None or entry[0] != os.getpid():
+        entry = (os.getpid(), {})
+        current_app.extensions['async_engines'] = entry
+    engines = entry[1]
+    if bind_key not in engines:
+        engines[bind_key] = _create_async_engine(
+            current_app, db.engines[bind_key].url)
+    return engines[bind_key]
+
+
+def read_session():
+    """Return a new async session on the database this request reads from,
+    which is a replica when :func:`app.replicas.route_to_replica` chose
+    one."""
+    return AsyncSession(get_async_engine(_replica_bind_key()),
+                        expire_on_commit=False)
+
+
+def archive_session():
+    """Return a new async session on the database of the archive tables."""
+    from app import db
+    bind_key = ARCHIVE_BIND_KEY if ARCHIVE_BIND_KEY in db.engines \
+        else _replica_bind_key()
+    return AsyncSession(get_async_engine(bind_key), expire_on_commit=False)
@@ -1,5 +1,12 @@
 from flask import Blueprint
+from app.replicas import route_to_replica
 
 bp = Blueprint('api', __name__)
 
-from app.api import users, errors, tokens, posts
\ No newline at end of file
+
+@bp.before_request
+def before_request():
+    route_to_replica()
+
+
+from app.api import users, errors, tokens, posts, stats, export
\ No newline at end of file
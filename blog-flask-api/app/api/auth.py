@@ -1,6 +1,8 @@
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app.models import User
 from app import db
+from app.admission import admit_user
+from app.replicas import identify_user, on_primary
 from app.api.errors import error_response
 from flask import current_app
 from werkzeug.exceptions import Unauthorized, Forbidden
@@ -9,13 +11,18 @@ basic_auth = HTTPBasicAuth()
 token_auth = HTTPTokenAuth()
 
 
+# credentials are checked on the primary, API clients have no session to
+# make them stick to it after they got a token, and replicas may lag
 @basic_auth.verify_password
+@on_primary()
 def verify_password(username, password):
     if username and password:
-        user = User.query.filter_by(username=username).first()
+        user = User.get_by_username(username)
         if user is None:
-            user = User.query.filter_by(email=username).first()
-        if user and user.verify_password(password):
+            user = User.get_by_email(username)
+        if user and user.check_password(password):
+            identify_user(user.id)
+            admit_user(user)
             return user
         
 
@@ -29,13 +36,21 @@ def basic_auth_error(status=401):
     }, error.code, {'WWW-Authenticate': 'Form'}
 
 @token_auth.verify_token
+@on_primary()
 def verify_token(access_token):
     if current_app.config['DISABLE_AUTH']:
-        user = db.session.get(User, 1)
-        user.ping()
+        user = User.get_cached(1)
+        if user.ping():
+            db.session.commit()
+        identify_user(user.id)
+        admit_user(user)
         return user
     if access_token:
-        return User.verify_access_token(access_token)
+        user = User.verify_access_token(access_token)
+        if user:
+            identify_user(user.id)
+            admit_user(user)
+        return user
 
 
 @token_auth.error_handler
@@ -0,0 +1,165 @@
+import csv
+import io
+import json
+import zlib
+from flask import abort, current_app, request, stream_with_context
+from app import db
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.models import User, Post, PostArchive, Message, MessageArchive, \
+    followers
+
+# the record types, in the order in which they are exported
+TYPES = ('post', 'message', 'follower', 'following')
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+CSV_FIELDS = ['type', 'id', 'timestamp', 'direction', 'username', 'body',
+              'language']
+
+
+def _timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def _stream(query):
+    # server-side cursors where the driver has them, and rows fetched in
+    # batches either way, so a large account is never loaded at once
+    return db.session.execute(query.execution_options(
+        yield_per=current_app.config['EXPORT_YIELD_PER']))
+
+
+def _posts(user, after):
+    # the archived posts have the lower ids, and a post caught in the middle
+    # of being archived is only exported once
+    for model in (PostArchive, Post):
+        for id, timestamp, body, language in _stream(
+                db.select(model.id, model.timestamp, model.body,
+                          model.language).where(
+                    model.user_id == user.id, model.id > after)
+                .order_by(model.id)):
+            after = id
+            yield {'type': 'post', 'id': id, 'timestamp': _timestamp(timestamp),
+                   'body': body, 'language': language}
+
+
+def _messages(user, after):
+    for model in (MessageArchive, Message):
+        for id, timestamp, body, sender_id, recipient_id in _stream(
+                db.select(model.id, model.timestamp, model.body,
+                          model.sender_id, model.recipient_id).where(
+                    db.or_(model.sender_id == user.id,
+                           model.recipient_id == user.id), model.id > after)
+                .order_by(model.id)):
+            after = id
+            sent = sender_id == user.id
+            other = User.get_cached(recipient_id if sent else sender_id)
+            yield {'type': 'message', 'id': id,
+                   'timestamp': _timestamp(timestamp),
+                   'direction': 'sent' if sent else 'received',
+                   'username': other.username if other else None,
+                   'body': body}
+
+
+def _follows(user, after, kind):
+    if kind == 'follower':
+        join = db.and_(followers.c.follower_id == User.id,
+                       followers.c.followed_id == user.id)
+    else:
+        join = db.and_(followers.c.followed_id == User.id,
+                       followers.c.follower_id == user.id)
+    for id, username in _stream(
+            db.select(User.id, User.username).join(followers, join)
+            .where(User.id > after).order_by(User.id)):
+        yield {'type': kind, 'id': id, 'username': username}
+
+
+def _records(user, type, after):
+    sources = {'post': lambda after: _posts(user, after),
+               'message': lambda after: _messages(user, after),
+               'follower': lambda after: _follows(user, after, 'follower'),
+               'following': lambda after: _follows(user, after, 'following')}
+    for name in TYPES[TYPES.index(type):]:
+        yield from sources[name](after if name == type else 0)
+
+
+def _ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def _csv_lines(records, header):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS, extrasaction='ignore')
+    if header:
+        writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _chunks(lines, compress):
+    """Encode ``lines`` into chunks of about EXPORT_CHUNK_SIZE bytes, gzip
+    compressed if ``compress`` is set."""
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    chunk = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        if compressor is not None:
+            data = compressor.compress(data)
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if compressor is not None:
+        chunk.append(compressor.flush())
+    yield b''.join(chunk)
+
+
+def _parse_cursor(cursor):
+    type, _, after = cursor.partition(':')
+    if type not in TYPES or not after.isdigit():
+        return None
+    return type, int(after)
+
+
+@bp.route('/users/<int:id>/export', methods=['GET'])
+@token_auth.login_required
+def export_user(id):
+    """Stream the user's posts, messages and followers
+
+    ``format`` is ``ndjson`` or ``csv``, and ``gzip=1`` compresses the
+    download. Records are exported by type in the order post, message,
+    follower and following, each type in id order. To resume an
+    interrupted download, pass the ``type`` and ``id`` of the last complete
+    record as ``cursor``, for example ``cursor=message:1234``.
+    """
+    user = token_auth.current_user()
+    if user.id != id:
+        abort(403)
+    format = request.args.get('format', 'ndjson')
+    if format not in FORMATS:
+        return bad_request('format must be ndjson or csv')
+    cursor = request.args.get('cursor')
+    type, after = ('post', 0) if cursor is None else \
+        _parse_cursor(cursor) or (None, None)
+    if type is None:
+        return bad_request('cursor must be <type>:<id>, with a type in ' +
+                           ', '.join(TYPES))
+    compress = request.args.get('gzip', 0, type=int)
+    records = _records(user, type, after)
+    lines = _ndjson_lines(records) if format == 'ndjson' else \
+        _csv_lines(records, header=cursor is None)
+    filename = '{}-export.{}{}'.format(user.username, format,
+                                       '.gz' if compress else '')
+    return current_app.response_class(
+        stream_with_context(_chunks(lines, compress)),
+        mimetype='application/gzip' if compress else FORMATS[format],
+        headers={'Content-Disposition':
+                 'attachment; filename="{}"'.format(filename)})
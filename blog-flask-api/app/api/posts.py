@@ -1,8 +1,9 @@
-from flask import abort
+from datetime import datetime
+from flask import abort, request
 from app import db, current_app
 from app.api import bp
 from app.api.schemas import PostSchema, DateTimePaginationSchema
-from app.models import Post
+from app.models import Post, PostArchive, User
 from app.api.auth import token_auth
 from app.api.pagination_decorator import paginated_response
 
@@ -12,12 +13,146 @@ update_post_schema = PostSchema(partial=True)
 
 
 
+def posts_select(where, after=None, limit=25):
+    """Select a page of posts with their authors, newest first.
+
+    ``after`` is the id of the last post of the previous page. The statement
+    is run by the sync and the async API alike.
+    """
+    query = db.select(Post.id, Post.body, Post.timestamp, Post.language,
+                      User.id.label('author_id'),
+                      User.username.label('author_username')).join(
+        User, User.id == Post.user_id).where(where)
+    if after is not None:
+        query = query.where(Post.id < after)
+    return query.order_by(Post.id.desc()).limit(limit)
+
+
+def archived_posts_select(user, after=None, limit=25):
+    """Select a page of the archived posts of ``user``, newest first, with
+    the same columns as :func:`posts_select`.
+
+    The archive may be in another database, so the author is not joined.
+    """
+    query = db.select(PostArchive.id, PostArchive.body, PostArchive.timestamp,
+                      PostArchive.language,
+                      PostArchive.user_id.label('author_id'),
+                      db.literal(user.username).label('author_username')
+                      ).where(PostArchive.user_id == user.id)
+    if after is not None:
+        query = query.where(PostArchive.id < after)
+    return query.order_by(PostArchive.id.desc()).limit(limit)
+
+
+def post_to_dict(row):
+    return {'id': row.id, 'body': row.body,
+            'timestamp': row.timestamp.isoformat() + 'Z',
+            'language': row.language,
+            'author': {'id': row.author_id,
+                       'username': row.author_username}}
+
+
+def page_args():
+    after = request.args.get('after', type=int)
+    limit = min(request.args.get('limit', 25, type=int), 100)
+    if limit <= 0:
+        abort(400)
+    return after, limit
+
+
+def page_response(rows, limit):
+    data = [post_to_dict(row) for row in rows]
+    return {'data': data, 'pagination': {
+        'limit': limit,
+        'count': len(data),
+        'after': data[-1]['id'] if len(data) == limit else None,
+    }}
+
+
+def delta_args():
+    """Read the cursor of a client that has the posts up to ``since_id``,
+    or up to the ISO 8601 time ``since_ts``, already."""
+    since_id = request.args.get('since_id', type=int)
+    since_ts = request.args.get('since_ts')
+    if since_ts is not None:
+        try:
+            since_ts = datetime.fromisoformat(since_ts.removesuffix('Z'))
+        except ValueError:
+            abort(400)
+    return since_id, since_ts
+
+
+def delta_where(since_id, since_ts):
+    where = []
+    if since_id is not None:
+        where.append(Post.id > since_id)
+    if since_ts is not None:
+        where.append(Post.timestamp > since_ts)
+    return where
+
+
+def newer_posts_select(since_id, since_ts):
+    """Select whether any post at all is newer than the cursor.
+
+    Each check is a single probe of the primary key or of the timestamp
+    index, so a poll when nothing was posted does not look at the feed.
+    """
+    return db.select(db.and_(*(
+        db.select(Post.id).where(where).exists()
+        for where in delta_where(since_id, since_ts))))
+
+
+def count_select(where, limit):
+    """Count the posts that match, up to ``limit``."""
+    return db.select(db.func.count()).select_from(
+        db.select(Post.id).where(where).limit(limit).subquery())
+
+
+def delta_response(rows, limit, after, since_id):
+    response = page_response(rows, limit)
+    # the first page has the newest post, which is the cursor of the next
+    # poll, the pages that follow it fill the gap up to the old cursor
+    response['pagination']['since_id'] = rows[0].id \
+        if rows and after is None else since_id
+    return response
+
+
 @bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
 def user_all_post(id):
     """Retrieve all posts from a user"""
-    pass
-    # user = db.session.get(User, id) or abort(404)
-    # return user.posts.select()
+    after, limit = page_args()
+    user = db.session.get(User, id) or abort(404)
+    rows = db.session.execute(
+        posts_select(Post.user_id == id, after, limit)).all()
+    if len(rows) < limit:
+        # the older posts go on in the archive, whose ids are all lower
+        rows += db.session.execute(archived_posts_select(
+            user, rows[-1].id if rows else after, limit - len(rows))).all()
+    return page_response(rows, limit)
+
+
+@bp.route('/feed', methods=['GET'])
+@token_auth.login_required
+def feed():
+    """Retrieve the user's feed, or only the posts newer than a cursor
+
+    A HEAD request only counts the new posts, up to FEED_COUNT_LIMIT, in the
+    X-New-Posts header.
+    """
+    after, limit = page_args()
+    since_id, since_ts = delta_args()
+    where = db.and_(token_auth.current_user().followed_posts_where(),
+                    *delta_where(since_id, since_ts))
+    new = since_id is None and since_ts is None or \
+        db.session.scalar(newer_posts_select(since_id, since_ts))
+    if request.method == 'HEAD':
+        count = db.session.scalar(count_select(
+            where, current_app.config['FEED_COUNT_LIMIT'])) if new else 0
+        return '', 200, {'X-New-Posts': str(count)}
+    rows = db.session.execute(
+        posts_select(where, after, limit)).all() if new else []
+    return delta_response(rows, limit, after, since_id)
 
 # @bp.route('/posts', methods=['POST'])
 # @basic_
@@ -83,14 +83,14 @@ class UserSchema(ma.SQLAlchemySchema):
             raise ValidationError('Username must start with a letter')
         user = token_auth.current_user()
         old_username = user.username if user else None
-        if value != old_username and User.query.filter_by(username=value).first():
+        if value != old_username and User.get_by_username(value):
             raise ValidationError('Use a different username.')
 
     @validates('email')
     def validate_email(self, value):
         user = token_auth.current_user()
         old_email = user.email if user else None
-        if value != old_email and User.query.filter_by(email=value).first():
+        if value != old_email and User.get_by_email(value):
             raise ValidationError('Use a different email.')
 
     @post_dump
@@ -107,7 +107,7 @@ class UpdateUserSchema(UserSchema):
 
     @validates('old_password')
     def validate_old_password(self, value):
-        if not token_auth.current_user().verify_password(value):
+        if not token_auth.current_user().check_password(value):
             raise ValidationError('Password is incorrect')
 
 
@@ -0,0 +1,39 @@
+from flask import jsonify
+from app.api import bp
+from app.api.auth import token_auth
+from app.admission import get_admission_control
+from app.cache import get_user_cache, get_response_cache
+from app.outbox import outbox_stats
+from app.resilience import breaker_stats
+
+
+@bp.route('/stats/cache', methods=['GET'])
+@token_auth.login_required
+def cache_stats():
+    """Hit rates of the caches of this process"""
+    response_cache = get_response_cache()
+    return jsonify({'user': get_user_cache().stats(),
+                    'response': response_cache.stats()
+                    if response_cache else None})
+
+
+@bp.route('/stats/admission', methods=['GET'])
+@token_auth.login_required
+def admission_stats():
+    """Requests in flight and rejected per limited endpoint"""
+    admission = get_admission_control()
+    return jsonify(admission.stats() if admission else None)
+
+
+@bp.route('/stats/breakers', methods=['GET'])
+@token_auth.login_required
+def breakers_stats():
+    """State of the circuit breakers of this process"""
+    return jsonify(breaker_stats())
+
+
+@bp.route('/stats/outbox', methods=['GET'])
+@token_auth.login_required
+def outbox_backlog():
+    """Backlog and lag of the outbox"""
+    return jsonify(outbox_stats())
@@ -7,7 +7,6 @@ from urllib.parse import urlencode
 
 from flask import request, abort, current_app, url_for
 from werkzeug.http import dump_cookie
-import requests
 
 from app import db
 from app.api.auth import basic_auth, token_auth
@@ -43,7 +42,6 @@ def new():
     user = basic_auth.current_user()
     token = user.generate_auth_token()
     db.session.add(token)
-    Token.clean()  # keep token table clean of old tokens
     db.session.commit()
     return token_schema.dump(token_response(token))
     
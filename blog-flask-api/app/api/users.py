@@ -7,6 +7,7 @@ from app.api.errors import bad_request
 from app.api.schemas import UserSchema, UpdateUserSchema, EmptySchema
 from app.api.auth import token_auth
 from app.api.pagination_decorator import paginated_response
+from app.cache import cached_response
 from pprint import pprint
 
 
@@ -20,9 +21,9 @@ def new_user():
     data = request.get_json() or {}
     if 'username' not in data or 'email' not in data or 'password' not in data:
         return bad_request('must include username, email and password fields')
-    if User.query.filter_by(username=data['username']).first():
+    if User.get_by_username(data['username']):
         return bad_request('please use a different username')
-    if User.query.filter_by(email=data['email']).first():
+    if User.get_by_email(data['email']):
         return bad_request('please use a different email address')
     user = user_schema.load(data, session=db.session)
     db.session.add(user)
@@ -32,6 +33,21 @@ def new_user():
     return user_schema.dump(user), 201
     
 
+def _unread_count_dependencies():
+    return ['user:{}'.format(token_auth.current_user().id)]
+
+
+@bp.route('/users/me/unread_message_count', methods=['GET'])
+@token_auth.login_required
+@cached_response(_unread_count_dependencies)
+def get_unread_message_count():
+    """Retrieve the unread message count of the authenticated user"""
+    count = db.session.scalar(
+        db.select(User.unread_message_count).where(
+            User.id == token_auth.current_user().id))
+    return jsonify({'unread_message_count': count})
+
+
 @bp.route('/users/<int:id>', methods = ['GET'])
 def get_user_id(id):
     pass
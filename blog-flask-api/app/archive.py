@@ -0,0 +1,44 @@
+import sqlalchemy as sa
+
+ARCHIVE_BIND_KEY = 'archive'
+
+
+def init_app(app):
+    """Add the bind of ARCHIVE_DATABASE_URL, if set.
+
+    The archive tables are in the main database otherwise. They are
+    defined with the other tables either way, so migrations create them
+    there.
+    """
+    url = app.config['ARCHIVE_DATABASE_URL']
+    if url:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[ARCHIVE_BIND_KEY] = url
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def drop_archive_metadata(db):
+    """Forget the empty metadata ``db.init_app`` made for the archive bind,
+    see :func:`app.replicas.drop_replica_metadatas`."""
+    db.metadatas.pop(ARCHIVE_BIND_KEY, None)
+
+
+def is_archive_table(table):
+    return table.info.get('archive', False)
+
+
+def archive_engine(db, mapper):
+    """Return the engine of the archive database when ``mapper`` is that of
+    an archive table and the archive has a database of its own."""
+    if mapper is None or ARCHIVE_BIND_KEY not in db.engines:
+        return None
+    if is_archive_table(sa.inspect(mapper).local_table):
+        return db.engines[ARCHIVE_BIND_KEY]
+
+
+def create_archive_tables(db):
+    """Create the archive tables in the archive database."""
+    engine = db.engines.get(ARCHIVE_BIND_KEY, db.engine)
+    for table in db.metadatas[None].sorted_tables:
+        if is_archive_table(table):
+            table.create(bind=engine, checkfirst=True)
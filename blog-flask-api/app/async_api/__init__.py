@@ -0,0 +1,17 @@
+"""Async versions of the read-heavy API endpoints.
+
+They do not serve more concurrent requests than the sync ones yet, see
+the limitations in app/aio.py.
+"""
+from flask import Blueprint
+from app.replicas import route_to_replica
+
+bp = Blueprint('async_api', __name__)
+
+
+@bp.before_request
+def before_request():
+    route_to_replica()
+
+
+from app.async_api import routes
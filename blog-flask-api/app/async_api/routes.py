@@ -0,0 +1,166 @@
+import json
+from flask import abort, current_app, request
+from app import db
+from app.aio import archive_session, read_session
+from app.api.auth import token_auth
+from app.api.posts import posts_select, archived_posts_select, \
+    post_to_dict, page_args, page_response, delta_args, \
+    delta_where, newer_posts_select, count_select, delta_response
+from app.async_api import bp
+from app.models import User, Post, Notification, Task, followers
+from app.resilience import CircuitOpen, get_breaker
+
+
+@bp.route('/users/<int:id>', methods=['GET'])
+@token_auth.login_required
+async def get_user(id):
+    """Retrieve a user"""
+    post_count = db.select(db.func.count(Post.id)).where(
+        Post.user_id == User.id).scalar_subquery()
+    follower_count = db.select(db.func.count()).where(
+        followers.c.followed_id == User.id).scalar_subquery()
+    followed_count = db.select(db.func.count()).where(
+        followers.c.follower_id == User.id).scalar_subquery()
+    async with read_session() as session:
+        user = (await session.execute(db.select(
+            User.id, User.username, User.about_me, User.last_seen,
+            post_count.label('post_count'),
+            follower_count.label('follower_count'),
+            followed_count.label('followed_count')).where(
+                User.id == id))).first()
+    if user is None:
+        abort(404)
+    return {'id': user.id, 'username': user.username,
+            'about_me': user.about_me,
+            'last_seen': user.last_seen.isoformat() + 'Z'
+            if user.last_seen else None,
+            'post_count': user.post_count,
+            'follower_count': user.follower_count,
+            'followed_count': user.followed_count}
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+async def user_all_post(id):
+    """Retrieve all posts from a user"""
+    after, limit = page_args()
+    async with read_session() as session:
+        user = await session.get(User, id)
+        if user is None:
+            abort(404)
+        rows = (await session.execute(
+            posts_select(Post.user_id == id, after, limit))).all()
+    if len(rows) < limit:
+        async with archive_session() as session:
+            rows += (await session.execute(archived_posts_select(
+                user, rows[-1].id if rows else after,
+                limit - len(rows)))).all()
+    return page_response(rows, limit)
+
+
+@bp.route('/feed', methods=['GET'])
+@token_auth.login_required
+async def feed():
+    """Retrieve the user's feed, or only the posts newer than a cursor"""
+    after, limit = page_args()
+    since_id, since_ts = delta_args()
+    where = db.and_(token_auth.current_user().followed_posts_where(),
+                    *delta_where(since_id, since_ts))
+    async with read_session() as session:
+        new = since_id is None and since_ts is None or \
+            await session.scalar(newer_posts_select(since_id, since_ts))
+        if request.method == 'HEAD':
+            count = await session.scalar(count_select(
+                where, current_app.config['FEED_COUNT_LIMIT'])) if new else 0
+            return '', 200, {'X-New-Posts': str(count)}
+        rows = (await session.execute(
+            posts_select(where, after, limit))).all() if new else []
+    return delta_response(rows, limit, after, since_id)
+
+
+@bp.route('/notifications', methods=['GET'])
+@token_auth.login_required
+async def notifications():
+    """Retrieve the user's notifications newer than ``since``"""
+    since = request.args.get('since', 0.0, type=float)
+    async with read_session() as session:
+        rows = await session.execute(
+            db.select(Notification.name, Notification.payload_json,
+                      Notification.timestamp).where(
+                Notification.user_id == token_auth.current_user().id,
+                Notification.timestamp > since).order_by(
+                    Notification.timestamp.asc()))
+    # payloads are stored as JSON already, so they are not decoded here
+    return current_app.response_class('[{}]'.format(','.join(
+        '{{"name": {}, "data": {}, "timestamp": {}}}'.format(
+            json.dumps(name), payload_json, json.dumps(timestamp))
+        for name, payload_json, timestamp in rows)),
+        mimetype='application/json')
+
+
+async def _task_progress(ids):
+    """Read the progress of RQ jobs the way ``Task.get_progress`` does."""
+    from redis.exceptions import RedisError
+    from rq.job import Job
+    from rq.serializers import resolve_serializer
+    serializer = resolve_serializer()
+    pipeline = current_app.async_redis.pipeline(transaction=False)
+    for id in ids:
+        pipeline.hget(Job.key_for(id), 'meta')
+    try:
+        metas = await get_breaker('redis').call_async(
+            pipeline.execute, errors=(RedisError,))
+    except (CircuitOpen, RedisError):
+        return [None] * len(ids)
+    # a job that expired from Redis has finished
+    return [serializer.loads(meta).get('progress', 0) if meta else 100
+            for meta in metas]
+
+
+@bp.route('/tasks', methods=['GET'])
+@token_auth.login_required
+async def tasks():
+    """Retrieve the user's tasks in progress"""
+    async with read_session() as session:
+        rows = (await session.execute(
+            db.select(Task.id, Task.name, Task.description).where(
+                Task.user_id == token_auth.current_user().id,
+                Task.complete == False))).all()  # noqa: E712
+    progress = await _task_progress([row.id for row in rows]) if rows else []
+    return {'data': [{'id': row.id, 'name': row.name,
+                      'description': row.description, 'progress': p}
+                     for row, p in zip(rows, progress)]}
+
+
+@bp.route('/search', methods=['GET'])
+@token_auth.login_required
+async def search():
+    """Search posts"""
+    q = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(request.args.get('per_page', 25, type=int), 100)
+    es = current_app.async_elasticsearch
+    if not q or es is None:
+        return {'data': [], 'total': 0}
+    from elasticsearch import TransportError
+    try:
+        result = await get_breaker('elasticsearch').call_async(
+            es.search, index=Post.__tablename__,
+            query={'multi_match': {'query': q, 'fields': ['*']}},
+            from_=(page - 1) * per_page, size=per_page,
+            errors=(TransportError,))
+    except CircuitOpen:
+        return {'data': [], 'total': 0}
+    except TransportError:
+        current_app.logger.warning('Search failed', exc_info=True)
+        return {'data': [], 'total': 0}
+    ids = [int(hit['_id']) for hit in result['hits']['hits']]
+    rows = []
+    if ids:
+        async with read_session() as session:
+            rows = (await session.execute(
+                posts_select(Post.id.in_(ids), limit=len(ids)))).all()
+    rank = {id: i for i, id in enumerate(ids)}
+    return {'data': [post_to_dict(row) for row in
+                     sorted(rows, key=lambda row: rank[row.id])],
+            'total': result['hits']['total']['value']}
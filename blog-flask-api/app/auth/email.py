@@ -1,14 +1,32 @@
-from flask import render_template, current_app
-from flask_babel import _
+from flask import render_template, current_app, request
+from flask_babel import _, force_locale, get_locale
+from app import db
 from app.email import send_email
+from app.models import OutboxEvent, User
 
 
 def send_password_reset_email(user):
-    token = user.get_reset_password_token()
-    send_email(_('[Flaskblog] Reset Your Password'),
-               sender=current_app.config['ADMINS'][0],
-               recipients=[user.email],
-               text_body=render_template('email/reset_password.txt',
-                                         user=user, token=token),
-               html_body=render_template('email/reset_password.html',
-                                         user=user, token=token))
\ No newline at end of file
+    # sent by the outbox dispatcher, the request does not wait for SMTP. The
+    # event only names the user, so that no token is stored in the outbox
+    db.session.add(OutboxEvent.create('email.password_reset', {
+        'user_id': user.id, 'locale': str(get_locale()),
+        'url_root': request.url_root}))
+    db.session.commit()
+
+
+def deliver_password_reset_email(user_id, locale, url_root):
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
+    # the links point at the site the reset was requested on
+    with current_app.test_request_context(base_url=url_root), \
+            force_locale(locale):
+        token = user.generate_reset_password_token()
+        send_email(_('[Flaskblog] Reset Your Password'),
+                   sender=current_app.config['DEFAULT_SENDER'][0],
+                   recipients=[user.email],
+                   text_body=render_template('email/reset_password_mail.txt',
+                                             user=user, token=token),
+                   html_body=render_template('email/reset_password_mail.html',
+                                             user=user, token=token),
+                   sync=True)
@@ -0,0 +1,209 @@
+"""Online backfills of large tables.
+
+A schema change that needs the existing rows rewritten is deployed in three
+steps, so that no migration holds a lock on a large table:
+
+1. Expand: a migration adds the new column or table, nullable, and the
+   code is changed to write it for new rows.
+2. Backfill: a function registered here with :func:`backfill` fills the
+   old rows, a range of primary keys at a time, with
+   ``flask backfill run <name>``. The run is throttled, commits a
+   checkpoint after every range, and starts again where it stopped.
+3. Contract: once the backfill is done, a migration adds the constraints
+   or drops the old column. It calls :func:`require_finished` first, so
+   that it cannot run too early.
+"""
+import time
+from flask import current_app
+import sqlalchemy as sa
+from app import db
+from app.models import BackfillCheckpoint, Message, Post, Thread
+
+_backfills = {}
+
+
+class BackfillRunning(Exception):
+    """Another runner holds the backfill."""
+
+
+class Backfill(object):
+    def __init__(self, name, model, func, description):
+        self.name = name
+        self.model = model
+        self.func = func
+        self.description = description
+
+    @property
+    def primary_key(self):
+        return sa.inspect(self.model).primary_key[0]
+
+
+def backfill(name, model):
+    """Register ``func(low, high)`` as the backfill ``name``.
+
+    The function fills the rows of ``model`` whose primary key is above
+    ``low`` and up to ``high``, and returns the number of rows it changed.
+    It runs in the transaction that records the checkpoint, and it can see
+    a range again after a crash, so it must skip rows that are done.
+    """
+    def decorator(func):
+        _backfills[name] = Backfill(name, model, func,
+                                    (func.__doc__ or '').strip())
+        return func
+    return decorator
+
+
+def get_backfill(name):
+    if name not in _backfills:
+        raise LookupError('no backfill named ' + name)
+    return _backfills[name]
+
+
+def list_backfills():
+    return sorted(_backfills.values(), key=lambda job: job.name)
+
+
+def _take_lease(name, owned):
+    """Hold the backfill ``name`` for BACKFILL_LEASE seconds, unless another
+    runner holds it. ``owned`` is true when this runner held it already."""
+    now = time.time()
+    checkpoint = BackfillCheckpoint.__table__
+    free = sa.or_(checkpoint.c.lease_until.is_(None),
+                  checkpoint.c.lease_until < now)
+    result = db.session.execute(
+        sa.update(checkpoint).where(
+            checkpoint.c.name == name,
+            sa.true() if owned else free).values(
+            lease_until=now + current_app.config['BACKFILL_LEASE']))
+    if not result.rowcount:
+        raise BackfillRunning(name)
+
+
+def _start(job, restart):
+    checkpoint = db.session.get(BackfillCheckpoint, job.name)
+    if checkpoint is not None and not restart:
+        return checkpoint
+    if checkpoint is None:
+        checkpoint = BackfillCheckpoint(name=job.name)
+        db.session.add(checkpoint)
+    else:
+        _take_lease(job.name, owned=False)
+    # rows added after this point are written by the new code already
+    end_id, total_rows = db.session.execute(db.select(
+        db.func.max(job.primary_key), db.func.count())).one()
+    now = time.time()
+    checkpoint.last_id = 0
+    checkpoint.end_id = end_id or 0
+    checkpoint.total_rows = total_rows
+    checkpoint.rows_scanned = checkpoint.rows_changed = 0
+    checkpoint.started_at = checkpoint.updated_at = now
+    checkpoint.finished_at = checkpoint.lease_until = None
+    db.session.commit()
+    return checkpoint
+
+
+def run(name, batch_size=None, rows_per_second=None, max_batches=None,
+        restart=False, progress=None):
+    """Run the backfill ``name`` from its checkpoint, and return the
+    checkpoint.
+
+    Each batch is the next ``batch_size`` primary keys, so that sparse ids
+    make batches of the same size. Batches are spaced so that no more than
+    ``rows_per_second`` rows are scanned per second, if given. The run
+    stops after ``max_batches`` batches, if given, and ``progress`` is
+    called with the checkpoint after each one.
+    """
+    config = current_app.config
+    job = get_backfill(name)
+    batch_size = batch_size or config['BACKFILL_BATCH_SIZE']
+    if rows_per_second is None:
+        rows_per_second = config['BACKFILL_ROWS_PER_SECOND']
+    checkpoint = _start(job, restart)
+    pk = job.primary_key
+    owned = False
+    batches = 0
+    try:
+        while checkpoint.finished_at is None and \
+                (max_batches is None or batches < max_batches):
+            started = time.monotonic()
+            _take_lease(name, owned)
+            owned = True
+            ids = db.session.scalars(
+                db.select(pk).where(pk > checkpoint.last_id,
+                                    pk <= checkpoint.end_id)
+                .order_by(pk).limit(batch_size)).all()
+            if ids:
+                changed = job.func(checkpoint.last_id, ids[-1])
+                checkpoint.last_id = ids[-1]
+                checkpoint.rows_scanned += len(ids)
+                checkpoint.rows_changed += changed or 0
+            checkpoint.updated_at = time.time()
+            if len(ids) < batch_size:
+                checkpoint.finished_at = checkpoint.updated_at
+            db.session.commit()
+            batches += 1
+            if progress is not None:
+                progress(checkpoint)
+            if rows_per_second and checkpoint.finished_at is None:
+                time.sleep(max(0.0, len(ids) / rows_per_second -
+                               (time.monotonic() - started)))
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        if owned:
+            db.session.execute(
+                db.update(BackfillCheckpoint)
+                .where(BackfillCheckpoint.name == name)
+                .values(lease_until=None))
+            db.session.commit()
+    return checkpoint
+
+
+def status():
+    checkpoints = {checkpoint.name: checkpoint for checkpoint in
+                   db.session.scalars(db.select(BackfillCheckpoint))}
+    return [dict(checkpoints[job.name].to_dict()
+                 if job.name in checkpoints else {'name': job.name},
+                 description=job.description)
+            for job in list_backfills()]
+
+
+def require_finished(connection, *names):
+    """Raise unless the backfills ``names`` are finished.
+
+    Meant for the contract step of a migration, with ``op.get_bind()``.
+    """
+    checkpoint = BackfillCheckpoint.__table__
+    finished = set(connection.scalars(
+        sa.select(checkpoint.c.name).where(
+            checkpoint.c.name.in_(names),
+            checkpoint.c.finished_at.isnot(None))))
+    missing = [name for name in names if name not in finished]
+    if missing:
+        raise RuntimeError('Run "flask backfill run {}" first'.format(
+            missing[0]))
+
+
+@backfill('post.language', Post)
+def _post_languages(low, high):
+    """Detect the language of posts that do not have one."""
+    from app.language import detect_language
+    rows = db.session.execute(db.select(Post.id, Post.body).where(
+        Post.id > low, Post.id <= high, Post.language.is_(None))).all()
+    if rows:
+        db.session.execute(db.update(Post), [
+            {'id': row.id, 'language': detect_language(row.body)}
+            for row in rows])
+    return len(rows)
+
+
+@backfill('message.thread', Message)
+def _message_threads(low, high):
+    """Attach messages that are not in a thread yet to their threads."""
+    messages = db.session.scalars(db.select(Message).where(
+        Message.id > low, Message.id <= high,
+        Message.thread_id.is_(None)).order_by(Message.id)).all()
+    for message in messages:
+        Thread.attach(message)
+    return len(messages)
@@ -0,0 +1,358 @@
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, request, session
+
+
+class TTLCache(object):
+    """In-process LRU cache whose entries expire after ``ttl`` seconds.
+
+    It is shared by all the threads of a process, and it counts hits and
+    misses so that its hit rate can be reported.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+USER_CACHE_CHANNEL = 'user-cache-invalidate'
+
+
+class UserCacheListener(object):
+    """Background thread that applies the user cache evictions published by
+    the other processes.
+
+    The cache is cleared whenever the subscription starts, because
+    evictions published while this process was not listening are lost.
+    """
+
+    def __init__(self, app, cache, retry_interval=1):
+        self.app = app
+        self.cache = cache
+        self.retry_interval = retry_interval
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or \
+                    self.pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='user-cache-listener')
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                self.app.logger.warning('User cache listener failed',
+                                        exc_info=True)
+            time.sleep(self.retry_interval)
+
+    def listen(self):
+        pubsub = self.app.redis.pubsub()
+        try:
+            pubsub.subscribe(USER_CACHE_CHANNEL)
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                if message['type'] == 'subscribe':
+                    self.cache.clear()
+                elif message['type'] == 'message':
+                    self.cache.delete(*decode_user_cache_keys(
+                        message['data']))
+        finally:
+            pubsub.close()
+
+
+def decode_user_cache_keys(data):
+    return [tuple(key) for key in json.loads(data)]
+
+
+def get_user_cache():
+    """Return the user cache of this process.
+
+    The cache holds the column values of users, without credentials, for
+    up to USER_CACHE_TTL seconds. A process forgets the users it changes
+    itself when it commits. With USER_CACHE_INVALIDATION set to 'redis',
+    it also publishes them, and every other process drops them within
+    about a second. Otherwise other processes see a change only once their
+    copy expires.
+    """
+    cache = current_app.extensions.get('user_cache')
+    if cache is None:
+        cache = TTLCache(current_app.config['USER_CACHE_SIZE'],
+                         current_app.config['USER_CACHE_TTL'])
+        current_app.extensions['user_cache'] = cache
+    if current_app.config['USER_CACHE_INVALIDATION'] == 'redis':
+        listener = current_app.extensions.get('user_cache_listener')
+        if listener is None:
+            listener = UserCacheListener(current_app._get_current_object(),
+                                         cache)
+            current_app.extensions['user_cache_listener'] = listener
+        if listener.pid != os.getpid():
+            listener.start()
+    return cache
+
+
+def evict_users(keys):
+    """Remove users from the user cache of this process, and of the other
+    processes when USER_CACHE_INVALIDATION is 'redis'."""
+    get_user_cache().delete(*keys)
+    if current_app.config['USER_CACHE_INVALIDATION'] == 'redis':
+        try:
+            current_app.redis.publish(USER_CACHE_CHANNEL, json.dumps(
+                [list(key) for key in keys]))
+        except Exception:
+            # the other processes still drop the users after USER_CACHE_TTL
+            current_app.logger.warning('Could not publish user cache '
+                                       'evictions', exc_info=True)
+
+
+class MemoryVersions(object):
+    """Dependency versions of a single process."""
+
+    def __init__(self, maxsize):
+        # a version that was evicted comes back with a value that was never
+        # used, so it cannot match old entries
+        self.versions = TTLCache(maxsize, ttl=24 * 60 * 60)
+        self.counter = itertools.count(1)
+
+    def get_versions(self, dependencies):
+        versions = []
+        for dependency in dependencies:
+            version = self.versions.get(dependency)
+            if version is None:
+                version = next(self.counter)
+                self.versions.set(dependency, version)
+            versions.append(version)
+        return versions
+
+    def bump(self, dependencies):
+        for dependency in dependencies:
+            self.versions.set(dependency, next(self.counter))
+
+
+class RedisVersions(object):
+    """Dependency versions shared by all processes."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def get_versions(self, dependencies):
+        if not dependencies:
+            return []
+        return [int(version or 0) for version in self.redis.mget(
+            ['response-version:' + d for d in dependencies])]
+
+    def bump(self, dependencies):
+        pipeline = self.redis.pipeline(transaction=False)
+        for dependency in dependencies:
+            pipeline.incr('response-version:' + dependency)
+        pipeline.execute()
+
+
+class MemoryResponseStore(object):
+    """Cached responses of a single process.
+
+    The dependency versions live in ``versions``. Unless they are shared
+    by all processes, a change made in one process leaves the others
+    serving their old entries until they time out.
+    """
+
+    def __init__(self, maxsize, versions):
+        self.entries = TTLCache(maxsize)
+        self.versions = versions
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, timeout):
+        self.entries.set(key, value, timeout)
+
+    def get_versions(self, dependencies):
+        return self.versions.get_versions(dependencies)
+
+    def bump(self, dependencies):
+        self.versions.bump(dependencies)
+
+
+class RedisResponseStore(RedisVersions):
+    """Cached responses and dependency versions shared by all processes."""
+
+    def get(self, key):
+        value = self.redis.get('response:' + key)
+        if value is not None:
+            return json.loads(value)
+
+    def set(self, key, value, timeout):
+        self.redis.set('response:' + key, json.dumps(value), ex=timeout)
+
+
+class ResponseCache(object):
+    """Cache of whole view responses, invalidated through dependencies.
+
+    A dependency is a name such as ``user:1``. Each dependency has a version
+    that is bumped when the data it names changes, and the versions of a
+    view's dependencies are part of its cache key, so that entries of a
+    changed dependency are never read again and expire on their own.
+    """
+
+    def __init__(self, store, timeout):
+        self.store = store
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, dependencies, vary):
+        versions = self.store.get_versions(dependencies)
+        return '{}|{}|{}|{}'.format(
+            request.full_path, vary, g.get('locale', ''),
+            ','.join('{}={}'.format(d, v)
+                     for d, v in zip(dependencies, versions)))
+
+    def get(self, key):
+        value = self.store.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, response, timeout=None):
+        try:
+            body = response.get_data(as_text=False).decode('utf-8')
+        except UnicodeDecodeError:
+            return
+        self.store.set(key, {'body': body, 'status': response.status_code,
+                             'mimetype': response.mimetype},
+                       timeout or self.timeout)
+
+    def bump(self, dependencies):
+        if dependencies:
+            self.store.bump(sorted(dependencies))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def get_response_cache():
+    """Return the response cache, or None when it is disabled."""
+    if 'response_cache' not in current_app.extensions:
+        backend = current_app.config['RESPONSE_CACHE_BACKEND']
+        if backend == 'redis':
+            store = RedisResponseStore(current_app.redis)
+        elif backend == 'memory':
+            if current_app.config['RESPONSE_CACHE_VERSIONS'] == 'redis':
+                versions = RedisVersions(current_app.redis)
+            else:
+                versions = MemoryVersions(
+                    current_app.config['RESPONSE_CACHE_SIZE'])
+            store = MemoryResponseStore(
+                current_app.config['RESPONSE_CACHE_SIZE'], versions)
+        else:
+            store = None
+        current_app.extensions['response_cache'] = ResponseCache(
+            store, current_app.config['RESPONSE_CACHE_TIMEOUT']) \
+            if store else None
+    return current_app.extensions['response_cache']
+
+
+def cached_response(dependencies, vary=None, timeout=None):
+    """Cache the successful GET responses of a view.
+
+    ``dependencies`` is called with the view arguments and returns the names
+    of the dependencies of the response, or None when the response should
+    not be cached. ``vary`` returns a string that tells apart the responses
+    of different users, for views that are not the same for everyone.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache = get_response_cache()
+            # flashed messages are rendered into the page
+            if cache is None or request.method != 'GET' or \
+                    '_flashes' in session:
+                return f(*args, **kwargs)
+            names = dependencies(**kwargs)
+            if names is None:
+                return f(*args, **kwargs)
+            try:
+                key = cache.key(names, vary() if vary else '')
+                value = cache.get(key)
+            except Exception:
+                # an unreachable backend only costs the caching
+                current_app.logger.warning('Response cache failed',
+                                           exc_info=True)
+                return f(*args, **kwargs)
+            if value is not None:
+                response = current_app.response_class(
+                    value['body'], value['status'],
+                    mimetype=value['mimetype'])
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                try:
+                    cache.set(key, response, timeout)
+                except Exception:
+                    current_app.logger.warning('Response cache failed',
+                                               exc_info=True)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
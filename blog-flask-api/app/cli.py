@@ -1,5 +1,6 @@
 import os
 import click
+from flask import current_app
 
 
 def register(app):
@@ -32,4 +33,298 @@ def register(app):
     def compile():
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
-            raise RuntimeError('compile command failed')
\ No newline at end of file
+            raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def tokens():
+        """Token maintenance commands."""
+        pass
+
+    @tokens.command()
+    @click.option('--batch-size', type=int, default=None,
+                  help='Rows deleted per transaction.')
+    def clean(batch_size):
+        """Remove expired tokens now."""
+        from app.models import Token
+        deleted = Token.clean(
+            batch_size or current_app.config['TOKEN_CLEANUP_BATCH_SIZE'])
+        print(deleted, 'expired tokens removed.')
+
+    @tokens.command()
+    def schedule():
+        """Start the periodic token sweeper on the task queue.
+
+        The sweeper needs an RQ worker started with --with-scheduler.
+        """
+        current_app.task_queue.enqueue('app.tasks.clean_tokens')
+        print('Token sweeper scheduled every {} minutes.'.format(
+            current_app.config['TOKEN_CLEANUP_INTERVAL_MINS']))
+
+
+    @app.cli.group()
+    def notifications():
+        """Notification maintenance commands."""
+        pass
+
+    @notifications.command()
+    @click.option('--days', type=int, default=None,
+                  help='Keep notifications newer than this many days.')
+    @click.option('--batch-size', type=int, default=None,
+                  help='Rows deleted per transaction.')
+    def prune(days, batch_size):
+        """Remove old notifications now."""
+        from app.models import Notification
+        deleted = Notification.prune(
+            days or current_app.config['NOTIFICATION_RETENTION_DAYS'],
+            batch_size or current_app.config['NOTIFICATION_PRUNE_BATCH_SIZE'])
+        print(deleted, 'old notifications removed.')
+
+    @notifications.command()
+    def schedule():
+        """Start the periodic notification pruning on the task queue.
+
+        Pruning needs an RQ worker started with --with-scheduler.
+        """
+        current_app.task_queue.enqueue('app.tasks.prune_notifications')
+        print('Notification pruning scheduled every {} minutes.'.format(
+            current_app.config['NOTIFICATION_PRUNE_INTERVAL_MINS']))
+
+    @app.cli.group()
+    def posts():
+        """Post maintenance commands."""
+        pass
+
+    @posts.command('detect-languages')
+    @click.option('--chunk-size', type=int, default=1000,
+                  help='Posts sent to a worker process at a time.')
+    @click.option('--workers', type=int, default=None,
+                  help='Number of worker processes.')
+    def detect_languages(chunk_size, workers):
+        """Detect the language of posts that do not have one."""
+        from app.language import backfill_languages
+        total = backfill_languages(chunk_size, workers)
+        print(total, 'posts updated.')
+
+
+    @app.cli.group()
+    def mail():
+        """Email commands."""
+        pass
+
+    @mail.command('debug-server')
+    @click.option('--host', default=None, help='Defaults to MAIL_SERVER.')
+    @click.option('--port', type=int, default=None,
+                  help='Defaults to MAIL_PORT.')
+    def debug_server(host, port):
+        """Run a local SMTP server that prints the messages it gets."""
+        from app.debug_smtp import DebugSMTPServer
+        server = DebugSMTPServer(
+            host or current_app.config['MAIL_SERVER'] or 'localhost',
+            port or current_app.config['MAIL_PORT'], echo=True)
+        print('Debugging SMTP server listening on {}:{}'.format(
+            server.hostname, server.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+
+
+    @app.cli.group()
+    def messages():
+        """Private message maintenance commands."""
+        pass
+
+    @messages.command('reconcile-unread')
+    @click.option('--batch-size', type=int, default=1000,
+                  help='Users checked per transaction.')
+    def reconcile_unread(batch_size):
+        """Recompute the unread message counters of all users."""
+        from app.models import User
+        fixed = User.reconcile_unread_counts(batch_size)
+        print(fixed, 'unread message counters fixed.')
+
+    @messages.command('build-threads')
+    @click.option('--batch-size', type=int, default=1000,
+                  help='Messages attached per transaction.')
+    def build_threads(batch_size):
+        """Attach messages that are not in a thread yet to their threads."""
+        from app.models import Thread
+        total = Thread.backfill(batch_size)
+        print(total, 'messages attached to threads.')
+
+    @app.cli.group()
+    def outbox():
+        """Outbox event commands."""
+        pass
+
+    @outbox.command()
+    @click.option('--batch-size', type=int, default=None,
+                  help='Events delivered per transaction.')
+    def dispatch(batch_size):
+        """Deliver the events that are due now."""
+        from app.outbox import drain
+        delivered, failed = drain(batch_size)
+        print(delivered, 'events delivered,', failed, 'failed.')
+
+    @outbox.command('run')
+    @click.option('--batch-size', type=int, default=None,
+                  help='Events delivered per transaction.')
+    def run_dispatcher(batch_size):
+        """Deliver events as they come, for OUTBOX_DISPATCHER=external."""
+        import time
+        from app.outbox import drain, prune_failed, PRUNE_INTERVAL
+        pruned_at = 0
+        while True:
+            delivered, failed = drain(batch_size)
+            if delivered or failed:
+                current_app.logger.info('%d events delivered, %d failed',
+                                        delivered, failed)
+            if time.time() - pruned_at > PRUNE_INTERVAL:
+                prune_failed()
+                pruned_at = time.time()
+            time.sleep(current_app.config['OUTBOX_POLL_INTERVAL'])
+
+    @outbox.command()
+    def stats():
+        """Show the backlog and lag of the outbox."""
+        from app.outbox import outbox_stats
+        stats = outbox_stats()
+        print('{pending} pending, {failed} failed, lag {lag:.1f}s'.format(
+            **stats))
+
+    @outbox.command()
+    def retry():
+        """Retry the events that failed too many times."""
+        from app.outbox import retry_failed
+        print(retry_failed(), 'events will be retried.')
+
+    @outbox.command()
+    @click.option('--days', type=int, default=None,
+                  help='Age of the failed events to delete.')
+    def prune(days):
+        """Delete old events that failed too many times."""
+        from app.outbox import prune_failed
+        print(prune_failed(days), 'failed events deleted.')
+
+    @app.cli.group()
+    def archive():
+        """Archival commands for old posts and messages."""
+        pass
+
+    @archive.command('create-tables')
+    def create_tables():
+        """Create the archive tables in ARCHIVE_DATABASE_URL."""
+        from app import db
+        from app.archive import create_archive_tables
+        create_archive_tables(db)
+        print('Archive tables created.')
+
+    @archive.command('run')
+    @click.option('--days', type=int, default=None,
+                  help='Archive rows older than this many days.')
+    @click.option('--batch-size', type=int, default=None,
+                  help='Rows moved per transaction.')
+    def run_archive(days, batch_size):
+        """Move old posts and messages to the archive now."""
+        from app.models import PostArchive, MessageArchive
+        days = days or current_app.config['ARCHIVE_AFTER_DAYS']
+        batch_size = batch_size or current_app.config['ARCHIVE_BATCH_SIZE']
+        print(PostArchive.archive(days, batch_size), 'posts and',
+              MessageArchive.archive(days, batch_size), 'messages archived.')
+
+    @archive.command()
+    def schedule():
+        """Start the periodic archiving on the task queue.
+
+        Archiving needs an RQ worker started with --with-scheduler.
+        """
+        current_app.task_queue.enqueue('app.tasks.archive_old_rows')
+        print('Archiving scheduled every {} minutes.'.format(
+            current_app.config['ARCHIVE_INTERVAL_MINS']))
+
+    @app.cli.group()
+    def backfill():
+        """Online backfill commands for large tables."""
+        pass
+
+    @backfill.command('list')
+    def list_backfills():
+        """Show the backfills and how far they went."""
+        from app.backfill import status
+        for job in status():
+            state = 'not started' if 'progress' not in job else \
+                'finished' if job['finished_at'] else \
+                '{progress}% ({rows_scanned}/{total_rows} rows)'.format(**job)
+            print('{:<24} {:<28} {}'.format(job['name'], state,
+                                            job['description']))
+
+    @backfill.command('run')
+    @click.argument('name')
+    @click.option('--batch-size', type=int, default=None,
+                  help='Rows per transaction.')
+    @click.option('--rows-per-second', type=int, default=None,
+                  help='Throttle, 0 for none.')
+    @click.option('--batches', type=int, default=None,
+                  help='Stop after this many batches.')
+    @click.option('--restart', is_flag=True,
+                  help='Start again from the first row.')
+    def run_backfill(name, batch_size, rows_per_second, batches, restart):
+        """Run a backfill from its last checkpoint."""
+        from app.backfill import run
+
+        def progress(checkpoint):
+            print('\r{}: {}/{} rows, {} changed'.format(
+                name, checkpoint.rows_scanned, checkpoint.total_rows,
+                checkpoint.rows_changed), end='', flush=True)
+
+        checkpoint = run(name, batch_size, rows_per_second, batches, restart,
+                         progress)
+        print()
+        print('Finished.' if checkpoint.finished_at else
+              'Stopped at id {}, run again to resume.'.format(
+                  checkpoint.last_id))
+
+    @app.cli.group()
+    def worker():
+        """Background job worker commands."""
+        pass
+
+    @worker.command()
+    @click.argument('queues', nargs=-1)
+    @click.option('--threads', type=int, default=None,
+                  help='Jobs run at the same time. Defaults to '
+                  'WORKER_THREADS.')
+    @click.option('--burst', is_flag=True,
+                  help='Quit when the queues are empty.')
+    @click.option('--with-scheduler', is_flag=True,
+                  help='Also enqueue scheduled jobs when they are due.')
+    def run(queues, threads, burst, with_scheduler):
+        """Run a worker that preloads the application."""
+        from app.worker import run_worker
+        run_worker(current_app._get_current_object(),
+                   queues or ['microblog-tasks'],
+                   threads or current_app.config['WORKER_THREADS'],
+                   burst=burst, with_scheduler=with_scheduler)
+
+    @app.cli.group()
+    def perf():
+        """Performance commands."""
+        pass
+
+    @perf.command()
+    @click.option('--runs', type=int, default=3,
+                  help='Number of cold starts to average.')
+    def startup(runs):
+        """Report import and app creation time per extension."""
+        import json
+        import subprocess
+        import sys
+        script = os.path.join(os.path.dirname(__file__), 'perf.py')
+        totals = {}
+        for i in range(runs):
+            output = subprocess.run([sys.executable, script], check=True,
+                                    capture_output=True, text=True).stdout
+            for name, seconds in json.loads(output.splitlines()[-1]):
+                totals[name] = totals.get(name, 0) + seconds
+        for name, seconds in totals.items():
+            print('{:<32} {:>8.1f} ms'.format(name, seconds / runs * 1000))
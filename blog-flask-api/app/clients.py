@@ -0,0 +1,80 @@
+import os
+import threading
+
+
+class LazyClient(object):
+    """Application attribute that creates its client on first use.
+
+    ``factory`` is called with the application the first time the attribute
+    is read. The client is kept in ``app.extensions`` together with the id
+    of the process that created it, so that a forked worker builds its own
+    client instead of sharing sockets with its parent. Assigning to the
+    attribute replaces the client, which is handy in tests.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        # the lock may have been held by another thread at fork time
+        self.lock = threading.Lock()
+
+    def __set_name__(self, owner, name):
+        self.key = 'client.' + name
+
+    def __get__(self, app, owner=None):
+        if app is None:
+            return self
+        entry = app.extensions.get(self.key)
+        if entry is None or entry[0] != os.getpid():
+            with self.lock:
+                entry = app.extensions.get(self.key)
+                if entry is None or entry[0] != os.getpid():
+                    entry = (os.getpid(), self.factory(app))
+                    app.extensions[self.key] = entry
+        return entry[1]
+
+    def __set__(self, app, client):
+        app.extensions[self.key] = (os.getpid(), client)
+
+
+def create_elasticsearch(app):
+    if not app.config['ELASTICSEARCH_URL']:
+        return None
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([app.config['ELASTICSEARCH_URL']],
+                         request_timeout=app.config['ELASTICSEARCH_TIMEOUT'],
+                         max_retries=app.config['ELASTICSEARCH_MAX_RETRIES'])
+
+
+def create_redis(app):
+    from redis import Redis
+    return Redis.from_url(
+        app.config['REDIS_URL'],
+        socket_connect_timeout=app.config['REDIS_CONNECT_TIMEOUT'],
+        socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'])
+
+
+def create_task_queue(app):
+    import rq
+    return rq.Queue('microblog-tasks', connection=app.redis)
+
+
+def create_async_elasticsearch(app):
+    if not app.config['ELASTICSEARCH_URL']:
+        return None
+    from elasticsearch import AsyncElasticsearch
+    return AsyncElasticsearch(
+        [app.config['ELASTICSEARCH_URL']],
+        request_timeout=app.config['ELASTICSEARCH_TIMEOUT'],
+        max_retries=app.config['ELASTICSEARCH_MAX_RETRIES'])
+
+
+def create_async_redis(app):
+    from redis.asyncio import Redis
+    return Redis.from_url(
+        app.config['REDIS_URL'],
+        socket_connect_timeout=app.config['REDIS_CONNECT_TIMEOUT'],
+        socket_timeout=app.config['REDIS_SOCKET_TIMEOUT'])
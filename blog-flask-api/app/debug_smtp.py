@@ -0,0 +1,98 @@
+import socketserver
+import threading
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        envelope = {}
+        self.reply('220 {} debugging SMTP server'.format(server.hostname))
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.reply('250-{}'.format(server.hostname))
+                self.reply('250 8BITMIME')
+            elif verb in ('HELO', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                envelope = {}
+                self.reply('250 OK')
+            elif verb == 'MAIL':
+                envelope = {'from': command[10:].strip(), 'to': []}
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = command[8:].strip()
+                if recipient.strip('<>') in server.refused:
+                    self.reply('550 No such user')
+                    continue
+                envelope.setdefault('to', []).append(recipient)
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    if data_line.startswith(b'..'):
+                        data_line = data_line[1:]
+                    data.append(data_line)
+                envelope['data'] = b''.join(data)
+                server.deliver(envelope)
+                envelope = {}
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class DebugSMTPServer(socketserver.ThreadingTCPServer):
+    """Local SMTP server that accepts every message and keeps it in memory.
+
+    It stands in for a real mail server in tests, benchmarks and
+    development. Use port 0 to let the system pick a free port.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, host='localhost', port=8025, echo=False):
+        super().__init__((host, port), _SMTPHandler)
+        self.hostname = host
+        self.echo = echo
+        # addresses that are refused, to try out rejected messages
+        self.refused = set()
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def deliver(self, envelope):
+        with self.lock:
+            self.messages.append(envelope)
+        if self.echo:
+            print('---------- MESSAGE FOLLOWS ----------')
+            print(envelope['data'].decode('utf-8', 'replace'))
+            print('------------ END MESSAGE ------------')
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,12 +1,117 @@
-from threading import Thread
+import os
+import queue
+import smtplib
+import threading
+import time
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class MailWorker(object):
+    """Background thread that sends queued messages in batches.
+
+    Each batch goes out over a single SMTP connection. When the server
+    fails, the unsent part of the batch is retried with exponential
+    backoff, and a message the server refuses is logged and skipped. The
+    queue is bounded so that a burst of messages cannot grow memory
+    without limit.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or \
+                    self.pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='mail-worker')
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def submit(self, msg):
+        """Queue ``msg`` and return True, or return False when the queue
+        stayed full for MAIL_QUEUE_TIMEOUT seconds and it was dropped."""
+        self.start()
+        try:
+            self.queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            self.app.logger.error('Mail queue full, email to %s dropped',
+                                  ', '.join(msg.recipients))
+            return False
+        return True
+
+    def flush(self):
+        """Wait until every queued message has been handled."""
+        self.queue.join()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.app.config['MAIL_BATCH_SIZE']:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                batch = self.next_batch()
+                try:
+                    self.send_batch(batch)
+                finally:
+                    for msg in batch:
+                        self.queue.task_done()
+
+    def send_batch(self, batch):
+        pending = list(batch)
+        retries = 0
+        while pending:
+            try:
+                with mail.connect() as conn:
+                    while pending:
+                        msg = pending.pop(0)
+                        try:
+                            conn.send(msg)
+                        except Exception as error:
+                            if not _rejected(error):
+                                pending.insert(0, msg)
+                                raise
+                            # sending it again would fail the same way
+                            self.app.logger.error(
+                                'Email to %s rejected: %r',
+                                ', '.join(msg.recipients), error)
+            except Exception:
+                retries += 1
+                if retries > self.app.config['MAIL_MAX_RETRIES']:
+                    self.app.logger.exception(
+                        'Could not send %d email(s)', len(pending))
+                    return
+                time.sleep(self.app.config['MAIL_RETRY_BACKOFF'] *
+                           2 ** (retries - 1))
+
+
+def _rejected(error):
+    """Tell whether the server refused a message for good, rather than the
+    connection failing."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and \
+        error.smtp_code >= 500
+
+
+def get_mail_worker():
+    worker = current_app.extensions.get('mail_worker')
+    if worker is None:
+        worker = MailWorker(current_app._get_current_object())
+        current_app.extensions['mail_worker'] = worker
+    return worker
 
 
 def send_email(subject, sender, recipients, text_body, html_body,
@@ -20,5 +125,4 @@ def send_email(subject, sender, recipients, text_body, html_body,
     if sync:
         mail.send(msg)
     else:
-        Thread(target=send_async_email,
-            args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+        get_mail_worker().submit(msg)
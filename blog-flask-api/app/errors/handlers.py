@@ -1,7 +1,9 @@
 from flask import render_template, request
+from werkzeug.exceptions import ServiceUnavailable
 from app import db
 from app.errors import bp
 from app.api.errors import error_response as api_error_response
+from app.passwords import PasswordHasherBusy
 
 
 def wants_json_response():
@@ -21,4 +23,27 @@ def internal_error(error):
     db.session.rollback()
     if wants_json_response():
         return api_error_response(500)
-    return render_template('errors/500.html'), 500
\ No newline at end of file
+    return render_template('errors/500.html'), 500
+
+
+@bp.app_errorhandler(PasswordHasherBusy)
+def password_hasher_busy_error(error):
+    db.session.rollback()
+    if wants_json_response():
+        response = api_error_response(503)
+    else:
+        response = ServiceUnavailable().get_response()
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@bp.app_errorhandler(429)
+@bp.app_errorhandler(503)
+def overloaded_error(error):
+    if wants_json_response():
+        response = api_error_response(error.code)
+    else:
+        response = error.get_response()
+    if getattr(error, 'retry_after', None):
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
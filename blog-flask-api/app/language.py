@@ -0,0 +1,91 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from flask import current_app
+from app import db
+from app.models import Post
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4096)
+def detect_language(text):
+    # langdetect loads its language profiles on first use, which is slow,
+    # so it is only imported by the detection workers
+    from langdetect import DetectorFactory, detect, LangDetectException
+    DetectorFactory.seed = 0  # make the results deterministic
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+def detect_languages(texts):
+    return [detect_language(text) for text in texts]
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                current_app.config['LANGUAGE_DETECTION_WORKERS'],
+                thread_name_prefix='language-detection')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _set_post_language(app, post_id, text):
+    with app.app_context():
+        try:
+            db.session.execute(db.update(Post).where(Post.id == post_id).values(
+                language=detect_language(text)))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Language detection failed for post %d',
+                                 post_id)
+
+
+def detect_post_language(post):
+    """Detect the language of a committed post in the background."""
+    app = current_app._get_current_object()
+    if not app.config['LANGUAGE_DETECTION_WORKERS']:
+        _set_post_language(app, post.id, post.body)
+        return
+    _get_executor().submit(_set_post_language, app, post.id, post.body)
+
+
+def backfill_languages(chunk_size=1000, workers=None):
+    """Detect the language of all posts that do not have one yet.
+
+    Posts are read in primary key order, ``workers`` chunks at a time, and
+    each chunk is detected in a separate process.
+    """
+    workers = workers or os.cpu_count()
+    last_id = 0
+    total = 0
+    with ProcessPoolExecutor(workers) as executor:
+        while True:
+            rows = db.session.execute(
+                db.select(Post.id, Post.body).where(
+                    Post.language.is_(None), Post.id > last_id)
+                .order_by(Post.id).limit(chunk_size * workers)).all()
+            if not rows:
+                break
+            chunks = [rows[i:i + chunk_size]
+                      for i in range(0, len(rows), chunk_size)]
+            results = executor.map(detect_languages,
+                                   [[row.body for row in chunk]
+                                    for chunk in chunks])
+            for chunk, languages in zip(chunks, results):
+                db.session.execute(db.update(Post), [
+                    {'id': row.id, 'language': language}
+                    for row, language in zip(chunk, languages)])
+            db.session.commit()
+            last_id = rows[-1].id
+            total += len(rows)
+    return total
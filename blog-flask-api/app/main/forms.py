@@ -18,7 +18,7 @@ class EditProfileForm(FlaskForm):
 
     def validate_username(self, username):
         if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()
+            user = User.get_by_username(self.username.data)
             if user is not None:
                 raise ValidationError(_('Please use a different username.'))
 
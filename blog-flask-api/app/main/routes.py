@@ -1,22 +1,30 @@
 from datetime import datetime
+import json
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from langdetect import detect, LangDetectException
 from app import db
+from app.replicas import read_replica
+from app.cache import cached_response
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, \
     MessageForm
-from app.models import User, Post, Message, Notification
-from app.translate import translate
+from app.models import User, Post, Notification, Thread
+from app.rows import post_rows_select, paginate_post_rows, post_rows_by_id, \
+    archived_post_rows, message_rows
+from app.search import query_index
+from app.translate import translate, translate_many
+from app.language import detect_post_language
 from app.main import bp
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # committing expires the user loaded from the cache, so only
+        # commit when last_seen actually changed
+        if current_user.ping():
+            db.session.commit()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -24,23 +32,21 @@ def before_request():
 
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
+@read_replica
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
+        detect_post_language(post)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
     page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
+    posts = paginate_post_rows(
+        post_rows_select(current_user.followed_posts_where())
+        .order_by(Post.newest_first()),
+        page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.index', page=posts.next_num) \
         if posts.has_next else None
     prev_url = url_for('main.index', page=posts.prev_num) \
@@ -50,13 +56,30 @@ def index():
                            prev_url=prev_url)
 
 
+def _viewer():
+    return str(current_user.id)
+
+
+def _explore_dependencies():
+    return ['posts', 'user:{}'.format(current_user.id)]
+
+
+def _user_dependencies(username):
+    user = User.get_by_username(username)
+    if user is not None:
+        return ['user:{}'.format(user.id), 'posts:{}'.format(user.id),
+                'user:{}'.format(current_user.id)]
+
+
 @bp.route('/explore')
 @login_required
+@read_replica
+@cached_response(_explore_dependencies, vary=_viewer)
 def explore():
     page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
+    posts = paginate_post_rows(
+        post_rows_select().order_by(Post.newest_first()),
+        page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.explore', page=posts.next_num) \
         if posts.has_next else None
     prev_url = url_for('main.explore', page=posts.prev_num) \
@@ -68,25 +91,38 @@ def explore():
 
 @bp.route('/user/<username>')
 @login_required
+@read_replica
+@cached_response(_user_dependencies, vary=_viewer)
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.get_by_username(username) or abort(404)
     page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    posts = paginate_post_rows(
+        post_rows_select(Post.user_id == user.id)
+        .order_by(Post.newest_first()), page, per_page)
+    items, has_next = posts.items, posts.has_next
+    if not has_next:
+        # the older posts go on in the archive
+        missing = per_page - len(items)
+        archived = archived_post_rows(
+            user, max(0, (page - 1) * per_page - posts.total), missing + 1)
+        items = items + archived[:missing]
+        has_next = len(archived) > missing
     next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
+                       page=page + 1) if has_next else None
     prev_url = url_for('main.user', username=user.username,
                        page=posts.prev_num) if posts.has_prev else None
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
+    return render_template('user.html', user=user, posts=items,
                            next_url=next_url, prev_url=prev_url, form=form)
 
 
 @bp.route('/user/<username>/popup')
 @login_required
+@read_replica
+@cached_response(_user_dependencies, vary=_viewer)
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.get_by_username(username) or abort(404)
     form = EmptyForm()
     return render_template('user_popup.html', user=user, form=form)
 
@@ -113,7 +149,7 @@ def edit_profile():
 def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.get_by_username(username)
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -133,7 +169,7 @@ def follow(username):
 def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.get_by_username(username)
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -156,14 +192,43 @@ def translate_text():
                                       request.form['dest_language'])})
 
 
+@bp.route('/translate_batch', methods=['POST'])
+@login_required
+def translate_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or \
+            not isinstance(data.get('ids', []), list) or \
+            not isinstance(data.get('dest_language') or '', str):
+        abort(400)
+    try:
+        ids = [int(id) for id in data.get('ids', [])[:100]]
+    except (TypeError, ValueError):
+        abort(400)
+    dest_language = data.get('dest_language') or g.locale
+    posts_by_language = {}
+    for post in db.session.execute(
+            db.select(Post.id, Post.body, Post.language).where(
+                Post.id.in_(ids))):
+        if post.language and post.language != dest_language:
+            posts_by_language.setdefault(post.language, []).append(post)
+    translations = {}
+    for source_language, posts in posts_by_language.items():
+        texts = translate_many([post.body for post in posts],
+                               source_language, dest_language)
+        for post, text in zip(posts, texts):
+            translations[post.id] = text
+    return jsonify({'translations': translations})
+
+
 @bp.route('/search')
 @login_required
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
+    ids, total = query_index(Post.__tablename__, g.search_form.q.data, page,
+                             current_app.config['POSTS_PER_PAGE'])
+    posts = post_rows_by_id(ids) if ids else []
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -175,13 +240,13 @@ def search():
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user = User.query.filter_by(username=recipient).first_or_404()
+    user = User.get_by_username(recipient) or abort(404)
     form = MessageForm()
     if form.validate_on_submit():
-        msg = Message(author=current_user, recipient=user,
-                      body=form.message.data)
-        db.session.add(msg)
-        user.add_notification('unread_message_count', user.new_messages())
+        current_user.send_message(user, form.message.data)
+        db.session.flush()
+        user.add_notification('unread_message_count',
+                              user.unread_message_count)
         db.session.commit()
         flash(_('Your message has been sent.'))
         return redirect(url_for('main.user', username=recipient))
@@ -193,19 +258,40 @@ def send_message(recipient):
 @login_required
 def messages():
     current_user.last_message_read_time = datetime.utcnow()
+    current_user.unread_message_count = 0
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page=page, per_page=current_app.config['POSTS_PER_PAGE'],
-            error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
-                           next_url=next_url, prev_url=prev_url)
+    before = request.args.get('before', type=int)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    conversations = current_user.conversations(before=before,
+                                               per_page=per_page + 1)
+    next_url = url_for('main.messages',
+                       before=conversations[per_page - 1][0].last_message_id) \
+        if len(conversations) > per_page else None
+    return render_template('messages.html', title=_('Messages'),
+                           conversations=conversations[:per_page],
+                           next_url=next_url)
+
+
+@bp.route('/messages/<username>')
+@login_required
+def thread(username):
+    user = User.get_by_username(username) or abort(404)
+    # the thread is created by the first message, not by looking at it
+    thread = Thread.between(current_user, user, create=False)
+    if thread is None:
+        return render_template('thread.html', title=_('Messages'), user=user,
+                               messages=[], next_url=None)
+    current_user.read_thread(thread)
+    db.session.commit()
+    before = request.args.get('before', type=int)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    messages = message_rows(thread, before=before, per_page=per_page + 1)
+    next_url = url_for('main.thread', username=username,
+                       before=messages[per_page - 1].id) \
+        if len(messages) > per_page else None
+    return render_template('thread.html', title=_('Messages'), user=user,
+                           messages=messages[:per_page], next_url=next_url)
 
 
 @bp.route('/export_posts')
@@ -223,10 +309,15 @@ def export_posts():
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
\ No newline at end of file
+    notifications = db.session.execute(
+        db.select(Notification.name, Notification.payload_json,
+                  Notification.timestamp).where(
+            Notification.user_id == current_user.id,
+            Notification.timestamp > since).order_by(
+                Notification.timestamp.asc()))
+    # payloads are stored as JSON already, so they are not decoded here
+    return current_app.response_class('[{}]'.format(','.join(
+        '{{"name": {}, "data": {}, "timestamp": {}}}'.format(
+            json.dumps(name), payload_json, json.dumps(timestamp))
+        for name, payload_json, timestamp in notifications)),
+        mimetype='application/json')
\ No newline at end of file
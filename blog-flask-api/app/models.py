@@ -1,18 +1,34 @@
 import base64
 from datetime import datetime, timedelta
+import hashlib
 from hashlib import md5
 import json
 import os
 import secrets
 from time import time
-from flask import current_app, url_for
+import uuid
+from flask import current_app, has_app_context, url_for
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
-import redis
-import rq
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import add_to_index, query_index
+from app.revocation import get_denylist, access_token_ttl
+from app.passwords import get_hasher
+from app.cache import get_user_cache, get_response_cache, evict_users
+from app.resilience import CircuitOpen, get_breaker
+from app.snowflake import BigIntegerId, assign_id
+
+
+def email_hash(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+def gravatar_url(email_hash, size):
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
+        email_hash, size)
 
 
 class SearchableMixin(object):
@@ -27,35 +43,35 @@ class SearchableMixin(object):
         return cls.query.filter(cls.id.in_(ids)).order_by(
             db.case(when, value=cls.id)), total
 
-    @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
-
-    @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
-
     @classmethod
     def reindex(cls):
         for obj in cls.query:
             add_to_index(cls.__tablename__, obj)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
-db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+def _collect_search_events(session, flush_context):
+    # runs after the flush, when new objects have their id
+    if not has_app_context() or not current_app.config['ELASTICSEARCH_URL']:
+        return
+    events = session.info.setdefault('search_events', [])
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, SearchableMixin) and obj not in session.deleted \
+                and (obj in session.new or session.is_modified(obj)):
+            events.append(('search.index', obj))
+    for obj in session.deleted:
+        if isinstance(obj, SearchableMixin):
+            events.append(('search.remove', obj))
+
+
+def _emit_search_events(session, flush_context):
+    # the events are flushed with the rest of the transaction
+    for topic, obj in session.info.pop('search_events', []):
+        session.add(OutboxEvent.create(
+            topic, {'index': obj.__tablename__, 'id': obj.id}))
+
+
+db.event.listen(db.session, 'after_flush', _collect_search_events)
+db.event.listen(db.session, 'after_flush_postexec', _emit_search_events)
 
 
 
@@ -78,20 +94,24 @@ class Token(db.Model):
     access_token = db.Column(db.String(64), index=True)
     access_expiration = db.Column(db.DateTime)
     refresh_token = db.Column(db.String(64), index=True)
-    refresh_expiration = db.Column(db.DateTime)
+    refresh_expiration = db.Column(db.DateTime, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
     @property
     def access_jwt_token(self):
-        return jwt.endcode({'token' : self.access_token},
-                            current_app.config['SECRET_KEY'],
-                            algorithm = 'HS256')
+        claims = {'token': self.access_token}
+        if current_app.config['STATELESS_ACCESS_TOKENS']:
+            # the claims are enough to verify the token without a lookup
+            claims.update({'sub': str(self.user_id), 'jti': self.access_token,
+                           'iat': time(), 'exp': self.access_expiration})
+        return jwt.encode(claims, current_app.config['SECRET_KEY'],
+                          algorithm='HS256')
 
     def generate(self):
         self.access_token = secrets.token_urlsafe()
-        self.access_expiration = datetime.now() + timedelta(minutes = current_app.config['ACCESS_TOKEN_EXPIRE_MINS'])
+        self.access_expiration = datetime.utcnow() + timedelta(minutes = current_app.config['ACCESS_TOKEN_EXPIRE_MINS'])
         self.refresh_token = secrets.token_urlsafe()
-        self.refresh_expiration = datetime.now() + timedelta(days = current_app.config['REFRESH_TOKEN_EXPIRE_DAYS'])
+        self.refresh_expiration = datetime.utcnow() + timedelta(days = current_app.config['REFRESH_TOKEN_EXPIRE_DAYS'])
 
     def expire(self, delay=None):
         if delay is None:
@@ -101,21 +121,53 @@ class Token(db.Model):
         self.refresh_expiration = datetime.utcnow() + timedelta(seconds = delay)
     
     @staticmethod
-    def clean():
-        """Remove any tokens that have been expired for more than a day."""
+    def clean(batch_size=1000):
+        """Remove any tokens that have been expired for more than a day.
+
+        Rows are deleted in batches of ``batch_size`` with a commit after each
+        batch, so that the table is never locked for long.
+        """
         yesterday = datetime.utcnow() - timedelta(days=1)
-        db.session.execute(db.delete(Token).where(Token.refresh_expiration < yesterday))
+        deleted = 0
+        while True:
+            ids = db.session.execute(
+                db.select(Token.id).where(Token.refresh_expiration < yesterday)
+                .limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            db.session.execute(db.delete(Token).where(Token.id.in_(ids)))
+            db.session.commit()
+            deleted += len(ids)
+        return deleted
 
     @staticmethod
     def from_jwt(access_jwt_token):
         access_token = None
         try:
+            # expired access tokens are still accepted here to refresh them
             access_token = jwt.decode(access_jwt_token, current_app.config['SECRET_KEY'],
-                                    algorithm=['HS256'])['token']
+                                    algorithms=['HS256'],
+                                    options={'verify_exp': False})['token']
             return db.session.execute(db.select(Token).filter_by(access_token=access_token)).scalar()
         except jwt.PyJWTError:
             pass
 
+    @staticmethod
+    def claims_from_jwt(access_jwt_token):
+        """Verify a stateless access token without touching the database."""
+        try:
+            claims = jwt.decode(access_jwt_token,
+                                current_app.config['SECRET_KEY'],
+                                algorithms=['HS256'],
+                                options={'require': ['sub', 'jti', 'iat',
+                                                     'exp']})
+        except jwt.PyJWTError:
+            return
+        not_before = get_denylist().get_not_before(int(claims['sub']))
+        if not_before is not None and claims['iat'] < not_before:
+            return
+        return claims
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
@@ -137,6 +189,8 @@ class User(db.Model):
                                         foreign_keys='Message.recipient_id',
                                         backref='recipient', lazy='dynamic')
     last_message_read_time = db.Column(db.DateTime)
+    unread_message_count = db.Column(db.Integer, nullable=False, default=0,
+                                     server_default='0')
     notifications = db.relationship('Notification', backref='user',
                                     lazy='dynamic')
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
@@ -155,19 +209,67 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = get_hasher().hash(password)
+
+    def set_password(self, password):
+        self.password = password
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        hasher = get_hasher()
+        if not self.password_hash or \
+                not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            # the hashing parameters changed, the caller commits the new hash
+            self.password = password
+        return True
+
+    def avatar(self, size):
+        return gravatar_url(email_hash(self.email), size)
 
     @property
-    def avatar_url(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+    def avatar_url(self):
+        return self.avatar(128)
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
+        """Update ``last_seen`` and return True, unless it was updated
+        less than ``LAST_SEEN_INTERVAL`` seconds ago."""
+        now = datetime.utcnow()
+        if self.last_seen and (now - self.last_seen).total_seconds() < \
+                current_app.config['LAST_SEEN_INTERVAL']:
+            return False
+        self.last_seen = now
+        return True
+
+    @staticmethod
+    def get_cached(id):
+        """Return the user with the given id, from the user cache if
+        possible."""
+        data = get_user_cache().get(('id', id))
+        if data is not None:
+            return _user_from_cache(data)
+        user = db.session.get(User, id)
+        if user is not None:
+            _cache_user(user)
+        return user
+
+    @staticmethod
+    def get_by_username(username):
+        return User._get_cached_by('username', username)
+
+    @staticmethod
+    def get_by_email(email):
+        return User._get_cached_by('email', email)
+
+    @staticmethod
+    def _get_cached_by(field, value):
+        id = get_user_cache().get((field, value))
+        if id is not None:
+            return User.get_cached(id)
+        user = db.session.scalar(db.select(User).filter_by(**{field: value}))
+        if user is not None:
+            _cache_user(user)
+        return user
 
     def follow(self, user):
         if not self.is_following(user):
@@ -181,17 +283,24 @@ class User(db.Model):
         return self.followed.filter(
             followers.c.followed_id == user.id).count() > 0
 
+    def followed_posts_where(self):
+        """Return the condition that matches the posts of
+        :meth:`followed_posts`, for statements that select columns."""
+        followed = db.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id)
+        return db.or_(Post.user_id.in_(followed), Post.user_id == self.id)
+
     def followed_posts(self):
         # followed = db.session.execute(db.select(Post).join(
         #         followers, followers.c.followed_id == Post.user_id).filter_by(
         #         followers.c.follower_id == self.id))
         followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter_by(
+            followers, (followers.c.followed_id == Post.user_id)).filter(
                 followers.c.follower_id == self.id)
         # own = db.session.execute(db.select(Post).filter_by(user_id=self.id))
         own = Post.query.filter_by(user_id=self.id)
         # return db.session.execute(db.union(followed, own).order_by(Post.timestamp.desc())).scalars()
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return followed.union(own).order_by(Post.newest_first())
 
     def generate_reset_password_token(self):
         return jwt.encode(
@@ -216,26 +325,37 @@ class User(db.Model):
 
     @staticmethod
     def verify_access_token(access_jwt_token, refresh_token=None):
+        if current_app.config['STATELESS_ACCESS_TOKENS']:
+            claims = Token.claims_from_jwt(access_jwt_token)
+            if claims:
+                user = User.get_cached(int(claims['sub']))
+                if user and user.ping():
+                    db.session.commit()
+                return user
+            return
         token = Token.from_jwt(access_jwt_token)
         if token:
-            if token.access_expiration > datetime.utc.now():
-                token.user.ping()
-                db.session.commit()
+            if token.access_expiration > datetime.utcnow():
+                if token.user.ping():
+                    db.session.commit()
                 return token.user
 
     @staticmethod
     def verify_refresh_token(refresh_token, access_jwt_token):
         token = Token.from_jwt(access_jwt_token)
         if token and token.refresh_token == refresh_token:
-            if token.refresh_expiration > datetime.utc.now():
+            if token.refresh_expiration > datetime.utcnow():
                 return token
-            
-            token.user.revoke_all()
+
+            # an expired refresh token is being reused, so it may have leaked
+            token.user.revoke_token()
             db.session.commit()
 
 
     def revoke_token(self):
         db.session.execute(db.delete(Token).where(Token.user == self))
+        if current_app.config['STATELESS_ACCESS_TOKENS']:
+            get_denylist().revoke_user(self.id, access_token_ttl())
 
 
     
@@ -245,18 +365,91 @@ class User(db.Model):
         return Message.query.filter_by(recipient=self).filter(
             Message.timestamp > last_read_time).count()
 
+    def send_message(self, recipient, body):
+        msg = Message(author=self, recipient=recipient, body=body)
+        db.session.add(msg)
+        Thread.between(self, recipient).add_message(msg)
+        recipient.increment_unread_messages()
+        return msg
+
+    def conversations(self, before=None, per_page=25):
+        """Return the user's threads, most recently active first.
+
+        Each row holds the user's ``ThreadParticipant``, the last ``Message``
+        and the other ``User``. Pass the ``last_message_id`` of the final row
+        as ``before`` to get the next page.
+        """
+        other = db.aliased(User)
+        query = db.select(ThreadParticipant, Message, other).join(
+            Message, Message.id == ThreadParticipant.last_message_id).join(
+            other, other.id == ThreadParticipant.other_user_id).where(
+            ThreadParticipant.user_id == self.id)
+        if before:
+            query = query.where(ThreadParticipant.last_message_id < before)
+        return db.session.execute(query.order_by(
+            ThreadParticipant.last_message_id.desc()).limit(per_page)).all()
+
+    def read_thread(self, thread):
+        db.session.execute(
+            db.update(ThreadParticipant).where(
+                ThreadParticipant.thread_id == thread.id,
+                ThreadParticipant.user_id == self.id)
+            .values(unread_count=0))
+
+    def increment_unread_messages(self):
+        # evaluated by the database, so concurrent senders do not race
+        self.unread_message_count = User.unread_message_count + 1
+
+    @staticmethod
+    def reconcile_unread_counts(batch_size=1000):
+        """Recompute the unread message counters from the message table."""
+        fixed = 0
+        last_id = 0
+        while True:
+            users = db.session.execute(
+                db.select(User.id, User.unread_message_count,
+                          User.last_message_read_time)
+                .where(User.id > last_id).order_by(User.id)
+                .limit(batch_size)).all()
+            if not users:
+                break
+            counts = dict(db.session.execute(
+                db.select(Message.recipient_id, db.func.count(Message.id))
+                .join(User, User.id == Message.recipient_id)
+                .where(User.id.in_([u.id for u in users]),
+                       Message.timestamp > db.func.coalesce(
+                           User.last_message_read_time, datetime(1900, 1, 1)))
+                .group_by(Message.recipient_id)).all())
+            updates = [{'user_id': u.id, 'old_count': u.unread_message_count,
+                        'new_count': counts.get(u.id, 0)} for u in users
+                       if u.unread_message_count != counts.get(u.id, 0)]
+            if updates:
+                # skip counters that changed since they were read
+                user = User.__table__
+                db.session.execute(
+                    db.update(user).where(
+                        user.c.id == db.bindparam('user_id'),
+                        user.c.unread_message_count ==
+                        db.bindparam('old_count'))
+                    .values(unread_message_count=db.bindparam('new_count')),
+                    updates)
+                _users_changed_outside_orm([u['user_id'] for u in updates])
+            db.session.commit()
+            fixed += len(updates)
+            last_id = users[-1].id
+        return fixed
+
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        Notification.upsert(self.id, name, json.dumps(data))
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue('app.tasks.' + name, self.id,
-                                                *args, **kwargs)
-        task = Task(id=rq_job.get_id(), name=name, description=description,
+        # the job is enqueued by the outbox once the task is committed
+        task = Task(id=str(uuid.uuid4()), name=name, description=description,
                     user=self)
         db.session.add(task)
+        db.session.add(OutboxEvent.create('task.enqueue', {
+            'task_id': task.id, 'name': name,
+            'args': [self.id] + list(args), 'kwargs': kwargs}))
         return task
 
     def get_tasks_in_progress(self):
@@ -296,48 +489,625 @@ class User(db.Model):
     
 
 
+# credentials are always read from the database, so that a password change
+# takes effect at once in every process
+_UNCACHED_USER_COLUMNS = {'password_hash'}
+
+
+# the user cache keeps the column values of users, and the users are rebuilt
+# from them in the current session without a query
+def _cache_user(user):
+    cache = get_user_cache()
+    data = {attr.key: getattr(user, attr.key)
+            for attr in User.__mapper__.column_attrs
+            if attr.key not in _UNCACHED_USER_COLUMNS}
+    cache.set(('id', user.id), data)
+    cache.set(('username', user.username), user.id)
+    cache.set(('email', user.email), user.id)
+
+
+def _user_from_cache(data):
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in data.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def _collect_changed_users(session, flush_context, instances):
+    # runs before the flush, because attributes set to SQL expressions lose
+    # their history during it
+    keys = session.info.setdefault('changed_user_keys', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            state = db.inspect(obj)
+            if state.identity:
+                keys.add(('id', state.identity[0]))
+            for field in ('username', 'email'):
+                history = state.attrs[field].history
+                for value in history.sum():
+                    keys.add((field, value))
+
+
+def _evict_changed_users(session):
+    keys = session.info.pop('changed_user_keys', None)
+    if keys and has_app_context():
+        evict_users(keys)
+
+
+def _forget_changed_users(session, previous_transaction):
+    session.info.pop('changed_user_keys', None)
+
+
+def _users_changed_outside_orm(ids):
+    """Have the caches forget users updated with a bulk statement once the
+    session commits."""
+    db.session.info.setdefault('changed_user_keys', set()).update(
+        ('id', id) for id in ids)
+    db.session.info.setdefault('changed_dependencies', set()).update(
+        'user:{}'.format(id) for id in ids)
+
+
+db.event.listen(db.session, 'before_flush', _collect_changed_users)
+db.event.listen(db.session, 'after_commit', _evict_changed_users)
+db.event.listen(db.session, 'after_soft_rollback', _forget_changed_users)
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return User.get_cached(int(id))
 
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(BigIntegerId, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
 
+    __table_args__ = (
+        # the posts of a user newer than a cursor are a range of this index
+        db.Index('ix_post_user_id_id', 'user_id', 'id'),
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+    @staticmethod
+    def newest_first():
+        """Return the order of the newest posts first, which is the order of
+        the primary key when the ids are time ordered."""
+        if current_app.config['SNOWFLAKE_IDS']:
+            return Post.id.desc()
+        return Post.timestamp.desc()
     
     @property
     def url(self):
         return url_for('api.posts.get', id=self.id)
 
 
+# bump the response cache dependencies of committed changes, see
+# app.cache.ResponseCache
+def _collect_user_dependencies(session, flush_context, instances):
+    names = session.info.setdefault('changed_dependencies', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            state = db.inspect(obj)
+            # both ends of a follow edge show it
+            followed = [db.inspect(user).identity
+                        for user in state.attrs.followed.history.sum()]
+            if state.identity and (
+                    followed or obj in session.deleted or
+                    session.is_modified(obj, include_collections=False)):
+                names.add('user:{}'.format(state.identity[0]))
+            # the author names and avatars are shown with the posts
+            if state.identity and (state.attrs.username.history.has_changes()
+                                   or state.attrs.email.history.has_changes()):
+                names.add('posts')
+            names.update('user:{}'.format(identity[0])
+                         for identity in followed if identity)
+
+
+def _collect_post_dependencies(session, flush_context):
+    # runs after the flush, when new posts know the id of their author
+    names = session.info.setdefault('changed_dependencies', set())
+    for obj in list(session.new) + list(session.dirty) + \
+            list(session.deleted):
+        if isinstance(obj, Post):
+            state = db.inspect(obj)
+            names.add('posts')
+            for user_id in set(state.attrs.user_id.history.sum()) | \
+                    {state.dict.get('user_id')}:
+                if user_id is not None:
+                    names.add('posts:{}'.format(user_id))
+
+
+def _bump_changed_dependencies(session):
+    names = session.info.pop('changed_dependencies', None)
+    if names and has_app_context():
+        cache = get_response_cache()
+        if cache is not None:
+            try:
+                cache.bump(names)
+            except Exception:
+                # the other processes still drop their entries when they
+                # time out
+                current_app.logger.warning('Could not bump %s',
+                                           ', '.join(sorted(names)),
+                                           exc_info=True)
+
+
+def _forget_changed_dependencies(session, previous_transaction):
+    session.info.pop('changed_dependencies', None)
+
+
+db.event.listen(db.session, 'before_flush', _collect_user_dependencies)
+db.event.listen(db.session, 'after_flush', _collect_post_dependencies)
+db.event.listen(db.session, 'after_commit', _bump_changed_dependencies)
+db.event.listen(db.session, 'after_soft_rollback',
+                _forget_changed_dependencies)
+
+
 class Message(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(BigIntegerId, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    thread_id = db.Column(db.Integer, db.ForeignKey('thread.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_message_recipient_id_timestamp', 'recipient_id',
+                 'timestamp'),
+        db.Index('ix_message_thread_id_id', 'thread_id', 'id'),
+    )
+
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
 
+db.event.listen(Post, 'before_insert', assign_id)
+db.event.listen(Message, 'before_insert', assign_id)
+
+
+class Thread(db.Model):
+    """A private conversation between two users.
+
+    ``user1_id`` is always the lower of the two user ids, so that there is
+    a single thread for each pair of users.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user1_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user2_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    messages = db.relationship('Message', backref='thread', lazy='dynamic')
+    participants = db.relationship('ThreadParticipant', backref='thread',
+                                   lazy='dynamic')
+
+    __table_args__ = (
+        db.Index('ix_thread_user1_id_user2_id', 'user1_id', 'user2_id',
+                 unique=True),
+    )
+
+    def __repr__(self):
+        return '<Thread {} {}>'.format(self.user1_id, self.user2_id)
+
+    @staticmethod
+    def between(user, other, create=True):
+        """Return the thread between two users.
+
+        A missing thread is created, unless ``create`` is false, in which
+        case None is returned.
+        """
+        user1_id, user2_id = sorted((user.id, other.id))
+        query = db.select(Thread).filter_by(user1_id=user1_id,
+                                            user2_id=user2_id)
+        thread = db.session.scalar(query)
+        if thread is None and create:
+            try:
+                with db.session.begin_nested():
+                    thread = Thread(user1_id=user1_id, user2_id=user2_id)
+                    db.session.add(thread)
+                    db.session.add_all([
+                        ThreadParticipant(thread=thread, user_id=user_id,
+                                          other_user_id=other_id)
+                        for user_id, other_id in {(user1_id, user2_id),
+                                                  (user2_id, user1_id)}])
+            except IntegrityError:
+                # another request started the same conversation
+                thread = db.session.scalar(query)
+        return thread
+
+    def add_message(self, message, unread=True):
+        """Append a message and update the participants' summaries."""
+        message.thread = self
+        db.session.flush()
+        participant = ThreadParticipant
+        unread_count = participant.unread_count
+        if unread:
+            unread_count = db.case(
+                (participant.user_id == message.recipient_id,
+                 participant.unread_count + 1),
+                else_=participant.unread_count)
+        # concurrent senders may finish out of order, so the pointer only
+        # moves forward
+        db.session.execute(
+            db.update(participant).where(participant.thread_id == self.id)
+            .values(last_message_id=db.case(
+                (db.or_(participant.last_message_id.is_(None),
+                        participant.last_message_id < message.id),
+                 message.id), else_=participant.last_message_id),
+                unread_count=unread_count)
+            .execution_options(synchronize_session='fetch'))
+
+    def messages_page(self, before=None, per_page=25):
+        """Return up to ``per_page`` messages older than message ``before``,
+        newest first."""
+        query = self.messages
+        if before:
+            query = query.filter(Message.id < before)
+        messages = query.order_by(Message.id.desc()).limit(per_page).all()
+        if len(messages) < per_page:
+            # the older messages go on in the archive
+            query = db.select(MessageArchive).where(
+                MessageArchive.thread_id == self.id)
+            before = messages[-1].id if messages else before
+            if before:
+                query = query.where(MessageArchive.id < before)
+            messages += db.session.scalars(
+                query.order_by(MessageArchive.id.desc())
+                .limit(per_page - len(messages))).all()
+        return messages
+
+    @staticmethod
+    def attach(message):
+        """Add a message sent before threads existed to its thread.
+
+        It counts as unread when the recipient has not opened the messages
+        page since it was sent. Used by :meth:`backfill` and by the
+        ``message.thread`` backfill of app/backfill.py.
+        """
+        read_time = message.recipient.last_message_read_time
+        Thread.between(message.author, message.recipient).add_message(
+            message, unread=read_time is None or message.timestamp > read_time)
+
+    @staticmethod
+    def backfill(batch_size=1000):
+        """Attach messages sent before threads existed to their threads."""
+        total = 0
+        while True:
+            messages = db.session.scalars(
+                db.select(Message).where(Message.thread_id.is_(None))
+                .order_by(Message.id).limit(batch_size)).all()
+            if not messages:
+                break
+            for message in messages:
+                Thread.attach(message)
+            db.session.commit()
+            total += len(messages)
+        return total
+
+
+class ThreadParticipant(db.Model):
+    """One user's view of a thread, listed in that user's inbox.
+
+    The last message id is copied here so that the inbox is a single
+    indexed query on ``(user_id, last_message_id)``, which also serves as
+    the pagination key.
+    """
+    thread_id = db.Column(db.Integer, db.ForeignKey('thread.id'),
+                          primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    other_user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    last_message_id = db.Column(BigIntegerId, db.ForeignKey('message.id'))
+    unread_count = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_thread_participant_user_id_last_message_id', 'user_id',
+                 'last_message_id'),
+        db.Index('ix_thread_participant_last_message_id', 'last_message_id'),
+    )
+
+
+def _archive_boundary(model, cutoff):
+    """Return the id below which the rows of ``model`` are archived.
+
+    It is the id of the first row newer than ``cutoff``, so that the ids in
+    the archive are all lower than the ids left behind. The newest row is
+    never archived, or SQLite could give its id to the next row.
+    """
+    newest = db.session.scalar(db.select(db.func.max(model.id)))
+    if newest is None:
+        return None
+    first_recent = db.session.scalar(
+        db.select(db.func.min(model.id)).where(model.timestamp >= cutoff))
+    return min(first_recent or newest, newest)
+
+
+def _move_to_archive(model, archive, cutoff, batch_size, keep=None,
+                     moved_rows=None):
+    """Move the rows of ``model`` older than ``cutoff`` to ``archive``.
+
+    Each batch is copied in a transaction and deleted from ``model`` in the
+    next one. A run that dies in between leaves copies of the batch in both
+    tables, which the next run deletes. ``keep`` returns the ids of a batch
+    that must not move, and ``moved_rows`` is told about the rows that do
+    before they are deleted.
+    """
+    boundary = _archive_boundary(model, cutoff)
+    if boundary is None:
+        return 0
+    columns = [getattr(model, column.key)
+               for column in archive.__table__.columns]
+    moved = 0
+    last_id = None
+    while True:
+        query = db.select(*columns).where(model.id < boundary)
+        if last_id is not None:
+            query = query.where(model.id > last_id)
+        rows = db.session.execute(
+            query.order_by(model.id).limit(batch_size)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        if keep is not None:
+            kept = keep([row.id for row in rows])
+            rows = [row for row in rows if row.id not in kept]
+            if not rows:
+                continue
+        ids = [row.id for row in rows]
+        copied = set(db.session.scalars(
+            db.select(archive.id).where(archive.id.in_(ids))))
+        new_rows = [row._asdict() for row in rows if row.id not in copied]
+        if new_rows:
+            db.session.execute(db.insert(archive), new_rows)
+        db.session.commit()
+        if moved_rows is not None:
+            moved_rows(rows)
+        db.session.execute(db.delete(model).where(model.id.in_(ids)))
+        db.session.commit()
+        moved += len(ids)
+    return moved
+
+
+class PostArchive(db.Model):
+    """Posts older than ARCHIVE_AFTER_DAYS, moved out of the post table.
+
+    Posts keep their ids, which are lower than those of the posts left in
+    the post table, so a listing that is newest first reads the post table
+    and then goes on here. The archive can be in a database of its own, so
+    it has no foreign keys.
+    """
+    __tablename__ = 'post_archive'
+    id = db.Column(BigIntegerId, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer)
+    language = db.Column(db.String(5))
+    author = db.relationship(
+        'User', primaryjoin='User.id == foreign(PostArchive.user_id)',
+        viewonly=True)
+
+    __table_args__ = (
+        db.Index('ix_post_archive_user_id_id', 'user_id', 'id'),
+        {'info': {'archive': True}},
+    )
+
+    def __repr__(self):
+        return '<PostArchive {}>'.format(self.body)
+
+    @staticmethod
+    def archive(max_age_days, batch_size=1000):
+        """Move posts older than ``max_age_days`` here in batches."""
+        def moved_rows(rows):
+            names = db.session.info.setdefault('changed_dependencies', set())
+            names.add('posts')
+            names.update('posts:{}'.format(row.user_id) for row in rows)
+
+        return _move_to_archive(
+            Post, PostArchive,
+            datetime.utcnow() - timedelta(days=max_age_days), batch_size,
+            moved_rows=moved_rows)
+
+
+class MessageArchive(db.Model):
+    """Private messages older than ARCHIVE_AFTER_DAYS, see
+    :class:`PostArchive`.
+
+    The last message of a thread is not archived, since the inbox shows it.
+    """
+    __tablename__ = 'message_archive'
+    id = db.Column(BigIntegerId, primary_key=True, autoincrement=False)
+    sender_id = db.Column(db.Integer)
+    recipient_id = db.Column(db.Integer)
+    thread_id = db.Column(db.Integer)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    author = db.relationship(
+        'User', primaryjoin='User.id == foreign(MessageArchive.sender_id)',
+        viewonly=True)
+    recipient = db.relationship(
+        'User', primaryjoin='User.id == foreign(MessageArchive.recipient_id)',
+        viewonly=True)
+
+    __table_args__ = (
+        db.Index('ix_message_archive_thread_id_id', 'thread_id', 'id'),
+        {'info': {'archive': True}},
+    )
+
+    def __repr__(self):
+        return '<MessageArchive {}>'.format(self.body)
+
+    @staticmethod
+    def archive(max_age_days, batch_size=1000):
+        """Move messages older than ``max_age_days`` here in batches."""
+        def last_messages(ids):
+            return set(db.session.scalars(
+                db.select(ThreadParticipant.last_message_id).where(
+                    ThreadParticipant.last_message_id.in_(ids))))
+
+        return _move_to_archive(
+            Message, MessageArchive,
+            datetime.utcnow() - timedelta(days=max_age_days), batch_size,
+            keep=last_messages)
+
+
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(128), index=True)
+    name = db.Column(db.String(128))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
 
+    __table_args__ = (
+        db.Index('ix_notification_user_id_name', 'user_id', 'name',
+                 unique=True),
+    )
+
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    @staticmethod
+    def upsert(user_id, name, payload_json):
+        """Insert or replace a user's notification with a single statement."""
+        values = {'user_id': user_id, 'name': name,
+                  'payload_json': payload_json, 'timestamp': time()}
+        dialect = db.session.get_bind(Notification.__mapper__).dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect in ('mysql', 'mariadb'):
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(Notification).values(**values)
+            db.session.execute(stmt.on_duplicate_key_update(
+                payload_json=stmt.inserted.payload_json,
+                timestamp=stmt.inserted.timestamp))
+            return
+        else:
+            db.session.execute(db.delete(Notification).filter_by(
+                user_id=user_id, name=name))
+            db.session.execute(db.insert(Notification).values(**values))
+            return
+        stmt = insert(Notification).values(**values)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['user_id', 'name'],
+            set_={'payload_json': stmt.excluded.payload_json,
+                  'timestamp': stmt.excluded.timestamp}))
+
+    @staticmethod
+    def prune(max_age_days, batch_size=1000):
+        """Remove notifications older than ``max_age_days`` in batches."""
+        cutoff = time() - max_age_days * 24 * 60 * 60
+        deleted = 0
+        while True:
+            ids = db.session.execute(
+                db.select(Notification.id).where(
+                    Notification.timestamp < cutoff)
+                .limit(batch_size)).scalars().all()
+            if not ids:
+                break
+            db.session.execute(db.delete(Notification).where(
+                Notification.id.in_(ids)))
+            db.session.commit()
+            deleted += len(ids)
+        return deleted
+
+
+class OutboxEvent(db.Model):
+    """A side effect of a transaction, delivered after it commits.
+
+    Events are written in the transaction of the change they come from, so
+    they are never lost when the process dies after the commit. See
+    app/outbox.py for their delivery. An event whose ``available_at`` is
+    None failed too many times and waits for ``flask outbox retry``, until
+    it is deleted after OUTBOX_FAILED_RETENTION_DAYS.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(64), nullable=False)
+    payload_json = db.Column(db.Text)
+    created_at = db.Column(db.Float, default=time)
+    available_at = db.Column(db.Float, index=True, default=time)
+    attempts = db.Column(db.Integer, nullable=False, default=0,
+                         server_default='0')
+    last_error = db.Column(db.String(255))
+
+    def __repr__(self):
+        return '<OutboxEvent {} {}>'.format(self.id, self.topic)
+
+    @staticmethod
+    def create(topic, payload):
+        now = time()
+        return OutboxEvent(topic=topic, payload_json=json.dumps(payload),
+                           created_at=now, available_at=now)
+
+    def get_payload(self):
+        return json.loads(self.payload_json)
+
+
+def _mark_outbox_events(session, flush_context, instances):
+    if any(isinstance(obj, OutboxEvent) for obj in session.new):
+        session.info['outbox_events'] = True
+
+
+def _wake_outbox_dispatcher(session):
+    if session.info.pop('outbox_events', None) and has_app_context():
+        from app.outbox import wake_dispatcher
+        wake_dispatcher()
+
+
+def _forget_outbox_events(session, previous_transaction):
+    session.info.pop('outbox_events', None)
+    session.info.pop('search_events', None)
+
+
+db.event.listen(db.session, 'before_flush', _mark_outbox_events)
+db.event.listen(db.session, 'after_commit', _wake_outbox_dispatcher)
+db.event.listen(db.session, 'after_soft_rollback', _forget_outbox_events)
+
+
+class ReplicaHeartbeat(db.Model):
+    """A single row that the primary rewrites every few seconds, so that
+    the lag of a replica shows in its copy, see app/replicas.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.Float, nullable=False)
+
+
+class BackfillCheckpoint(db.Model):
+    """How far a backfill of app/backfill.py went.
+
+    The rows up to ``last_id`` are done, out of the rows up to ``end_id``
+    that existed when the backfill started. A runner holds the backfill
+    until ``lease_until``, so that two runners do not do the same work.
+    """
+    name = db.Column(db.String(64), primary_key=True)
+    last_id = db.Column(BigIntegerId, nullable=False, default=0)
+    end_id = db.Column(BigIntegerId, nullable=False, default=0)
+    total_rows = db.Column(db.Integer, nullable=False, default=0)
+    rows_scanned = db.Column(db.Integer, nullable=False, default=0)
+    rows_changed = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.Float, default=time)
+    updated_at = db.Column(db.Float, default=time)
+    finished_at = db.Column(db.Float)
+    lease_until = db.Column(db.Float)
+
+    def __repr__(self):
+        return '<BackfillCheckpoint {} {}/{}>'.format(
+            self.name, self.last_id, self.end_id)
+
+    def to_dict(self):
+        return {'name': self.name, 'last_id': self.last_id,
+                'end_id': self.end_id, 'total_rows': self.total_rows,
+                'rows_scanned': self.rows_scanned,
+                'rows_changed': self.rows_changed,
+                'progress': 100 * self.rows_scanned // self.total_rows
+                if self.total_rows else 100,
+                'started_at': self.started_at,
+                'updated_at': self.updated_at,
+                'finished_at': self.finished_at}
+
 
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -346,13 +1116,117 @@ class Task(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     complete = db.Column(db.Boolean, default=False)
 
+    def _fetch_rq_job(self):
+        # rq is only needed by the few requests that look at task progress
+        from redis.exceptions import RedisError
+        from rq.job import Job
+        return get_breaker('redis').call(
+            Job.fetch, self.id, connection=current_app.redis,
+            errors=(RedisError,))
+
     def get_rq_job(self):
+        from redis.exceptions import RedisError
+        from rq.exceptions import NoSuchJobError
         try:
-            rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
-        except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
+            return self._fetch_rq_job()
+        except (CircuitOpen, RedisError, NoSuchJobError):
             return None
-        return rq_job
 
     def get_progress(self):
-        job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
\ No newline at end of file
+        """Return the progress in percent, or None when Redis cannot tell."""
+        from redis.exceptions import RedisError
+        from rq.exceptions import NoSuchJobError
+        try:
+            job = self._fetch_rq_job()
+        except NoSuchJobError:
+            # the job expired after it finished
+            return 100
+        except (CircuitOpen, RedisError):
+            return None
+        return job.meta.get('progress', 0)
+
+
+class Translation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    text_hash = db.Column(db.String(64))
+    source_language = db.Column(db.String(10))
+    dest_language = db.Column(db.String(10))
+    text = db.Column(db.Text)
+    last_used = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_translation_key', 'text_hash', 'source_language',
+                 'dest_language', unique=True),
+    )
+
+    @staticmethod
+    def hash_text(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def lookup(hashes, source_language, dest_language):
+        """Return the cached translations of the given text hashes, and the
+        ids of the entries whose LRU position is due for a refresh."""
+        if not hashes:
+            return {}, []
+        rows = db.session.execute(db.select(
+            Translation.id, Translation.text_hash, Translation.text,
+            Translation.last_used).where(
+                Translation.text_hash.in_(hashes),
+                Translation.source_language == source_language,
+                Translation.dest_language == dest_language)).all()
+        # refresh the LRU position at most once an hour per entry
+        stale = datetime.utcnow() - timedelta(hours=1)
+        return {row.text_hash: row.text for row in rows}, \
+            [row.id for row in rows if row.last_used < stale]
+
+    @staticmethod
+    def touch(connection, ids):
+        """Move entries to the most recently used end of the cache."""
+        connection.execute(db.update(Translation).where(
+            Translation.id.in_(ids)).values(last_used=datetime.utcnow()))
+
+    @staticmethod
+    def store(connection, translations, source_language, dest_language):
+        """Insert the translations of a dict of text hashes.
+
+        Entries that another request cached first are skipped rather than
+        failing the insert.
+        """
+        rows = [{'text_hash': h, 'source_language': source_language,
+                 'dest_language': dest_language, 'text': text,
+                 'last_used': datetime.utcnow()}
+                for h, text in translations.items()]
+        dialect = connection.dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect in ('mysql', 'mariadb'):
+            connection.execute(db.insert(Translation).prefix_with('IGNORE'),
+                               rows)
+            return
+        else:
+            for row in rows:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(db.insert(Translation), row)
+                except IntegrityError:
+                    pass
+            return
+        connection.execute(insert(Translation).on_conflict_do_nothing(
+            index_elements=['text_hash', 'source_language', 'dest_language']),
+            rows)
+
+    @staticmethod
+    def evict(connection, max_entries):
+        """Remove the least recently used entries above ``max_entries``."""
+        count = connection.scalar(db.select(db.func.count(Translation.id)))
+        if count <= max_entries:
+            return 0
+        ids = connection.execute(
+            db.select(Translation.id).order_by(Translation.last_used.asc())
+            .limit(count - max_entries)).scalars().all()
+        connection.execute(db.delete(Translation).where(
+            Translation.id.in_(ids)))
+        return len(ids)
@@ -0,0 +1,251 @@
+import os
+import threading
+from time import time
+from flask import current_app
+from app import db
+from app.models import OutboxEvent
+
+_handlers = {}
+
+# seconds between two deletions of old failed events
+PRUNE_INTERVAL = 60 * 60
+
+
+def handler(topic):
+    """Register a function that delivers the events of ``topic``.
+
+    Handlers get the payload of the event. Delivery is at least once, so a
+    handler can see the same event again and must not mind.
+    """
+    def decorator(f):
+        _handlers.setdefault(topic, []).append(f)
+        return f
+    return decorator
+
+
+def dispatch(batch_size=None):
+    """Deliver a batch of due events and return the numbers of delivered
+    and failed events.
+
+    Delivered events are deleted. A failed event is tried again later, with
+    exponential backoff, until it reaches OUTBOX_MAX_ATTEMPTS.
+    """
+    config = current_app.config
+    now = time()
+    events = db.session.scalars(
+        db.select(OutboxEvent).where(OutboxEvent.available_at <= now)
+        .order_by(OutboxEvent.id)
+        .limit(batch_size or config['OUTBOX_BATCH_SIZE'])
+        .with_for_update(skip_locked=True)).all()
+    delivered = []
+    failed = 0
+    for event in events:
+        try:
+            # a handler that fails leaves the session as it found it
+            with db.session.begin_nested():
+                handlers = _handlers.get(event.topic)
+                if not handlers:
+                    raise LookupError('no handler for ' + event.topic)
+                for handle in handlers:
+                    handle(event.get_payload())
+        except Exception as error:
+            current_app.logger.warning('Outbox event %d (%s) failed',
+                                       event.id, event.topic, exc_info=True)
+            failed += 1
+            event.attempts += 1
+            event.last_error = repr(error)[:255]
+            if event.attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+                event.available_at = None
+            else:
+                event.available_at = now + config['OUTBOX_RETRY_BACKOFF'] * \
+                    2 ** (event.attempts - 1)
+        else:
+            delivered.append(event.id)
+    if delivered:
+        db.session.execute(db.delete(OutboxEvent).where(
+            OutboxEvent.id.in_(delivered)))
+    db.session.commit()
+    return len(delivered), failed
+
+
+def drain(batch_size=None):
+    """Dispatch batches until no due event is left."""
+    batch_size = batch_size or current_app.config['OUTBOX_BATCH_SIZE']
+    totals = [0, 0]
+    while True:
+        delivered, failed = dispatch(batch_size)
+        totals[0] += delivered
+        totals[1] += failed
+        if delivered + failed < batch_size:
+            return tuple(totals)
+
+
+def retry_failed():
+    """Make the events that failed too many times due again."""
+    result = db.session.execute(
+        db.update(OutboxEvent).where(OutboxEvent.available_at.is_(None))
+        .values(available_at=time(), attempts=0))
+    db.session.commit()
+    return result.rowcount
+
+
+def prune_failed(max_age_days=None):
+    """Delete the events that failed too many times and are older than
+    OUTBOX_FAILED_RETENTION_DAYS, and return how many were deleted."""
+    if max_age_days is None:
+        max_age_days = current_app.config['OUTBOX_FAILED_RETENTION_DAYS']
+    result = db.session.execute(
+        db.delete(OutboxEvent).where(
+            OutboxEvent.available_at.is_(None),
+            OutboxEvent.created_at < time() - max_age_days * 24 * 60 * 60))
+    db.session.commit()
+    return result.rowcount
+
+
+def outbox_stats():
+    pending, oldest = db.session.execute(db.select(
+        db.func.count(), db.func.min(OutboxEvent.created_at)).where(
+            OutboxEvent.available_at.isnot(None))).one()
+    failed = db.session.scalar(db.select(db.func.count()).where(
+        OutboxEvent.available_at.is_(None)))
+    stats = {'pending': pending, 'failed': failed,
+             'lag': time() - oldest if oldest else 0.0}
+    dispatcher = current_app.extensions.get('outbox_dispatcher')
+    if dispatcher is not None:
+        stats.update(delivered=dispatcher.delivered,
+                     failures=dispatcher.failures)
+    return stats
+
+
+class OutboxDispatcher(object):
+    """Background thread that delivers outbox events.
+
+    It starts with the application and is woken up when a transaction of
+    this process commits events. Otherwise it looks for due events every
+    OUTBOX_POLL_INTERVAL seconds, which picks up retries and the events of
+    processes that died.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.failures = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or \
+                    self.pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='outbox-dispatcher')
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def ensure_started(self):
+        # threads do not survive a fork, so a forked worker starts its own
+        if self.pid != os.getpid():
+            self.start()
+
+    def wake(self):
+        self.start()
+        self.wakeup.set()
+
+    def run(self):
+        pruned_at = 0
+        with self.app.app_context():
+            while True:
+                self.wakeup.wait(self.app.config['OUTBOX_POLL_INTERVAL'])
+                self.wakeup.clear()
+                try:
+                    delivered, failed = drain()
+                    self.delivered += delivered
+                    self.failures += failed
+                    if time() - pruned_at > PRUNE_INTERVAL:
+                        prune_failed()
+                        pruned_at = time()
+                except Exception:
+                    self.app.logger.exception('Outbox dispatch failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+def get_dispatcher(app=None):
+    app = app or current_app._get_current_object()
+    dispatcher = app.extensions.get('outbox_dispatcher')
+    if dispatcher is None:
+        dispatcher = OutboxDispatcher(app)
+        app.extensions['outbox_dispatcher'] = dispatcher
+    return dispatcher
+
+
+def init_app(app):
+    if app.config['OUTBOX_DISPATCHER'] == 'thread':
+        dispatcher = get_dispatcher(app)
+        dispatcher.start()
+        app.before_request(dispatcher.ensure_started)
+
+
+def wake_dispatcher():
+    """Have the dispatcher thread deliver newly committed events, unless
+    the events are left to ``flask outbox run``."""
+    if current_app.config['OUTBOX_DISPATCHER'] == 'thread':
+        get_dispatcher().wake()
+
+
+def searchable_model(index):
+    from app.models import SearchableMixin
+    for mapper in db.Model.registry.mappers:
+        cls = mapper.class_
+        if issubclass(cls, SearchableMixin) and cls.__tablename__ == index:
+            return cls
+    raise LookupError('no searchable model for ' + index)
+
+
+@handler('search.index')
+def _index_document(payload):
+    from app.search import index_document, delete_document
+    if not current_app.elasticsearch:
+        return
+    model = searchable_model(payload['index'])
+    # the current state is indexed, so a late retry cannot go back in time
+    obj = db.session.get(model, payload['id'])
+    if obj is None:
+        delete_document(payload['index'], payload['id'])
+    else:
+        index_document(payload['index'], obj.id, {
+            field: getattr(obj, field) for field in obj.__searchable__})
+
+
+@handler('search.remove')
+def _remove_document(payload):
+    from app.search import delete_document
+    if current_app.elasticsearch:
+        delete_document(payload['index'], payload['id'])
+
+
+@handler('email.send')
+def _send_email(payload):
+    from app.email import send_email
+    send_email(payload['subject'], payload['sender'], payload['recipients'],
+               payload['text_body'], payload['html_body'], sync=True)
+
+
+@handler('email.password_reset')
+def _send_password_reset_email(payload):
+    from app.auth.email import deliver_password_reset_email
+    deliver_password_reset_email(payload['user_id'], payload['locale'],
+                                 payload['url_root'])
+
+
+@handler('task.enqueue')
+def _enqueue_task(payload):
+    from rq.job import Job
+    # the job may have been enqueued by an earlier delivery
+    if not Job.exists(payload['task_id'], connection=current_app.redis):
+        current_app.task_queue.enqueue(
+            'app.tasks.' + payload['name'], *payload['args'],
+            job_id=payload['task_id'], **payload['kwargs'])
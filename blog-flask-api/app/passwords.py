@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already waiting."""
+    pass
+
+
+class PasswordHasher(object):
+    """Run password hashing on a bounded pool of worker processes.
+
+    At most ``workers + queue_size`` hashes are running or waiting at any
+    time. Further callers wait up to ``queue_timeout`` seconds for a slot
+    and then get :class:`PasswordHasherBusy`, so a login burst is shed
+    instead of starving the request threads. With no workers the hashing
+    runs in the calling thread.
+    """
+
+    def __init__(self, method, workers=0, queue_size=0, queue_timeout=None):
+        self.method = method
+        # werkzeug stores a shorthand method such as 'scrypt' with its
+        # parameters filled in, so compare with the prefix it really writes
+        self.prefix = generate_password_hash('', method).split('$', 1)[0]
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(workers + queue_size) \
+            if workers else None
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                # pools do not survive a fork, each process starts its own
+                self.executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+                self.pid = os.getpid()
+            return self.executor
+
+    def _run(self, f, *args):
+        if self.slots is None:
+            return f(*args)
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise PasswordHasherBusy()
+        try:
+            return self._get_executor().submit(f, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.prefix
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def get_hasher():
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is None:
+        hasher = PasswordHasher(
+            current_app.config['PASSWORD_HASH_METHOD'],
+            workers=current_app.config['PASSWORD_HASH_WORKERS'],
+            queue_size=current_app.config['PASSWORD_HASH_QUEUE_SIZE'],
+            queue_timeout=current_app.config['PASSWORD_HASH_QUEUE_TIMEOUT'])
+        current_app.extensions['password_hasher'] = hasher
+    return hasher
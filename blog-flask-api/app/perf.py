@@ -0,0 +1,45 @@
+"""Startup timings of the application.
+
+This file is run as a script in a new interpreter by ``flask perf
+startup``, so that nothing is imported yet when the timings start. It
+prints the timings as JSON.
+"""
+import importlib
+import json
+import os
+import sys
+import time
+
+# imported by create_app, in the order it imports them
+EXTENSIONS = ['flask', 'flask_sqlalchemy', 'flask_migrate', 'flask_login',
+              'flask_mail', 'flask_bootstrap', 'flask_moment', 'flask_babel',
+              'flask_cors', 'flask_marshmallow']
+# created on first use, so not part of the startup time
+CLIENTS = ['redis', 'task_queue', 'elasticsearch']
+
+
+def measure():
+    timings = []
+
+    def timed(name, f):
+        start = time.perf_counter()
+        result = f()
+        timings.append((name, time.perf_counter() - start))
+        return result
+
+    for name in EXTENSIONS:
+        timed('import ' + name, lambda: importlib.import_module(name))
+    create_app = timed('import app', lambda: importlib.import_module(
+        'app')).create_app
+    app = timed('create_app()', create_app)
+    for name in CLIENTS:
+        timed('first use of app.' + name, lambda: getattr(app, name))
+    timed('import langdetect', lambda: importlib.import_module('langdetect'))
+    return timings
+
+
+if __name__ == '__main__':
+    # run from inside the package, whose email module would shadow the
+    # standard library one
+    sys.path[0] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    print(json.dumps(measure()))
@@ -0,0 +1,273 @@
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import time
+from flask import current_app, g, request, session, has_app_context, \
+    has_request_context
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+from app.archive import archive_engine
+from app.cache import TTLCache
+
+REPLICA_BIND_PREFIX = 'replica_'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingSession(Session):
+    """Session that sends reads of a replica-routed request to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = archive_engine(self._db, mapper) if bind is None else None
+        if engine is not None:
+            return engine
+        if bind is None and not self._flushing and _is_read(clause) and \
+                _is_default_bind(mapper):
+            key = _replica_bind_key()
+            if key is not None and key in self._db.engines:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def _is_read(clause):
+    return clause is None or getattr(clause, 'is_select', False)
+
+
+def _is_default_bind(mapper):
+    if mapper is None:
+        return True
+    table = sa.inspect(mapper).local_table
+    return table.metadata.info.get('bind_key') is None
+
+
+def _replica_bind_key():
+    if not has_app_context() or g.get('_use_primary') or \
+            not g.get('_read_replica'):
+        return None
+    if '_replica_bind' not in g:
+        # chosen at the first read, when the user of an API request is known
+        g._replica_bind = _choose_replica()
+    return g._replica_bind
+
+
+def _choose_replica():
+    user_id = g.get('_replica_user_id')
+    if user_id is not None and get_sticky_users().is_stuck(user_id):
+        return None
+    keys = get_lag_monitor().healthy_keys()
+    return random.choice(keys) if keys else None
+
+
+def replica_bind_keys(app):
+    return ['{}{}'.format(REPLICA_BIND_PREFIX, i)
+            for i in range(len(app.config['SQLALCHEMY_REPLICA_URIS']))]
+
+
+def use_primary():
+    """Send the remaining queries of this request to the primary."""
+    g._use_primary = True
+
+
+@contextmanager
+def on_primary():
+    """Send the queries of the block to the primary, for reads that must see
+    the latest writes, such as the lookups of a newly issued token."""
+    previous = g.get('_use_primary')
+    g._use_primary = True
+    try:
+        yield
+    finally:
+        g._use_primary = previous
+
+
+def identify_user(user_id):
+    """Record the user of a token authenticated request.
+
+    API clients do not keep the session cookie, so their writes make them
+    stick to the primary by user id instead.
+    """
+    g._replica_user_id = user_id
+    # a replica chosen before the user was known is chosen again
+    g.pop('_replica_bind', None)
+
+
+def route_to_replica():
+    """Send the reads of this request to a replica when it is safe to.
+
+    The replica is one that is no more than REPLICA_LAG_SECONDS behind the
+    primary, see :class:`LagMonitor`, and none is used for a client that
+    wrote in the last REPLICA_LAG_SECONDS.
+    """
+    if not current_app.config['SQLALCHEMY_REPLICA_URIS'] or \
+            request.method not in SAFE_METHODS or g.get('_use_primary'):
+        return
+    if session.get('_primary_until', 0) > time():
+        # the client wrote recently, the replicas may not have caught up yet
+        return
+    g._read_replica = True
+
+
+def read_replica(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        route_to_replica()
+        return f(*args, **kwargs)
+    return decorated
+
+
+def _record_write(db_session, flush_context):
+    if has_request_context():
+        g._db_wrote = True
+
+
+def _stick_to_primary(response):
+    if g.get('_db_wrote') and request.method not in SAFE_METHODS and \
+            current_app.config['SQLALCHEMY_REPLICA_URIS']:
+        seconds = current_app.config['REPLICA_LAG_SECONDS']
+        session['_primary_until'] = time() + seconds
+        if g.get('_replica_user_id') is not None:
+            get_sticky_users().stick(g._replica_user_id, seconds)
+    return response
+
+
+class LagMonitor(object):
+    """Keeps track of the replicas that are close enough to the primary.
+
+    The primary holds a heartbeat row with the time it was last written.
+    At most every REPLICA_LAG_CHECK_INTERVAL seconds, a process rewrites it
+    and reads the copy of each replica, and the difference between the two
+    times is the lag of the replica, give or take one interval. Replicas
+    more than REPLICA_LAG_SECONDS behind, and replicas that cannot be read,
+    are left out until they catch up.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['REPLICA_LAG_CHECK_INTERVAL']
+        self.max_lag = app.config['REPLICA_LAG_SECONDS']
+        self.lock = threading.Lock()
+        self.checked_at = 0
+        self.lags = {}
+
+    def healthy_keys(self):
+        now = time()
+        with self.lock:
+            due = now >= self.checked_at + self.interval
+            if due:
+                self.checked_at = now
+        if due:
+            # other requests keep using the previous lags in the meantime
+            self.lags = self.measure()
+        return [key for key, lag in self.lags.items()
+                if lag is not None and lag <= self.max_lag]
+
+    def measure(self):
+        from app import db
+        from app.models import ReplicaHeartbeat
+        query = sa.select(ReplicaHeartbeat.timestamp).where(
+            ReplicaHeartbeat.id == 1)
+        try:
+            with db.engine.begin() as conn:
+                beat = conn.scalar(query)
+                if beat is None or time() - beat >= self.interval:
+                    beat = time()
+                    if not conn.execute(sa.update(ReplicaHeartbeat).where(
+                            ReplicaHeartbeat.id == 1).values(
+                                timestamp=beat)).rowcount:
+                        conn.execute(sa.insert(ReplicaHeartbeat).values(
+                            id=1, timestamp=beat))
+        except Exception:
+            self.app.logger.warning('Could not write the replica heartbeat',
+                                    exc_info=True)
+            return {}
+        lags = {}
+        for key in replica_bind_keys(self.app):
+            try:
+                with db.engines[key].connect() as conn:
+                    replica_beat = conn.scalar(query)
+            except Exception:
+                self.app.logger.warning('Could not read the heartbeat of %s',
+                                        key, exc_info=True)
+                replica_beat = None
+            lags[key] = None if replica_beat is None else beat - replica_beat
+        return lags
+
+
+def get_lag_monitor():
+    monitor = current_app.extensions.get('replica_lag_monitor')
+    if monitor is None:
+        monitor = LagMonitor(current_app._get_current_object())
+        current_app.extensions['replica_lag_monitor'] = monitor
+    return monitor
+
+
+class MemoryStickyUsers(object):
+    """Users that wrote recently, known to a single process."""
+
+    def __init__(self):
+        self.users = TTLCache(maxsize=100000)
+
+    def stick(self, user_id, seconds):
+        self.users.set(user_id, True, seconds)
+
+    def is_stuck(self, user_id):
+        return self.users.get(user_id) is not None
+
+
+class RedisStickyUsers(object):
+    """Users that wrote recently, shared by all processes."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def stick(self, user_id, seconds):
+        try:
+            self.redis.set('primary-until:{}'.format(user_id), 1,
+                           px=int(seconds * 1000))
+        except Exception:
+            current_app.logger.warning('Could not stick user %s to the '
+                                       'primary', user_id, exc_info=True)
+
+    def is_stuck(self, user_id):
+        try:
+            return bool(self.redis.exists('primary-until:{}'.format(user_id)))
+        except Exception:
+            # reading from the primary is always safe
+            current_app.logger.warning('Could not check user %s', user_id,
+                                       exc_info=True)
+            return True
+
+
+def get_sticky_users():
+    sticky_users = current_app.extensions.get('replica_sticky_users')
+    if sticky_users is None:
+        if current_app.config['REPLICA_STICKY_BACKEND'] == 'redis':
+            sticky_users = RedisStickyUsers(current_app.redis)
+        else:
+            sticky_users = MemoryStickyUsers()
+        current_app.extensions['replica_sticky_users'] = sticky_users
+    return sticky_users
+
+
+def init_app(app, db):
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for key, uri in zip(replica_bind_keys(app),
+                        app.config['SQLALCHEMY_REPLICA_URIS']):
+        binds[key] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.after_request(_stick_to_primary)
+    if not db.event.contains(db.session, 'after_flush', _record_write):
+        db.event.listen(db.session, 'after_flush', _record_write)
+
+
+def drop_replica_metadatas(db):
+    """Forget the metadata that ``db.init_app`` made for the replica binds.
+
+    Replicas hold copies of the default tables and need no metadata of their
+    own. Left in place, ``db.create_all()`` of a later application without
+    replicas would look for their engines.
+    """
+    for key in list(db.metadatas):
+        if key is not None and key.startswith(REPLICA_BIND_PREFIX):
+            del db.metadatas[key]
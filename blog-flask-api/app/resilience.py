@@ -0,0 +1,127 @@
+import threading
+import time
+from flask import current_app
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """The dependency failed recently and is not called for now."""
+
+
+class CircuitBreaker(object):
+    """Stop calling a dependency that keeps failing.
+
+    After ``failure_threshold`` failures in a row the circuit opens and
+    calls fail at once with :class:`CircuitOpen`. Once ``reset_timeout``
+    seconds have passed it is half open: a single call is let through, and
+    it closes the circuit if it succeeds or opens it again if it fails.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.calls = 0
+        self.rejected = 0
+        self.total_failures = 0
+        self.times_opened = 0
+
+    def before_call(self):
+        with self.lock:
+            if self.state == OPEN and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == OPEN or (self.state == HALF_OPEN and
+                                      self.probing):
+                self.rejected += 1
+                raise CircuitOpen(self.name)
+            if self.state == HALF_OPEN:
+                self.probing = True
+            self.calls += 1
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.total_failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.times_opened += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, errors=(Exception,), **kwargs):
+        """Call ``func`` through the breaker. Exceptions in ``errors`` count
+        as failures of the dependency and are raised again."""
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except errors:
+            self.record_failure()
+            raise
+        except BaseException:
+            # not the dependency's fault, but the probe is over
+            with self.lock:
+                self.probing = False
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, func, *args, errors=(Exception,), **kwargs):
+        """Await the coroutine function ``func`` through the breaker, see
+        :meth:`call`."""
+        self.before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except errors:
+            self.record_failure()
+            raise
+        except BaseException:
+            with self.lock:
+                self.probing = False
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        with self.lock:
+            state = self.state
+            if state == OPEN and \
+                    time.monotonic() - self.opened_at >= self.reset_timeout:
+                state = HALF_OPEN
+            return {'state': state, 'failures': self.failures,
+                    'calls': self.calls, 'rejected': self.rejected,
+                    'total_failures': self.total_failures,
+                    'times_opened': self.times_opened}
+
+
+def get_breaker(name):
+    """Return the circuit breaker of the dependency ``name`` for this
+    process."""
+    breakers = current_app.extensions.setdefault('circuit_breakers', {})
+    breaker = breakers.get(name)
+    if breaker is None:
+        breaker = breakers.setdefault(name, CircuitBreaker(
+            name, current_app.config['BREAKER_FAILURE_THRESHOLD'],
+            current_app.config['BREAKER_RESET_TIMEOUT']))
+    return breaker
+
+
+def breaker_stats():
+    return {name: breaker.stats() for name, breaker in
+            current_app.extensions.get('circuit_breakers', {}).items()}
@@ -0,0 +1,65 @@
+import threading
+from time import time
+from flask import current_app
+
+
+class MemoryDenylist(object):
+    """Per-user "not before" times for one process.
+
+    A revocation only reaches the process that made it, so this backend is
+    only right for a single process, such as tests or the development
+    server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.not_before = {}
+
+    def revoke_user(self, user_id, ttl):
+        now = time()
+        with self.lock:
+            for key in [key for key, (_, expires) in self.not_before.items()
+                        if expires <= now]:
+                del self.not_before[key]
+            self.not_before[user_id] = (now, now + ttl)
+
+    def get_not_before(self, user_id):
+        entry = self.not_before.get(user_id)
+        if entry is not None and entry[1] > time():
+            return entry[0]
+
+
+class RedisDenylist(object):
+    """Denylist shared by all processes, entries expire with the tokens."""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def revoke_user(self, user_id, ttl):
+        self.redis.set('tokens-not-before:{}'.format(user_id), time(),
+                       ex=max(int(ttl), 1))
+
+    def get_not_before(self, user_id):
+        not_before = self.redis.get('tokens-not-before:{}'.format(user_id))
+        if not_before is not None:
+            return float(not_before)
+
+
+def get_denylist():
+    denylist = current_app.extensions.get('token_denylist')
+    if denylist is None:
+        if current_app.config['TOKEN_DENYLIST_BACKEND'] == 'redis':
+            denylist = RedisDenylist(current_app.redis)
+        else:
+            if current_app.config['STATELESS_ACCESS_TOKENS'] and \
+                    not (current_app.testing or current_app.debug):
+                current_app.logger.warning(
+                    'Revoked stateless access tokens stay valid in other '
+                    'processes, set TOKEN_DENYLIST_BACKEND to redis')
+            denylist = MemoryDenylist()
+        current_app.extensions['token_denylist'] = denylist
+    return denylist
+
+
+def access_token_ttl():
+    return current_app.config['ACCESS_TOKEN_EXPIRE_MINS'] * 60
@@ -0,0 +1,121 @@
+from collections import namedtuple
+from flask_sqlalchemy.pagination import SelectPagination
+from app import db
+from app.models import Post, PostArchive, Message, MessageArchive, User, \
+    email_hash, gravatar_url
+
+
+class AuthorRow(namedtuple('AuthorRow', ['id', 'username', 'email_hash'])):
+    """The author of a listed post or message, with the parts of
+    :class:`app.models.User` that the listing templates use."""
+    __slots__ = ()
+
+    def avatar(self, size):
+        return gravatar_url(self.email_hash, size)
+
+
+class PostRow(namedtuple('PostRow', ['id', 'body', 'timestamp', 'language',
+                                     'author'])):
+    """A post read for display only.
+
+    Rows are plain tuples, so they cost no identity map entry, change
+    tracking or lazy loader, and the posts of an author share one
+    :class:`AuthorRow`.
+    """
+    __slots__ = ()
+
+
+class MessageRow(namedtuple('MessageRow', ['id', 'body', 'timestamp',
+                                           'author'])):
+    """A private message read for display only, see :class:`PostRow`."""
+    __slots__ = ()
+
+
+def post_rows_select(where=None):
+    """Select the columns of :class:`PostRow` and its author."""
+    query = db.select(Post.id, Post.body, Post.timestamp, Post.language,
+                      User.id, User.username, User.email).join(
+        User, User.id == Post.user_id)
+    return query if where is None else query.where(where)
+
+
+def to_post_rows(result):
+    authors = {}
+    rows = []
+    for id, body, timestamp, language, user_id, username, email in result:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = AuthorRow(user_id, username,
+                                                  email_hash(email))
+        rows.append(PostRow(id, body, timestamp, language, author))
+    return rows
+
+
+def post_rows(where):
+    return to_post_rows(db.session.execute(post_rows_select(where)))
+
+
+def post_rows_by_id(ids):
+    """Return the posts with the given ids, in the order of ``ids``."""
+    rank = {id: i for i, id in enumerate(ids)}
+    return sorted(post_rows(Post.id.in_(ids)), key=lambda row: rank[row.id])
+
+
+def archived_post_rows(user, offset, limit):
+    """Return a page of the archived posts of ``user``, newest first.
+
+    The archive may be in another database, so the author is not joined.
+    """
+    author = AuthorRow(user.id, user.username, email_hash(user.email))
+    return [PostRow(id, body, timestamp, language, author)
+            for id, body, timestamp, language in db.session.execute(
+                db.select(PostArchive.id, PostArchive.body,
+                          PostArchive.timestamp, PostArchive.language)
+                .where(PostArchive.user_id == user.id)
+                .order_by(PostArchive.id.desc())
+                .offset(offset).limit(limit))]
+
+
+class PostRowPagination(SelectPagination):
+    """Pagination of a :func:`post_rows_select` statement into
+    :class:`PostRow` items."""
+
+    def _query_items(self):
+        select = self._query_args['select']
+        return to_post_rows(self._query_args['session'].execute(
+            select.limit(self.per_page).offset(self._query_offset)))
+
+
+def paginate_post_rows(select, page, per_page):
+    return PostRowPagination(select=select, session=db.session(), page=page,
+                             per_page=per_page, max_per_page=None,
+                             error_out=False, count=True)
+
+
+def message_rows(thread, before=None, per_page=25):
+    """Return up to ``per_page`` messages of ``thread`` older than message
+    ``before``, newest first, like :meth:`app.models.Thread.messages_page`.
+
+    The authors are the two users of the thread, so they are read once
+    rather than joined, which also works for the archive.
+    """
+    authors = {user_id: AuthorRow(user_id, username, email_hash(email))
+               for user_id, username, email in db.session.execute(
+                   db.select(User.id, User.username, User.email).where(
+                       User.id.in_([thread.user1_id, thread.user2_id])))}
+    rows = []
+    for model in (Message, MessageArchive):
+        # the older messages go on in the archive
+        query = db.select(model.id, model.body, model.timestamp,
+                          model.sender_id).where(model.thread_id == thread.id)
+        if rows:
+            before = rows[-1].id
+        if before:
+            query = query.where(model.id < before)
+        rows += [MessageRow(id, body, timestamp, authors.get(sender_id))
+                 for id, body, timestamp, sender_id in db.session.execute(
+                     query.order_by(model.id.desc())
+                     .limit(per_page - len(rows)))]
+        if len(rows) == per_page:
+            break
+    return rows
@@ -1,4 +1,29 @@
 from flask import current_app
+from app.resilience import CircuitOpen, get_breaker
+
+
+def _call(method, **kwargs):
+    """Call the Elasticsearch client through its circuit breaker.
+
+    Only connection errors and timeouts count as failures, error responses
+    such as a 404 come from a cluster that is up.
+    """
+    from elasticsearch import TransportError
+    return get_breaker('elasticsearch').call(
+        getattr(current_app.elasticsearch, method), errors=(TransportError,),
+        **kwargs)
+
+
+def index_document(index, id, payload):
+    _call('index', index=index, id=id, body=payload)
+
+
+def delete_document(index, id):
+    from elasticsearch import NotFoundError
+    try:
+        _call('delete', index=index, id=id)
+    except NotFoundError:
+        pass
 
 
 def add_to_index(index, model):
@@ -7,21 +32,39 @@ def add_to_index(index, model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    try:
+        index_document(index, model.id, payload)
+    except CircuitOpen:
+        pass
+    except Exception:
+        current_app.logger.warning('Indexing %s %s failed', index, model.id,
+                                   exc_info=True)
 
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    try:
+        delete_document(index, model.id)
+    except CircuitOpen:
+        pass
+    except Exception:
+        current_app.logger.warning('Removing %s %s from the index failed',
+                                   index, model.id, exc_info=True)
 
 
 def query_index(index, query, page, per_page):
     if not current_app.elasticsearch:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+    try:
+        search = _call(
+            'search', index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
+    except CircuitOpen:
+        return [], 0
+    except Exception:
+        current_app.logger.warning('Search failed', exc_info=True)
+        return [], 0
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    return ids, search['hits']['total']['value']
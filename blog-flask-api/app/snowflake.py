@@ -0,0 +1,164 @@
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from flask import current_app
+import sqlalchemy as sa
+
+# 2020-01-01T00:00:00Z, ids are good for 69 years after it
+EPOCH = 1577836800000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# SQLite keeps INTEGER PRIMARY KEY columns, which are 64-bit already, as
+# aliases of the rowid
+BigIntegerId = sa.BigInteger().with_variant(sa.Integer(), 'sqlite')
+
+
+class SnowflakeGenerator(object):
+    """Make 64-bit ids that sort by the time they were made.
+
+    An id is the milliseconds since :data:`EPOCH`, followed by the id of the
+    worker that made it and a sequence number for the ids of the same
+    millisecond. Workers with different ids never make the same id, so they
+    do not need to ask each other or the database.
+    """
+
+    def __init__(self, worker_id, lease=None):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError('worker id must be between 0 and {}'.format(
+                MAX_WORKER_ID))
+        self.worker_id = worker_id
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.last = 0
+        self.sequence = 0
+
+    def next_id(self):
+        if self.lease is not None and not self.lease.held():
+            raise RuntimeError('the lease of worker id {} was lost'.format(
+                self.worker_id))
+        now = int(time.time() * 1000)
+        with self.lock:
+            if now > self.last:
+                self.last = now
+                self.sequence = 0
+            else:
+                # the clock went back or this millisecond is taken already,
+                # the ids keep counting from the last one instead of waiting
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    self.last += 1
+            return (self.last - EPOCH) << (WORKER_BITS + SEQUENCE_BITS) | \
+                self.worker_id << SEQUENCE_BITS | self.sequence
+
+
+def snowflake_time(id):
+    """Return the UTC time at which the id was made."""
+    ms = (id >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).replace(
+        tzinfo=None)
+
+
+RENEW_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+
+class WorkerIdLease(object):
+    """One of the worker ids, held in Redis by this process.
+
+    The id is taken with SET NX and renewed by a background thread. If a
+    renewal fails until the lease runs out, another process may take the
+    id, so the lease is no longer held and ids are no longer made with it.
+    """
+
+    def __init__(self, redis, ttl):
+        self.redis = redis
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.renew_script = redis.register_script(RENEW_SCRIPT)
+        self.expires = 0
+        self.lost = False
+        start = random.randrange(MAX_WORKER_ID + 1)
+        for i in range(MAX_WORKER_ID + 1):
+            worker_id = (start + i) % (MAX_WORKER_ID + 1)
+            deadline = time.monotonic() + ttl
+            if redis.set(self.key(worker_id), self.token, nx=True,
+                         px=int(ttl * 1000)):
+                self.worker_id = worker_id
+                self.expires = deadline
+                break
+        else:
+            raise RuntimeError('all Snowflake worker ids are taken')
+        threading.Thread(target=self.run, daemon=True,
+                         name='snowflake-lease').start()
+
+    @staticmethod
+    def key(worker_id):
+        return 'snowflake-worker:{}'.format(worker_id)
+
+    def held(self):
+        return not self.lost and time.monotonic() < self.expires
+
+    def renew(self):
+        deadline = time.monotonic() + self.ttl
+        if self.renew_script(keys=[self.key(self.worker_id)],
+                             args=[self.token, int(self.ttl * 1000)]):
+            self.expires = deadline
+        else:
+            self.lost = True
+
+    def run(self):
+        while self.held():
+            time.sleep(self.ttl / 3)
+            try:
+                self.renew()
+            except Exception:
+                # the lease may still be renewed before it runs out
+                pass
+
+
+def check_config(app):
+    """Refuse to start when SNOWFLAKE_IDS is set without a way to give
+    each process its own worker id."""
+    if app.config['SNOWFLAKE_IDS'] and \
+            app.config['SNOWFLAKE_WORKER_ID'] is None:
+        raise RuntimeError('SNOWFLAKE_IDS needs SNOWFLAKE_WORKER_ID, set it '
+                           'to a worker id or to "redis"')
+
+
+def get_generator():
+    """Return the id generator of this process.
+
+    With SNOWFLAKE_WORKER_ID set to "redis", each process leases a worker
+    id of its own. A number is used as is, so it must be different in every
+    process that makes ids, on every host.
+    """
+    entry = current_app.extensions.get('snowflake_generator')
+    if entry is None or entry[0] != os.getpid() or \
+            (entry[1].lease is not None and not entry[1].lease.held()):
+        worker_id = current_app.config['SNOWFLAKE_WORKER_ID']
+        if worker_id == 'redis':
+            lease = WorkerIdLease(current_app.redis,
+                                  current_app.config['SNOWFLAKE_LEASE'])
+            generator = SnowflakeGenerator(lease.worker_id, lease)
+        else:
+            generator = SnowflakeGenerator(int(worker_id))
+        entry = (os.getpid(), generator)
+        current_app.extensions['snowflake_generator'] = entry
+    return entry[1]
+
+
+def assign_id(mapper, connection, target):
+    """``before_insert`` listener that gives new rows a Snowflake id when
+    SNOWFLAKE_IDS is set."""
+    if target.id is None and current_app.config['SNOWFLAKE_IDS']:
+        target.id = get_generator().next_id()
@@ -0,0 +1,67 @@
+import sqlalchemy as sa
+
+
+def is_file_database(uri):
+    url = sa.engine.make_url(uri)
+    return url.get_backend_name() == 'sqlite' and \
+        url.database not in (None, '', ':memory:')
+
+
+def engine_options(app):
+    """Pool configuration for the SQLite performance profile.
+
+    WAL lets readers proceed while a writer commits, so the pool can hand
+    out several connections at once instead of serializing every request.
+    """
+    timeout = app.config['SQLITE_BUSY_TIMEOUT'] / 1000
+    return {
+        'poolclass': sa.pool.QueuePool,
+        'pool_size': app.config['SQLITE_POOL_SIZE'],
+        'max_overflow': app.config['SQLITE_POOL_SIZE'],
+        'pool_timeout': timeout,
+        'connect_args': {'timeout': timeout, 'check_same_thread': False},
+    }
+
+
+def pragmas(app):
+    return [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA busy_timeout={}'.format(app.config['SQLITE_BUSY_TIMEOUT']),
+        'PRAGMA cache_size={}'.format(app.config['SQLITE_CACHE_SIZE']),
+        'PRAGMA mmap_size={}'.format(app.config['SQLITE_MMAP_SIZE']),
+        'PRAGMA temp_store=MEMORY',
+    ]
+
+
+def configure(app):
+    """Add the profile's pool options, before the engines are created."""
+    if not app.config['SQLITE_PERFORMANCE_PROFILE'] or \
+            not is_file_database(app.config['SQLALCHEMY_DATABASE_URI']):
+        return
+    options = engine_options(app)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def add_pragmas(app, engine):
+    """Set the profile's pragmas on every new connection of ``engine``."""
+    statements = pragmas(app)
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    sa.event.listen(engine, 'connect', set_pragmas)
+
+
+def init_app(app, db):
+    """Set the profile's pragmas on every new SQLite file connection."""
+    if not app.config['SQLITE_PERFORMANCE_PROFILE']:
+        return
+    with app.app_context():
+        for engine in db.engines.values():
+            if is_file_database(engine.url):
+                add_pragmas(app, engine)
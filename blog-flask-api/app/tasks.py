@@ -1,14 +1,44 @@
 import json
 import sys
 import time
-from flask import render_template
+from datetime import timedelta
+from functools import wraps
+from flask import current_app, has_app_context, render_template
 from rq import get_current_job
+from werkzeug.local import LocalProxy
 from app import create_app, db
-from app.models import User, Post, Task
+from app.models import User, Post, PostArchive, Task, Token, Notification, \
+    MessageArchive
 from app.email import send_email
 
-app = create_app()
-app.app_context().push()
+_app = None
+
+
+def _get_app():
+    """Return the application the job runs in.
+
+    A worker that preloads the application pushes its context before jobs
+    run, so jobs share it. Otherwise the application is created the first
+    time a job needs it rather than when this module is imported.
+    """
+    global _app
+    if has_app_context():
+        return current_app._get_current_object()
+    if _app is None:
+        _app = create_app()
+        _app.app_context().push()
+    return _app
+
+
+app = LocalProxy(_get_app)
+
+
+def task(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        _get_app()
+        return f(*args, **kwargs)
+    return wrapper
 
 
 def _set_task_progress(progress):
@@ -24,14 +54,18 @@ def _set_task_progress(progress):
         db.session.commit()
 
 
+@task
 def export_posts(user_id):
     try:
         user = User.query.get(user_id)
         _set_task_progress(0)
         data = []
         i = 0
-        total_posts = user.posts.count()
-        for post in user.posts.order_by(Post.timestamp.asc()):
+        archived = db.session.scalars(db.select(PostArchive).where(
+            PostArchive.user_id == user.id).order_by(PostArchive.id)).all()
+        total_posts = len(archived) + user.posts.count()
+        # the archived posts are the oldest ones
+        for post in archived + user.posts.order_by(Post.id).all():
             data.append({'body': post.body,
                          'timestamp': post.timestamp.isoformat() + 'Z'})
             time.sleep(5)
@@ -48,4 +82,76 @@ def export_posts(user_id):
                 sync=True)
     except:
         _set_task_progress(100)
-        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
\ No newline at end of file
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+@task
+def clean_tokens(reschedule=True):
+    try:
+        deleted = Token.clean(app.config['TOKEN_CLEANUP_BATCH_SIZE'])
+        app.logger.info('Removed %d expired tokens', deleted)
+    except:
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        if reschedule:
+            schedule_token_cleanup()
+
+
+def schedule_token_cleanup():
+    return app.task_queue.enqueue_in(
+        timedelta(minutes=app.config['TOKEN_CLEANUP_INTERVAL_MINS']),
+        'app.tasks.clean_tokens')
+
+
+@task
+def prune_notifications(reschedule=True):
+    try:
+        deleted = Notification.prune(
+            app.config['NOTIFICATION_RETENTION_DAYS'],
+            app.config['NOTIFICATION_PRUNE_BATCH_SIZE'])
+        app.logger.info('Removed %d old notifications', deleted)
+    except:
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        if reschedule:
+            schedule_notification_pruning()
+
+
+def schedule_notification_pruning():
+    return app.task_queue.enqueue_in(
+        timedelta(minutes=app.config['NOTIFICATION_PRUNE_INTERVAL_MINS']),
+        'app.tasks.prune_notifications')
+
+
+@task
+def reconcile_unread_counts():
+    try:
+        fixed = User.reconcile_unread_counts()
+        app.logger.info('Fixed %d unread message counters', fixed)
+    except:
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+
+@task
+def archive_old_rows(reschedule=True):
+    try:
+        days = app.config['ARCHIVE_AFTER_DAYS']
+        batch_size = app.config['ARCHIVE_BATCH_SIZE']
+        posts = PostArchive.archive(days, batch_size)
+        messages = MessageArchive.archive(days, batch_size)
+        app.logger.info('Archived %d posts and %d messages', posts, messages)
+    except:
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+    finally:
+        if reschedule:
+            schedule_archiving()
+
+
+def schedule_archiving():
+    return app.task_queue.enqueue_in(
+        timedelta(minutes=app.config['ARCHIVE_INTERVAL_MINS']),
+        'app.tasks.archive_old_rows')
@@ -1,21 +1,108 @@
-import json
-import requests
+import random
 from flask import current_app
 from flask_babel import _
+from sqlalchemy.exc import SQLAlchemyError
+from app import db
+from app.models import Translation
+from app.resilience import CircuitOpen, get_breaker
+
+TRANSLATOR_URL = 'https://api.cognitive.microsofttranslator.com/translate'
+# the translator accepts at most 1000 texts per request
+MAX_BATCH_SIZE = 1000
+
+
+def get_session():
+    """Return the HTTP session shared by all translator calls."""
+    session = current_app.extensions.get('translator_session')
+    if session is None:
+        # requests is slow to import and only needed once a text is
+        # translated
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(
+            pool_maxsize=current_app.config['TRANSLATOR_POOL_SIZE'],
+            max_retries=1))
+        session.headers.update({
+            'Ocp-Apim-Subscription-Key':
+                current_app.config['MS_TRANSLATOR_KEY'],
+            'Ocp-Apim-Subscription-Region': 'westus2'})
+        current_app.extensions['translator_session'] = session
+    return session
+
+
+def _call_translator(texts, source_language, dest_language):
+    translations = []
+    for i in range(0, len(texts), MAX_BATCH_SIZE):
+        r = get_session().post(
+            TRANSLATOR_URL, params={'api-version': '3.0',
+                                    'from': source_language,
+                                    'to': dest_language},
+            json=[{'Text': text} for text in texts[i:i + MAX_BATCH_SIZE]],
+            timeout=(current_app.config['TRANSLATOR_CONNECT_TIMEOUT'],
+                     current_app.config['TRANSLATOR_READ_TIMEOUT']))
+        if r.status_code >= 500:
+            # counts as a failure of the translator
+            r.raise_for_status()
+        if r.status_code != 200:
+            return None
+        translations += [t['translations'][0]['text'] for t in r.json()]
+    return translations
+
 
 # get translate text from microsoft translation
 def translate(text, source_language, dest_language):
+    return translate_many([text], source_language, dest_language)[0]
+
+
+def translate_many(texts, source_language, dest_language):
+    """Translate a list of texts with one translator call for the misses."""
     if 'MS_TRANSLATOR_KEY' not in current_app.config or \
             not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westus2'}
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+        return [_('Error: the translation service is not configured.')] * \
+            len(texts)
+    hashes = [Translation.hash_text(text) for text in texts]
+    cached, touched = Translation.lookup(set(hashes), source_language,
+                                         dest_language)
+    missing = {}
+    for h, text in zip(hashes, texts):
+        if h not in cached:
+            missing.setdefault(h, text)
+    added = {}
+    if missing:
+        from requests import RequestException
+        try:
+            translations = get_breaker('translator').call(
+                _call_translator, list(missing.values()), source_language,
+                dest_language, errors=(RequestException,))
+        except (CircuitOpen, RequestException):
+            translations = None
+        if translations is not None:
+            added = dict(zip(missing, translations))
+            cached.update(added)
+    if touched or added:
+        _update_cache(touched, added, source_language, dest_language)
+    # texts the translator could not handle are shown untranslated
+    return [cached.get(h, text) for h, text in zip(hashes, texts)]
+
+
+def _update_cache(touched, added, source_language, dest_language):
+    """Write the cache changes in a transaction of their own, so that the
+    caller's session is neither committed nor rolled back with them."""
+    try:
+        with db.engine.begin() as connection:
+            if touched:
+                Translation.touch(connection, touched)
+            if added:
+                Translation.store(connection, added, source_language,
+                                  dest_language)
+            # counting the entries costs a scan, so it is done on average
+            # once every TRANSLATION_EVICT_EVERY new entries
+            if added and random.random() < \
+                    len(added) / current_app.config['TRANSLATION_EVICT_EVERY']:
+                Translation.evict(connection,
+                                  current_app.config['TRANSLATION_CACHE_SIZE'])
+    except SQLAlchemyError:
+        # the translations are still returned, only uncached
+        current_app.logger.warning('Could not update the translation cache',
+                                   exc_info=True)
@@ -0,0 +1,148 @@
+import importlib
+import signal
+import threading
+from collections import deque
+from redis import Redis
+from rq import Queue, SimpleWorker
+from rq.timeouts import TimerDeathPenalty
+from app import db
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class JobLatency(object):
+    """Queue wait and run times of the most recent jobs, in seconds."""
+
+    def __init__(self, size=1000):
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.waits = deque(maxlen=size)
+        self.runs = deque(maxlen=size)
+
+    def record(self, job):
+        if not (job.enqueued_at and job.started_at and job.ended_at):
+            return
+        with self.lock:
+            self.jobs += 1
+            self.waits.append(
+                (job.started_at - job.enqueued_at).total_seconds())
+            self.runs.append((job.ended_at - job.started_at).total_seconds())
+
+    def summary(self):
+        with self.lock:
+            waits, runs = list(self.waits), list(self.runs)
+            jobs = self.jobs
+        return {'jobs': jobs,
+                'wait_p50': _percentile(waits, 0.5),
+                'wait_p95': _percentile(waits, 0.95),
+                'run_p50': _percentile(runs, 0.5),
+                'run_p95': _percentile(runs, 0.95)}
+
+
+class PreloadedWorker(SimpleWorker):
+    """RQ worker that runs jobs in its own process.
+
+    The stock worker forks for every job, so each job pays for the fork and
+    for building the application again. This worker runs inside the
+    application context of an application created once, so jobs reuse its
+    database and Redis connection pools.
+    """
+
+    def __init__(self, *args, app=None, latency=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.app = app
+        self.latency = latency or JobLatency()
+
+    def perform_job(self, job, queue):
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            # hand the connection back to the pool and drop any state the
+            # job left in the session
+            db.session.remove()
+            self.latency.record(job)
+            interval = self.app.config['WORKER_LATENCY_LOG_INTERVAL']
+            if interval and self.latency.jobs % interval == 0:
+                self.log_latency()
+
+    def log_latency(self):
+        summary = self.latency.summary()
+        self.app.logger.info(
+            '%d jobs, wait p50 %.3fs p95 %.3fs, run p50 %.3fs p95 %.3fs',
+            summary['jobs'], summary['wait_p50'], summary['wait_p95'],
+            summary['run_p50'], summary['run_p95'])
+
+
+class ThreadWorker(PreloadedWorker):
+    """Preloaded worker that runs in a thread next to other workers.
+
+    Signals can only be handled in the main thread, so job timeouts use a
+    timer and stopping is left to :func:`run_worker`.
+    """
+    death_penalty_class = TimerDeathPenalty
+
+    def _install_signal_handlers(self):
+        pass
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        if timeout is None:
+            return super().dequeue_job_and_maintain_ttl(None)
+        # wait in short rounds to notice a stop request
+        while not self._stop_requested:
+            result = super().dequeue_job_and_maintain_ttl(1, max_idle_time=1)
+            if result is not None:
+                return result
+
+
+def run_worker(app, queue_names, threads=1, burst=False,
+               with_scheduler=False):
+    """Preload the application and work on ``queue_names``.
+
+    With more than one thread, each thread runs its own worker and the jobs
+    share the application and its connection pools.
+    """
+    with app.app_context():
+        # job functions are imported once here instead of in every job
+        importlib.import_module('app.tasks')
+        # app.redis has a socket timeout shorter than the blocking dequeue,
+        # without one RQ sets a timeout that fits
+        connection = Redis.from_url(
+            app.config['REDIS_URL'],
+            socket_connect_timeout=app.config['REDIS_CONNECT_TIMEOUT'])
+        queues = [Queue(name, connection=connection) for name in queue_names]
+        latency = JobLatency()
+        if threads <= 1:
+            worker = PreloadedWorker(queues, connection=connection, app=app,
+                                     latency=latency)
+            worker.work(burst=burst, with_scheduler=with_scheduler)
+            worker.log_latency()
+            return latency
+
+        workers = [ThreadWorker(queues, connection=connection, app=app,
+                                latency=latency)
+                   for i in range(threads)]
+
+        def work(worker, with_scheduler):
+            with app.app_context():
+                worker.work(burst=burst, with_scheduler=with_scheduler)
+
+        def request_stop(signum, frame):
+            for worker in workers:
+                worker._stop_requested = True
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+        pool = [threading.Thread(target=work, args=(worker, with_scheduler
+                                                    and i == 0))
+                for i, worker in enumerate(workers)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        workers[0].log_latency()
+        return latency
@@ -0,0 +1,10 @@
+"""ASGI entry point, for example ``uvicorn asgi:asgi_app``.
+
+Flask views run in a pool of ASGI_THREADS threads. The async views of the
+``/api/async`` blueprint run on one event loop per process, see app/aio.py,
+so the threads only wait for them.
+"""
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from blogflask import app
+
+asgi_app = WSGIMiddleware(app, workers=app.config['ASGI_THREADS'])
@@ -0,0 +1,148 @@
+"""Throughput of the sync API under a WSGI server and of the async API
+under an ASGI server, at high concurrency.
+
+Both servers run in their own process against the same SQLite file and
+serve pages of a user's posts: the WSGI server ``/api/users/<id>/posts``
+and uvicorn ``/api/async/users/<id>/posts``, which run the same query.
+Run from the project directory:
+
+    python benchmarks/async_api.py --concurrency 200 --requests 5000
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+import aiohttp  # noqa: E402
+from app import create_app, db  # noqa: E402
+from app.models import User, Post, Token  # noqa: E402
+from config import Config  # noqa: E402
+
+PROJECT_DIR = os.path.join(os.path.dirname(__file__), '..')
+
+
+def make_config(path):
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        ELASTICSEARCH_URL = None
+    return BenchmarkConfig
+
+
+def populate(users, posts):
+    """Create the users and their posts and return an access token for
+    each user."""
+    db.create_all()
+    db.session.add_all([User(username='user{}'.format(i),
+                             email='user{}@example.com'.format(i))
+                        for i in range(users)])
+    db.session.commit()
+    db.session.add_all([Post(body='post {}'.format(i), user_id=i % users + 1)
+                        for i in range(posts)])
+    tokens = [Token(user_id=i + 1) for i in range(users)]
+    for token in tokens:
+        token.generate()
+    db.session.add_all(tokens)
+    db.session.commit()
+    return [token.access_jwt_token for token in tokens]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(command, port, env):
+    server = subprocess.Popen(command, env=env, cwd=PROJECT_DIR,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('server did not start: ' + ' '.join(command))
+
+
+async def load(url, tokens, users, concurrency, requests):
+    latencies = []
+    errors = 0
+    next_request = iter(range(requests))
+
+    async def client(http):
+        nonlocal errors
+        for i in next_request:
+            user = i % users
+            start = time.perf_counter()
+            async with http.get(
+                    url.format(id=user + 1),
+                    headers={'Authorization': 'Bearer ' + tokens[user]}) \
+                    as response:
+                await response.read()
+                if response.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*[client(http) for i in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (requests / elapsed, latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95)], errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'bench.db')
+        app = create_app(make_config(path))
+        with app.app_context():
+            tokens = populate(args.users, args.posts)
+        env = dict(os.environ, FLASK_APP='blogflask.py',
+                   DATABASE_URL='sqlite:///' + path,
+                   SQLITE_PERFORMANCE_PROFILE='1', ELASTICSEARCH_URL='')
+        servers = (
+            ('wsgi', [sys.executable, '-m', 'flask', 'run', '--no-reload',
+                      '--with-threads', '--port', '{port}'],
+             '/api/users/{id}/posts'),
+            ('asgi', [sys.executable, '-m', 'uvicorn', 'asgi:asgi_app',
+                      '--log-level', 'warning', '--port', '{port}'],
+             '/api/async/users/{id}/posts'),
+        )
+        print('{:<6} {:>12} {:>10} {:>10} {:>8}'.format(
+            'server', 'requests/s', 'p50 ms', 'p95 ms', 'errors'))
+        for name, command, path in servers:
+            port = free_port()
+            server = start_server([arg.format(port=port) for arg in command],
+                                  port, env)
+            try:
+                rate, p50, p95, errors = asyncio.run(load(
+                    'http://127.0.0.1:{}{}'.format(port, path), tokens,
+                    args.users, args.concurrency, args.requests))
+            finally:
+                server.terminate()
+                server.wait()
+            print('{:<6} {:>12.1f} {:>10.1f} {:>10.1f} {:>8}'.format(
+                name, rate, p50 * 1000, p95 * 1000, errors))
+
+
+if __name__ == '__main__':
+    main()
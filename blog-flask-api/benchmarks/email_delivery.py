@@ -0,0 +1,80 @@
+"""Delivery of a burst of emails to the local debugging SMTP server.
+
+Compares one thread and SMTP connection per message, which is how email
+used to be sent, with the queued mail worker. Run from the project
+directory:
+
+    python benchmarks/email_delivery.py --messages 500
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from flask_mail import Message  # noqa: E402
+from app import create_app, mail  # noqa: E402
+from app.debug_smtp import DebugSMTPServer  # noqa: E402
+from app.email import get_mail_worker  # noqa: E402
+from config import Config  # noqa: E402
+
+
+def make_message(i):
+    return Message('Reset your password {}'.format(i),
+                   sender='no-reply@example.com',
+                   recipients=['user{}@example.com'.format(i)],
+                   body='Click the link to reset your password.')
+
+
+def thread_per_message(app, count):
+    def send(msg):
+        with app.app_context():
+            mail.send(msg)
+
+    threads = [threading.Thread(target=send, args=(make_message(i),))
+               for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def mail_worker(app, count):
+    with app.app_context():
+        worker = get_mail_worker()
+        for i in range(count):
+            worker.submit(make_message(i))
+        worker.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    args = parser.parse_args()
+
+    print('{:<20} {:>10} {:>12} {:>12}'.format('mode', 'seconds', 'messages/s',
+                                               'connections'))
+    for name, send in (('thread per message', thread_per_message),
+                       ('mail worker', mail_worker)):
+        server = DebugSMTPServer(port=0)
+        server.start()
+
+        class BenchmarkConfig(Config):
+            MAIL_SERVER = 'localhost'
+            MAIL_PORT = server.port
+            MAIL_QUEUE_SIZE = args.messages
+
+        app = create_app(BenchmarkConfig)
+        start = time.time()
+        send(app, args.messages)
+        elapsed = time.time() - start
+        server.stop()
+        print('{:<20} {:>10.2f} {:>12.1f} {:>12}'.format(
+            name, elapsed, len(server.messages) / elapsed, server.connections))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Write throughput of task progress notifications.
+
+Calls ``_set_task_progress`` the way a running export does, with the old
+delete and insert of the notification row and with the upsert. Each update
+commits, so the numbers include the cost of the transaction. Run from the
+project directory:
+
+    python benchmarks/notification_writes.py --tasks 50 --updates 100
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from app import create_app, db  # noqa: E402
+from app.models import User, Task, Notification  # noqa: E402
+from app import tasks  # noqa: E402
+from config import Config  # noqa: E402
+
+
+class StubJob(object):
+    def __init__(self, job_id):
+        self.id = job_id
+        self.meta = {}
+
+    def get_id(self):
+        return self.id
+
+    def save_meta(self):
+        pass
+
+
+def legacy_add_notification(self, name, data):
+    self.notifications.filter_by(name=name).delete()
+    n = Notification(name=name, payload_json=json.dumps(data), user=self)
+    db.session.add(n)
+    return n
+
+
+def setup(task_count):
+    db.drop_all()
+    db.create_all()
+    users = [User(username='user{}'.format(i),
+                  email='user{}@example.com'.format(i))
+             for i in range(task_count)]
+    db.session.add_all(users)
+    db.session.flush()
+    db.session.add_all([Task(id='task{}'.format(i), name='export_posts',
+                             description='Exporting posts...', user=user)
+                        for i, user in enumerate(users)])
+    db.session.commit()
+
+
+def run(task_count, updates):
+    setup(task_count)
+    jobs = [StubJob('task{}'.format(i)) for i in range(task_count)]
+    start = time.time()
+    for progress in range(updates):
+        for job in jobs:
+            with mock.patch.object(tasks, 'get_current_job',
+                                   return_value=job):
+                tasks._set_task_progress(progress * 100 // updates)
+    elapsed = time.time() - start
+    rows = db.session.scalar(db.select(db.func.count(Notification.id)))
+    return task_count * updates / elapsed, rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=100)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+            tmpdir.name, 'benchmark.db')
+
+    # the tasks run in this application context, like in a worker that
+    # preloads the application
+    create_app(BenchmarkConfig).app_context().push()
+
+    print('{:<16} {:>12} {:>8}'.format('mode', 'updates/s', 'rows'))
+    with mock.patch.object(User, 'add_notification', legacy_add_notification):
+        rate, rows = run(args.tasks, args.updates)
+    print('{:<16} {:>12.1f} {:>8}'.format('delete + insert', rate, rows))
+    rate, rows = run(args.tasks, args.updates)
+    print('{:<16} {:>12.1f} {:>8}'.format('upsert', rate, rows))
+
+
+if __name__ == '__main__':
+    main()
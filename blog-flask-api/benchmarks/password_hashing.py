@@ -0,0 +1,67 @@
+"""Login throughput of password verification, in the request thread and
+on the hashing process pool.
+
+Request threads verify passwords concurrently, the way a login burst
+reaches ``auth.login`` and ``/api/tokens``. Run from the project directory:
+
+    python benchmarks/password_hashing.py --threads 16 --seconds 10
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from app.passwords import PasswordHasher  # noqa: E402
+from config import Config  # noqa: E402
+
+
+def run(hasher, threads, seconds):
+    pwhash = hasher.hash('correct horse battery staple')
+    hasher.verify(pwhash, 'warm up the pool')
+    logins = [0] * threads
+    deadline = time.time() + seconds
+
+    def login(i):
+        while time.time() < deadline:
+            hasher.verify(pwhash, 'correct horse battery staple')
+            logins[i] += 1
+
+    workers = [threading.Thread(target=login, args=(i,))
+               for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    hasher.shutdown()
+    return sum(logins) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--method', default=Config.PASSWORD_HASH_METHOD)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print('method: {}'.format(args.method))
+    print('{:<24} {:>10} {:>16}'.format('mode', 'logins/s',
+                                        'logins/s/core'))
+    inline = run(PasswordHasher(args.method), args.threads, args.seconds)
+    # hashlib releases the GIL, so inline hashing can use every core
+    print('{:<24} {:>10.1f} {:>16.1f}'.format('request thread', inline,
+                                              inline / os.cpu_count()))
+    pooled = run(PasswordHasher(args.method, workers=args.workers,
+                                queue_size=args.threads),
+                 args.threads, args.seconds)
+    print('{:<24} {:>10.1f} {:>16.1f}'.format(
+        'pool ({} workers)'.format(args.workers), pooled,
+        pooled / args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Cost of loading a listing page as ORM objects and as read-only rows.
+
+Loads pages of the explore listing the way the view did before, as ``Post``
+objects whose authors are loaded lazily, and as ``PostRow`` tuples from a
+single select of the needed columns. Each page reads the author name and
+avatar of every post, like ``_post.html`` does. Run from the project
+directory:
+
+    python benchmarks/row_projection.py --posts 20000 --per-page 25
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from app import create_app, db  # noqa: E402
+from app.models import User, Post  # noqa: E402
+from app.rows import post_rows_select, paginate_post_rows  # noqa: E402
+from config import Config  # noqa: E402
+
+
+def setup(post_count, user_count=200):
+    db.create_all()
+    db.session.execute(db.insert(User), [
+        {'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)}
+        for i in range(user_count)])
+    db.session.execute(db.insert(Post), [
+        {'body': 'post number {}'.format(i), 'user_id': i % user_count + 1}
+        for i in range(post_count)])
+    db.session.commit()
+
+
+def orm_page(page, per_page):
+    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
+        page=page, per_page=per_page, error_out=False)
+    return [(post.author.username, post.author.avatar(70), post.body)
+            for post in posts.items]
+
+
+def row_page(page, per_page):
+    posts = paginate_post_rows(
+        post_rows_select().order_by(Post.timestamp.desc()), page, per_page)
+    return [(post.author.username, post.author.avatar(70), post.body)
+            for post in posts.items]
+
+
+def run(load_page, pages, per_page):
+    start = time.perf_counter()
+    for page in range(1, pages + 1):
+        load_page(page, per_page)
+        db.session.remove()
+    elapsed = time.perf_counter() - start
+    # memory held by one page and its session while it is rendered
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    items = load_page(1, per_page)  # noqa: F841
+    size = sum(stat.size_diff for stat in tracemalloc.take_snapshot()
+               .compare_to(snapshot, 'filename'))
+    tracemalloc.stop()
+    db.session.remove()
+    return pages / elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--per-page', type=int, default=25)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+            tmpdir.name, 'benchmark.db')
+
+    create_app(BenchmarkConfig).app_context().push()
+    setup(args.posts)
+
+    print('{:<8} {:>10} {:>12}'.format('mode', 'pages/s', 'bytes/page'))
+    for name, load_page in (('orm', orm_page), ('rows', row_page)):
+        load_page(1, args.per_page)
+        db.session.remove()
+        rate, size = run(load_page, args.pages, args.per_page)
+        print('{:<8} {:>10.1f} {:>12}'.format(name, rate, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Concurrent read/write throughput of SQLite with and without the
+performance profile.
+
+Each worker thread simulates requests of the web application: a
+``last_seen`` update, a notification write every few requests and a page
+of the explore query. Run from the project directory:
+
+    python benchmarks/sqlite_concurrency.py --threads 16 --seconds 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from app import create_app, db  # noqa: E402
+from app.models import User, Post, Notification  # noqa: E402
+from config import Config  # noqa: E402
+
+
+def make_config(path, profile):
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        SQLITE_PERFORMANCE_PROFILE = profile
+        ELASTICSEARCH_URL = None
+    return BenchmarkConfig
+
+
+def populate(users, posts):
+    db.create_all()
+    db.session.add_all([User(username='user{}'.format(i),
+                             email='user{}@example.com'.format(i))
+                        for i in range(users)])
+    db.session.commit()
+    db.session.add_all([Post(body='post {}'.format(i), user_id=i % users + 1)
+                        for i in range(posts)])
+    db.session.commit()
+
+
+def worker(app, user_id, deadline, stats, lock):
+    done = errors = 0
+    with app.app_context():
+        while time.time() < deadline:
+            try:
+                user = db.session.get(User, user_id)
+                user.last_seen = datetime.utcnow()
+                db.session.commit()
+                if done % 5 == 0:
+                    db.session.add(Notification(name='bench', user_id=user_id,
+                                                payload_json='0'))
+                    db.session.commit()
+                Post.query.order_by(Post.timestamp.desc()).limit(25).all()
+                done += 1
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+        db.session.remove()
+    with lock:
+        stats['requests'] += done
+        stats['errors'] += errors
+
+
+def run(profile, threads, seconds):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(make_config(os.path.join(tmpdir, 'bench.db'),
+                                     profile))
+        with app.app_context():
+            populate(threads, 1000)
+        stats = {'requests': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.time() + seconds
+        workers = [threading.Thread(target=worker,
+                                    args=(app, i + 1, deadline, stats, lock))
+                   for i in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+    return stats['requests'] / seconds, stats['errors']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print('{:<10} {:>12} {:>10}'.format('profile', 'requests/s', 'errors'))
+    for name, profile in (('default', None), ('tuned', '1')):
+        rate, errors = run(profile, args.threads, args.seconds)
+        print('{:<10} {:>12.1f} {:>10}'.format(name, rate, errors))
+
+
+if __name__ == '__main__':
+    main()
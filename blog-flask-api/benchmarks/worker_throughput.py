@@ -0,0 +1,67 @@
+"""Throughput of small background jobs with the stock RQ worker and with
+the preloaded worker.
+
+Enqueues short notification pruning jobs and drains the queue with
+``rq worker --burst``, which forks and builds the application for every
+job, and then with ``flask worker run --burst``. Needs the Redis server
+from REDIS_URL. Run from the project directory:
+
+    python benchmarks/worker_throughput.py --jobs 500 --threads 4
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+from rq import Queue  # noqa: E402
+from app import create_app  # noqa: E402
+
+QUEUE = 'microblog-benchmark'
+
+
+def enqueue(app, count):
+    with app.app_context():
+        queue = Queue(QUEUE, connection=app.redis)
+        queue.empty()
+        for i in range(count):
+            queue.enqueue('app.tasks.prune_notifications', reschedule=False)
+
+
+def drain(command):
+    env = dict(os.environ, FLASK_APP='blogflask.py')
+    start = time.time()
+    subprocess.run(command, check=True, env=env, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL,
+                   cwd=os.path.join(os.path.dirname(__file__), '..'))
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    app = create_app()
+    redis_url = app.config['REDIS_URL']
+    print('{:<28} {:>10} {:>10}'.format('worker', 'seconds', 'jobs/s'))
+    for name, command in (
+            ('rq worker', ['rq', 'worker', '--burst', '--url', redis_url,
+                           QUEUE]),
+            ('preloaded', ['flask', 'worker', 'run', '--burst',
+                           '--threads', '1', QUEUE]),
+            ('preloaded, {} threads'.format(args.threads),
+             ['flask', 'worker', 'run', '--burst',
+              '--threads', str(args.threads), QUEUE])):
+        enqueue(app, args.jobs)
+        elapsed = drain(command)
+        print('{:<28} {:>10.2f} {:>10.1f}'.format(name, elapsed,
+                                                  args.jobs / elapsed))
+
+
+if __name__ == '__main__':
+    main()
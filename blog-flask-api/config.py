@@ -1,15 +1,110 @@
+import json
 import os
 from dotenv import load_dotenv
 basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.flaskenv'))
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
+        'sqlite:///' + os.path.join(basedir, 'app.db')
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',')
+        if uri]
+    REPLICA_LAG_SECONDS = int(os.environ.get('REPLICA_LAG_SECONDS') or '5')
+    REPLICA_LAG_CHECK_INTERVAL = float(
+        os.environ.get('REPLICA_LAG_CHECK_INTERVAL') or '1')
+    REPLICA_STICKY_BACKEND = os.environ.get('REPLICA_STICKY_BACKEND') or \
+        'redis'
+    SQLITE_PERFORMANCE_PROFILE = os.environ.get('SQLITE_PERFORMANCE_PROFILE')
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or '5000')
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or '-64000')
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or '268435456')
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or '10')
     DISABLE_AUTH = (os.environ.get('DISABLE_AUTH'))
     ACCESS_TOKEN_EXPIRE_MINS = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINS') or '15')
+    STATELESS_ACCESS_TOKENS = os.environ.get('STATELESS_ACCESS_TOKENS')
+    TOKEN_DENYLIST_BACKEND = os.environ.get('TOKEN_DENYLIST_BACKEND') or 'redis'
     REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS') or '7')
     REFRESH_TOKEN_IN_COOKIE = os.environ.get('REFRESH_TOKEN_IN_COOKIE')
     REFRESH_TOKEN_IN_BODY = os.environ.get('REFRESH_TOKEN_IN_BODY')
+    TOKEN_CLEANUP_INTERVAL_MINS = int(
+        os.environ.get('TOKEN_CLEANUP_INTERVAL_MINS') or '60')
+    TOKEN_CLEANUP_BATCH_SIZE = int(
+        os.environ.get('TOKEN_CLEANUP_BATCH_SIZE') or '1000')
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or '10000')
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or '60')
+    USER_CACHE_INVALIDATION = os.environ.get('USER_CACHE_INVALIDATION') or \
+        'local'
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND') or \
+        'memory'
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE') or '1000')
+    RESPONSE_CACHE_VERSIONS = os.environ.get('RESPONSE_CACHE_VERSIONS') or \
+        'redis'
+    RESPONSE_CACHE_TIMEOUT = int(
+        os.environ.get('RESPONSE_CACHE_TIMEOUT') or '300')
+    ADMISSION_BACKEND = os.environ.get('ADMISSION_BACKEND') or 'memory'
+    ADMISSION_LIMITS = json.loads(os.environ.get('ADMISSION_LIMITS') or 'null') \
+        or {
+            'main.search': {'concurrency': 4, 'rate': 20,
+                            'user_rate': 1, 'user_burst': 5},
+            'main.export_posts': {'concurrency': 2,
+                                  'user_rate': 1 / 60, 'user_burst': 1},
+            'main.translate_*': {'concurrency': 8,
+                                 'user_rate': 2, 'user_burst': 10},
+            'api.user_all_post': {'concurrency': 16,
+                                  'user_rate': 10, 'user_burst': 20},
+            'api.get_unread_message_count': {'concurrency': 16,
+                                             'user_rate': 10,
+                                             'user_burst': 20},
+            'api.feed': {'user_rate': 2, 'user_burst': 10},
+            'api.export_user': {'concurrency': 4,
+                                'user_rate': 1 / 60, 'user_burst': 3},
+            'async_api.*': {'concurrency': 32,
+                            'user_rate': 10, 'user_burst': 20},
+        }
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER') or '1')
+    ADMISSION_SLOT_TIMEOUT = int(
+        os.environ.get('ADMISSION_SLOT_TIMEOUT') or '60')
+    LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL') or '60')
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS') or '40')
+    WORKER_THREADS = int(os.environ.get('WORKER_THREADS') or '1')
+    WORKER_LATENCY_LOG_INTERVAL = int(
+        os.environ.get('WORKER_LATENCY_LOG_INTERVAL') or '100')
+    NOTIFICATION_RETENTION_DAYS = int(
+        os.environ.get('NOTIFICATION_RETENTION_DAYS') or '30')
+    NOTIFICATION_PRUNE_INTERVAL_MINS = int(
+        os.environ.get('NOTIFICATION_PRUNE_INTERVAL_MINS') or '60')
+    NOTIFICATION_PRUNE_BATCH_SIZE = int(
+        os.environ.get('NOTIFICATION_PRUNE_BATCH_SIZE') or '1000')
+    OUTBOX_DISPATCHER = os.environ.get('OUTBOX_DISPATCHER') or 'thread'
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE') or '100')
+    OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL') or '1')
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS') or '10')
+    OUTBOX_RETRY_BACKOFF = float(os.environ.get('OUTBOX_RETRY_BACKOFF') or '1')
+    OUTBOX_FAILED_RETENTION_DAYS = int(
+        os.environ.get('OUTBOX_FAILED_RETENTION_DAYS') or '7')
+    FEED_COUNT_LIMIT = int(os.environ.get('FEED_COUNT_LIMIT') or '100')
+    ARCHIVE_DATABASE_URL = os.environ.get('ARCHIVE_DATABASE_URL')
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or '365')
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or '1000')
+    ARCHIVE_INTERVAL_MINS = int(
+        os.environ.get('ARCHIVE_INTERVAL_MINS') or '1440')
+    BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE') or '1000')
+    BACKFILL_ROWS_PER_SECOND = int(
+        os.environ.get('BACKFILL_ROWS_PER_SECOND') or '5000')
+    BACKFILL_LEASE = int(os.environ.get('BACKFILL_LEASE') or '60')
+    EXPORT_YIELD_PER = int(os.environ.get('EXPORT_YIELD_PER') or '1000')
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or '65536')
+    SNOWFLAKE_IDS = os.environ.get('SNOWFLAKE_IDS')
+    SNOWFLAKE_WORKER_ID = os.environ.get('SNOWFLAKE_WORKER_ID')
+    SNOWFLAKE_LEASE = int(os.environ.get('SNOWFLAKE_LEASE') or '30')
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'pbkdf2:sha256:600000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or '2')
+    PASSWORD_HASH_QUEUE_SIZE = int(
+        os.environ.get('PASSWORD_HASH_QUEUE_SIZE') or '32')
+    PASSWORD_HASH_QUEUE_TIMEOUT = float(
+        os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT') or '2')
     RESET_TOKEN_MINS = int(os.environ.get('RESET_TOKEN_MINS') or '15')
     PASSWORD_RESET_URL = os.environ.get('PASSWORD_RESET_URL') or \
         'http://localhost:3000/reset'
@@ -21,8 +116,33 @@ class Config(object):
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or '1000')
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get('MAIL_QUEUE_TIMEOUT') or '5')
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or '50')
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or '3')
+    MAIL_RETRY_BACKOFF = float(os.environ.get('MAIL_RETRY_BACKOFF') or '1')
     DEFAULT_SENDER = ['flaskblog@example.com']
     POSTs_PER_PAGE = 25
     LANGUAGES = ['en', 'vi']
+    LANGUAGE_DETECTION_WORKERS = int(
+        os.environ.get('LANGUAGE_DETECTION_WORKERS') or '2')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or '2')
+    ELASTICSEARCH_MAX_RETRIES = int(
+        os.environ.get('ELASTICSEARCH_MAX_RETRIES') or '1')
+    MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    TRANSLATOR_CONNECT_TIMEOUT = float(
+        os.environ.get('TRANSLATOR_CONNECT_TIMEOUT') or '2')
+    TRANSLATOR_READ_TIMEOUT = float(
+        os.environ.get('TRANSLATOR_READ_TIMEOUT') or '5')
+    TRANSLATOR_POOL_SIZE = int(os.environ.get('TRANSLATOR_POOL_SIZE') or '10')
+    TRANSLATION_CACHE_SIZE = int(
+        os.environ.get('TRANSLATION_CACHE_SIZE') or '100000')
+    TRANSLATION_EVICT_EVERY = int(
+        os.environ.get('TRANSLATION_EVICT_EVERY') or '100')
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT') or '1')
+    REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT') or '2')
+    BREAKER_FAILURE_THRESHOLD = int(
+        os.environ.get('BREAKER_FAILURE_THRESHOLD') or '5')
+    BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT') or '30')
\ No newline at end of file
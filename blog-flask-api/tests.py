@@ -1,12 +1,51 @@
 from datetime import datetime, timedelta
+import json
+import jwt
+import os
+import queue
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from contextlib import contextmanager
+from unittest import mock
+from app import create_app, db, replicas
+from app.models import User, Post, Token, Translation, Notification, \
+    Thread, ThreadParticipant, Message as PrivateMessage
+from app.translate import translate, translate_many
+from app.language import detect_language, detect_post_language, \
+    backfill_languages
+from app.passwords import PasswordHasher, PasswordHasherBusy
+from app.cache import TTLCache, get_response_cache, get_user_cache, \
+    UserCacheListener, USER_CACHE_CHANNEL
+from app.debug_smtp import DebugSMTPServer
+from app.worker import JobLatency
+from app.aio import async_to_sync, get_async_engine
+from app.admission import MemoryLimiter, get_admission_control
+from app.resilience import CircuitBreaker, CircuitOpen, breaker_stats
+from app.search import query_index
+from app.models import OutboxEvent, PostArchive, MessageArchive
+from app.archive import create_archive_tables
+from app import backfill
+from app.models import BackfillCheckpoint, ReplicaHeartbeat
+from app.rows import PostRow, post_rows_select, paginate_post_rows, \
+    post_rows_by_id, message_rows
+from app.outbox import dispatch, outbox_stats, retry_failed, \
+    prune_failed, OutboxDispatcher
+from app.snowflake import SnowflakeGenerator, WorkerIdLease, \
+    snowflake_time
+from app.email import send_email, get_mail_worker
+from flask_mail import Message
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    LANGUAGE_DETECTION_WORKERS = 0
+    OUTBOX_DISPATCHER = 'external'
+    TOKEN_DENYLIST_BACKEND = 'memory'
+    RESPONSE_CACHE_VERSIONS = 'local'
+    REPLICA_STICKY_BACKEND = 'memory'
 
 class UserModelTest(unittest.TestCase):
     def setUp(self):
@@ -26,6 +65,36 @@ class UserModelTest(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash_on_login(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan')
+        u.set_password('cat')
+        self.app.extensions.pop('password_hasher')
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_no_rehash_with_shorthand_method(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+        u = User(username='susan')
+        u.set_password('cat')
+        password_hash = u.password_hash
+        self.assertTrue(password_hash.startswith('scrypt:32768:8:1$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertEqual(u.password_hash, password_hash)
+
+    def test_password_hasher_backpressure(self):
+        hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1,
+                                queue_size=0, queue_timeout=0)
+        hasher.slots.acquire()
+        self.assertRaises(PasswordHasherBusy, hasher.hash, 'cat')
+        hasher.slots.release()
+        self.assertTrue(hasher.verify(hasher.hash('cat'), 'cat'))
+        hasher.shutdown()
+
     def test_default_avatar(self):
         u = User(username='hoang', email='hoang@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/57558dbbc0155e6a43505838bb89e0ac?d=identicon&s=128'))
@@ -91,5 +160,1646 @@ class UserModelTest(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+
+class TokenModelTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_clean_in_batches(self):
+        u = User(username='susan', email='susan@example.com')
+        long_ago = datetime.utcnow() - timedelta(days=2)
+        expired = [Token(user=u, refresh_expiration=long_ago)
+                   for i in range(5)]
+        valid = Token(user=u)
+        valid.generate()
+        db.session.add_all(expired + [valid])
+        db.session.commit()
+
+        self.assertEqual(Token.clean(batch_size=2), 5)
+        self.assertEqual(db.session.scalars(db.select(Token)).all(), [valid])
+
+    def issue_token(self):
+        u = User(username='susan', email='susan@example.com')
+        token = u.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        return u, token.access_jwt_token
+
+    def test_access_token(self):
+        u, access_token = self.issue_token()
+        self.assertEqual(User.verify_access_token(access_token), u)
+        self.assertIsNone(User.verify_access_token(access_token + 'x'))
+
+    def test_stateless_access_token(self):
+        self.app.config['STATELESS_ACCESS_TOKENS'] = True
+        u, access_token = self.issue_token()
+        # verification does not need the token row
+        db.session.execute(db.delete(Token))
+        db.session.commit()
+        self.assertEqual(User.verify_access_token(access_token), u)
+
+        u.revoke_token()
+        db.session.commit()
+        self.assertIsNone(User.verify_access_token(access_token))
+
+
+class TranslationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        patcher = mock.patch('app.translate._call_translator',
+                             side_effect=lambda texts, source, dest: [
+                                 '{}:{}'.format(dest, t) for t in texts])
+        self.translator = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cached_translation(self):
+        self.assertEqual(translate('xin chao', 'vi', 'en'), 'en:xin chao')
+        self.assertEqual(translate('xin chao', 'vi', 'en'), 'en:xin chao')
+        self.assertEqual(self.translator.call_count, 1)
+        self.assertEqual(translate('xin chao', 'vi', 'fr'), 'fr:xin chao')
+        self.assertEqual(self.translator.call_count, 2)
+
+    def test_batch_only_sends_misses(self):
+        translate('a', 'vi', 'en')
+        self.assertEqual(translate_many(['a', 'b', 'c', 'b'], 'vi', 'en'),
+                         ['en:a', 'en:b', 'en:c', 'en:b'])
+        self.translator.assert_called_with(['b', 'c'], 'vi', 'en')
+
+    def test_lru_eviction(self):
+        self.app.config['TRANSLATION_CACHE_SIZE'] = 2
+        self.app.config['TRANSLATION_EVICT_EVERY'] = 1
+        translate('a', 'vi', 'en')
+        Translation.query.update(
+            {'last_used': datetime.utcnow() - timedelta(days=1)})
+        translate_many(['b', 'c'], 'vi', 'en')
+        self.assertEqual(sorted(t.text for t in Translation.query),
+                         ['en:b', 'en:c'])
+
+    def test_eviction_is_sampled(self):
+        self.app.config['TRANSLATION_CACHE_SIZE'] = 1
+        with mock.patch.object(Translation, 'evict') as evict:
+            with mock.patch('random.random', return_value=0.5):
+                translate_many(['a', 'b'], 'vi', 'en')
+                evict.assert_not_called()
+            with mock.patch('random.random', return_value=0.001):
+                translate('c', 'vi', 'en')
+                evict.assert_called_once_with(mock.ANY, 1)
+
+    def test_cache_writes_leave_caller_session_alone(self):
+        translate('a', 'vi', 'en')
+        with mock.patch.object(db.session, 'commit') as commit, \
+                mock.patch.object(db.session, 'rollback') as rollback:
+            translate('a', 'vi', 'en')
+            # another request cached 'a' between the lookup and the insert
+            with mock.patch.object(Translation, 'lookup',
+                                   return_value=({}, [])):
+                self.assertEqual(translate_many(['a', 'b'], 'vi', 'en'),
+                                 ['en:a', 'en:b'])
+        commit.assert_not_called()
+        rollback.assert_not_called()
+        self.assertEqual(sorted(t.text for t in Translation.query),
+                         ['en:a', 'en:b'])
+
+    def test_translate_batch_rejects_bad_ids(self):
+        client = self.app.test_client()
+        with mock.patch('flask_login.utils._get_user',
+                        return_value=mock.Mock(is_authenticated=True)):
+            for data in ({'ids': ['x']}, {'ids': 1}, [1],
+                         {'ids': [1], 'dest_language': ['en']}):
+                response = client.post('/translate_batch', json=data)
+                self.assertEqual(response.status_code, 400)
+
+
+class LanguageDetectionTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_detect_post_language(self):
+        p = Post(body='Hello, this is a post written in English.')
+        db.session.add(p)
+        db.session.commit()
+        detect_post_language(p)
+        db.session.refresh(p)
+        self.assertEqual(p.language, 'en')
+        self.assertEqual(detect_language('12345'), '')
+
+    def test_backfill_languages(self):
+        db.session.add_all([
+            Post(body='Hello, this is a post written in English.'),
+            Post(body='Xin chào, đây là một bài viết bằng tiếng Việt.'),
+            Post(body='Already detected', language='xx')])
+        db.session.commit()
+        self.assertEqual(backfill_languages(chunk_size=1, workers=1), 2)
+        self.assertEqual([p.language for p in Post.query.order_by(Post.id)],
+                         ['en', 'vi', 'xx'])
+
+
+class MailWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = DebugSMTPServer(port=0)
+        self.server.start()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = 'localhost'
+            MAIL_PORT = self.server.port
+            MAIL_SUPPRESS_SEND = False
+            MAIL_RETRY_BACKOFF = 0
+
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.server.stop()
+
+    def test_batch_reuses_connection(self):
+        worker = get_mail_worker()
+        for i in range(10):
+            worker.queue.put(Message('subject {}'.format(i),
+                                     sender='from@example.com',
+                                     recipients=['to@example.com'],
+                                     body='text'))
+        worker.start()
+        worker.flush()
+        self.assertEqual(len(self.server.messages), 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_rejected_message_is_skipped(self):
+        self.server.refused.add('nobody@example.com')
+        worker = get_mail_worker()
+        for recipient in ('to@example.com', 'nobody@example.com',
+                          'to@example.com'):
+            worker.queue.put(Message('subject', sender='from@example.com',
+                                     recipients=[recipient], body='text'))
+        worker.start()
+        worker.flush()
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_full_queue_drops_message(self):
+        self.app.config['MAIL_QUEUE_TIMEOUT'] = 0
+        worker = get_mail_worker()
+        worker.queue = queue.Queue(maxsize=1)
+        worker.queue.put(None)
+        with mock.patch.object(worker, 'start'):
+            self.assertFalse(worker.submit(Message(
+                'subject', sender='from@example.com',
+                recipients=['to@example.com'], body='text')))
+
+    def test_retry(self):
+        self.app.config['MAIL_RETRY_BACKOFF'] = 0.1
+        state = self.app.extensions['mail']
+        port, state.port = state.port, 1
+        threading.Timer(0.05, setattr, (state, 'port', port)).start()
+        send_email('subject', 'from@example.com', ['to@example.com'],
+                   'text', '<p>html</p>')
+        get_mail_worker().flush()
+        self.assertEqual(len(self.server.messages), 1)
+
+
+class UnreadMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def send(self, sender, recipient):
+        db.session.add(PrivateMessage(author=sender, recipient=recipient,
+                                      body='hi'))
+        recipient.increment_unread_messages()
+        db.session.commit()
+
+    def test_counter(self):
+        self.send(self.u1, self.u2)
+        self.send(self.u1, self.u2)
+        self.assertEqual(self.u2.unread_message_count, 2)
+        self.assertEqual(self.u2.new_messages(), 2)
+        self.assertEqual(self.u1.unread_message_count, 0)
+
+    def test_reconcile(self):
+        self.send(self.u1, self.u2)
+        self.u1.unread_message_count = 5
+        db.session.commit()
+        self.assertEqual(User.reconcile_unread_counts(batch_size=1), 1)
+        self.assertEqual(self.u1.unread_message_count, 0)
+        self.assertEqual(self.u2.unread_message_count, 1)
+
+    def test_api_counts(self):
+        self.send(self.u1, self.u2)
+        token = self.u2.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        response = self.app.test_client().get(
+            '/api/users/me/unread_message_count',
+            headers={'Authorization': 'Bearer ' + token.access_jwt_token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'unread_message_count': 1})
+
+    def test_api_counts_of_other_users(self):
+        self.send(self.u1, self.u2)
+        client = self.app.test_client()
+        counts = []
+        for user in (self.u2, self.u1):
+            token = user.generate_auth_token()
+            db.session.add(token)
+            db.session.commit()
+            response = client.get(
+                '/api/users/me/unread_message_count',
+                headers={'Authorization': 'Bearer ' + token.access_jwt_token})
+            counts.append(response.get_json()['unread_message_count'])
+        # the first response is cached, but not served to the second user
+        self.assertEqual(counts, [1, 0])
+
+
+class ThreadTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        self.u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.u1, self.u2, self.u3])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_conversations(self):
+        self.u1.send_message(self.u2, 'hi susan')
+        self.u3.send_message(self.u1, 'hi john')
+        self.u2.send_message(self.u1, 'hi john, from susan')
+        self.u1.send_message(self.u2, 'how are you?')
+        db.session.commit()
+        self.assertEqual(Thread.query.count(), 2)
+
+        rows = self.u1.conversations(per_page=1)
+        self.assertEqual([(m.body, u.username) for p, m, u in rows],
+                         [('how are you?', 'susan')])
+        rows = self.u1.conversations(before=rows[-1][0].last_message_id)
+        self.assertEqual([(m.body, u.username) for p, m, u in rows],
+                         [('hi john', 'mary')])
+        self.assertEqual(rows[0][0].unread_count, 1)
+
+        rows = self.u2.conversations()
+        self.assertEqual(rows[0][0].unread_count, 2)
+        self.u2.read_thread(Thread.between(self.u2, self.u1))
+        db.session.commit()
+        self.assertEqual(self.u2.conversations()[0][0].unread_count, 0)
+        self.assertEqual(self.u2.unread_message_count, 2)
+
+    def test_messages_page(self):
+        for i in range(5):
+            self.u1.send_message(self.u2, str(i))
+        db.session.commit()
+        thread = Thread.between(self.u2, self.u1)
+        page = thread.messages_page(per_page=3)
+        self.assertEqual([m.body for m in page], ['4', '3', '2'])
+        page = thread.messages_page(before=page[-1].id, per_page=3)
+        self.assertEqual([m.body for m in page], ['1', '0'])
+
+    def test_viewing_does_not_create_thread(self):
+        self.assertIsNone(Thread.between(self.u1, self.u2, create=False))
+        client = self.app.test_client()
+        with mock.patch('flask_login.utils._get_user', return_value=mock.Mock(
+                id=self.u1.id, username='john', is_authenticated=True,
+                is_anonymous=False)):
+            response = client.get('/messages/susan')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Thread.query.count(), 0)
+        self.assertEqual(ThreadParticipant.query.count(), 0)
+        self.u1.send_message(self.u2, 'hi susan')
+        db.session.commit()
+        self.assertIsNotNone(Thread.between(self.u1, self.u2, create=False))
+
+    def test_backfill(self):
+        db.session.add_all([
+            PrivateMessage(author=self.u1, recipient=self.u2, body='a'),
+            PrivateMessage(author=self.u2, recipient=self.u1, body='b'),
+            PrivateMessage(author=self.u3, recipient=self.u2, body='c')])
+        db.session.commit()
+        self.assertEqual(Thread.backfill(batch_size=2), 3)
+        self.assertEqual(Thread.query.count(), 2)
+        rows = self.u2.conversations()
+        self.assertEqual([(m.body, p.unread_count) for p, m, u in rows],
+                         [('c', 1), ('b', 1)])
+
+    def test_attach_read_message(self):
+        message = PrivateMessage(author=self.u1, recipient=self.u2, body='a',
+                                 timestamp=datetime.utcnow() - timedelta(1))
+        db.session.add(message)
+        self.u2.last_message_read_time = datetime.utcnow()
+        db.session.commit()
+        Thread.attach(message)
+        db.session.commit()
+        self.assertEqual(self.u2.conversations()[0][0].unread_count, 0)
+
+
+class UserCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def count_queries(self, f):
+        queries = []
+
+        def before_cursor_execute(*args):
+            queries.append(args[2])
+
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        try:
+            result = f()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute',
+                            before_cursor_execute)
+        db.session.remove()
+        return result, len(queries)
+
+    def test_ttl_cache(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_read_through(self):
+        user, queries = self.count_queries(
+            lambda: User.get_by_username('john').email)
+        self.assertEqual((user, queries), ('john@example.com', 1))
+        user, queries = self.count_queries(
+            lambda: User.get_by_username('john').email)
+        self.assertEqual((user, queries), ('john@example.com', 0))
+        user, queries = self.count_queries(
+            lambda: User.get_cached(1).username)
+        self.assertEqual((user, queries), ('john', 0))
+        self.assertIsNone(User.get_by_username('susan'))
+
+    def test_cached_user_can_be_updated(self):
+        User.get_by_username('john')
+        db.session.remove()
+        user = User.get_cached(1)
+        user.about_me = 'hello'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(db.session.get(User, 1).about_me, 'hello')
+
+    def test_invalidation(self):
+        user = User.get_by_username('john')
+        user.username = 'johnny'
+        db.session.commit()
+        self.assertIsNone(User.get_by_username('john'))
+        self.assertEqual(User.get_cached(1).username, 'johnny')
+
+        user = User.get_cached(1)
+        user.email = 'other@example.com'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(User.get_by_email('john@example.com').id, 1)
+
+    def test_password_is_read_from_database(self):
+        user = User.get_cached(1)
+        user.set_password('cat')
+        db.session.commit()
+        db.session.remove()
+        User.get_cached(1)
+        db.session.remove()
+        # as if another process changed the password
+        db.session.execute(db.update(User).values(
+            password_hash=User(password='dog').password_hash))
+        db.session.commit()
+        db.session.remove()
+        self.assertNotIn('password_hash', get_user_cache().get(('id', 1)))
+        self.assertFalse(User.get_cached(1).check_password('cat'))
+        self.assertTrue(User.get_cached(1).check_password('dog'))
+
+    def test_evictions_are_published(self):
+        self.app.config['USER_CACHE_INVALIDATION'] = 'redis'
+        redis = mock.Mock()
+        redis.pubsub.return_value.get_message.side_effect = [
+            {'type': 'subscribe', 'data': 1},
+            {'type': 'message', 'data': json.dumps([['id', 1]])},
+            StopIteration]
+        self.app.redis = redis
+        cache = TTLCache()
+        cache.set(('id', 1), {})
+        cache.set(('id', 2), {})
+        listener = UserCacheListener(self.app, cache)
+        self.assertRaises(StopIteration, listener.listen)
+        self.assertIsNone(cache.get(('id', 1)))
+        self.assertIsNone(cache.get(('id', 2)))
+
+        # keep the application from starting its own listener
+        listener.pid = os.getpid()
+        self.app.extensions['user_cache_listener'] = listener
+        user = User.get_by_username('john')
+        user.username = 'johnny'
+        db.session.commit()
+        channel, data = redis.publish.call_args[0]
+        self.assertEqual(channel, USER_CACHE_CHANNEL)
+        self.assertIn(['username', 'john'], json.loads(data))
+
+    def test_ping(self):
+        user = User.get_cached(1)
+        user.last_seen = datetime.utcnow()
+        self.assertFalse(user.ping())
+        user.last_seen -= timedelta(minutes=2)
+        self.assertTrue(user.ping())
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+        token = self.u2.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + token.access_jwt_token}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_counts(self):
+        response = self.app.test_client().get(
+            '/api/users/me/unread_message_count',
+            headers=self.headers)
+        return (response.headers['X-Cache'],
+                response.get_json()['unread_message_count'])
+
+    def test_hit_and_invalidation(self):
+        self.assertEqual(self.get_counts(), ('MISS', 0))
+        self.assertEqual(self.get_counts(), ('HIT', 0))
+        self.u1.send_message(self.u2, 'hi')
+        db.session.commit()
+        self.assertEqual(self.get_counts(), ('MISS', 1))
+        stats = get_response_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_versions_in_redis(self):
+        self.app.config['RESPONSE_CACHE_VERSIONS'] = 'redis'
+        redis = self.app.redis = mock.Mock()
+        redis.mget.return_value = [b'4']
+        self.assertEqual(self.get_counts(), ('MISS', 0))
+        self.assertEqual(self.get_counts(), ('HIT', 0))
+        # another process wrote to the user
+        redis.mget.return_value = [b'5']
+        self.assertEqual(self.get_counts(), ('MISS', 0))
+        # and without redis the view still works, uncached
+        redis.mget.side_effect = ConnectionError
+        response = self.app.test_client().get(
+            '/api/users/me/unread_message_count',
+            headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Cache', response.headers)
+
+    def test_dependencies(self):
+        cache = get_response_cache()
+        with mock.patch.object(cache, 'bump') as bump:
+            self.u1.follow(self.u2)
+            db.session.commit()
+        self.assertEqual(bump.call_args[0][0],
+                         {'user:{}'.format(self.u1.id),
+                          'user:{}'.format(self.u2.id)})
+        with mock.patch.object(cache, 'bump') as bump:
+            db.session.add(Post(body='hello', author=self.u2))
+            db.session.commit()
+        self.assertEqual(bump.call_args[0][0],
+                         {'posts', 'posts:{}'.format(self.u2.id)})
+        with mock.patch.object(cache, 'bump') as bump:
+            self.u2.about_me = 'hi'
+            db.session.rollback()
+            db.session.commit()
+        bump.assert_not_called()
+        with mock.patch.object(cache, 'bump') as bump:
+            self.u2.about_me = 'hi'
+            db.session.commit()
+        self.assertEqual(bump.call_args[0][0], {'user:{}'.format(self.u2.id)})
+        with mock.patch.object(cache, 'bump') as bump:
+            self.u2.username = 'sue'
+            db.session.commit()
+        self.assertEqual(bump.call_args[0][0],
+                         {'posts', 'user:{}'.format(self.u2.id)})
+
+
+class NotificationTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u = User(username='john', email='john@example.com')
+        db.session.add(self.u)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_upsert(self):
+        self.u.add_notification('task_progress', {'progress': 10})
+        self.u.add_notification('task_progress', {'progress': 50})
+        self.u.add_notification('unread_message_count', 1)
+        db.session.commit()
+        self.assertEqual(self.u.notifications.count(), 2)
+        n = self.u.notifications.filter_by(name='task_progress').first()
+        self.assertEqual(n.get_data(), {'progress': 50})
+
+    def test_prune(self):
+        self.u.add_notification('old', 1)
+        self.u.add_notification('new', 2)
+        db.session.commit()
+        old = self.u.notifications.filter_by(name='old').first()
+        old.timestamp -= 31 * 24 * 60 * 60
+        db.session.commit()
+        self.assertEqual(Notification.prune(30, batch_size=1), 1)
+        self.assertEqual([n.name for n in self.u.notifications], ['new'])
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        primary = os.path.join(self.tmpdir.name, 'primary.db')
+        replica = os.path.join(self.tmpdir.name, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + replica]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.metadata.create_all(db.engines['replica_0'])
+        # the replica holds a lagging copy of the user table
+        db.session.add(User(username='primary', email='p@example.com'))
+        db.session.commit()
+        with db.engines['replica_0'].begin() as conn:
+            conn.execute(db.insert(User).values(
+                username='replica', email='r@example.com'))
+        self.set_replica_heartbeat(time.time())
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.metadata.drop_all(db.engines['replica_0'])
+        for engine in db.engines.values():
+            engine.dispose()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def set_replica_heartbeat(self, timestamp):
+        with db.engines['replica_0'].begin() as conn:
+            conn.execute(db.delete(ReplicaHeartbeat))
+            conn.execute(db.insert(ReplicaHeartbeat).values(
+                id=1, timestamp=timestamp))
+
+    @contextmanager
+    def request(self, *args, **kwargs):
+        # g belongs to the application context, which a test request shares
+        # with the test unless it has its own
+        with self.app.app_context(), \
+                self.app.test_request_context(*args, **kwargs):
+            yield
+
+    def usernames(self):
+        return [u.username for u in User.query.all()]
+
+    def test_reads_without_routing_use_primary(self):
+        with self.app.test_request_context('/explore'):
+            self.assertEqual(self.usernames(), ['primary'])
+
+    def test_get_request_reads_from_replica(self):
+        with self.app.test_request_context('/explore'):
+            replicas.route_to_replica()
+            self.assertEqual(self.usernames(), ['replica'])
+
+    def test_writes_go_to_primary(self):
+        with self.app.test_request_context('/explore'):
+            replicas.route_to_replica()
+            db.session.add(User(username='new', email='n@example.com'))
+            db.session.commit()
+        with db.engine.connect() as conn:
+            usernames = conn.execute(
+                db.select(User.username).order_by(User.id)).scalars().all()
+        self.assertEqual(usernames, ['primary', 'new'])
+
+    def test_use_primary_override(self):
+        with self.app.test_request_context('/explore'):
+            replicas.route_to_replica()
+            replicas.use_primary()
+            self.assertEqual(self.usernames(), ['primary'])
+
+    def test_post_requests_are_not_routed(self):
+        with self.app.test_request_context('/index', method='POST'):
+            replicas.route_to_replica()
+            self.assertEqual(self.usernames(), ['primary'])
+
+    def test_recent_write_sticks_to_primary(self):
+        with self.app.test_request_context('/index', method='POST'):
+            db.session.add(User(username='new', email='n@example.com'))
+            db.session.commit()
+            from flask import session
+            self.app.process_response(self.app.response_class())
+            primary_until = session['_primary_until']
+        with self.app.test_request_context('/index'):
+            from flask import session
+            session['_primary_until'] = primary_until
+            replicas.route_to_replica()
+            self.assertEqual(self.usernames(), ['primary', 'new'])
+
+    def test_token_write_sticks_to_primary(self):
+        with self.request('/api/posts', method='POST'):
+            replicas.identify_user(1)
+            db.session.add(User(username='new', email='n@example.com'))
+            db.session.commit()
+            self.app.process_response(self.app.response_class())
+        # an API client sends no session cookie
+        with self.request('/api/users'):
+            replicas.route_to_replica()
+            replicas.identify_user(1)
+            self.assertEqual(self.usernames(), ['primary', 'new'])
+        with self.request('/api/users'):
+            replicas.route_to_replica()
+            replicas.identify_user(2)
+            self.assertEqual(self.usernames(), ['replica'])
+
+    def test_lagging_replica_is_not_used(self):
+        self.app.config['REPLICA_LAG_CHECK_INTERVAL'] = 0
+        self.set_replica_heartbeat(time.time() - 60)
+        with self.request('/explore'):
+            replicas.route_to_replica()
+            self.assertEqual(self.usernames(), ['primary'])
+        with db.engine.connect() as conn:
+            beat = conn.scalar(db.select(ReplicaHeartbeat.timestamp))
+        # the replica caught up with the heartbeat of the primary
+        self.set_replica_heartbeat(beat)
+        with self.request('/explore'):
+            replicas.route_to_replica()
+            self.assertEqual(self.usernames(), ['replica'])
+
+    def test_later_apps_do_not_see_replica_binds(self):
+        self.assertNotIn('replica_0', db.metadatas)
+        with create_app(TestConfig).app_context():
+            db.create_all()
+            db.drop_all()
+
+    def test_token_is_checked_on_primary(self):
+        token = db.session.get(User, 1).generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        with db.engines['replica_0'].begin() as conn:
+            conn.execute(db.update(User).values(unread_message_count=3))
+        response = self.app.test_client().get(
+            '/api/users/me/unread_message_count', headers={
+                'Authorization': 'Bearer ' + token.access_jwt_token})
+        self.assertEqual(response.status_code, 200)
+        # the rest of the request still reads from the replica
+        self.assertEqual(response.get_json(), {'unread_message_count': 3})
+
+
+class SQLiteProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        class ProfileConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir.name, 'app.db')
+            SQLITE_PERFORMANCE_PROFILE = '1'
+
+        self.app = create_app(ProfileConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.engine.dispose()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def test_pragmas(self):
+        with db.engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(
+                conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(
+                conn.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+
+    def test_pool(self):
+        self.assertEqual(db.engine.pool.size(), 10)
+
+
+class LazyClientTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+
+    def test_created_on_first_use(self):
+        self.assertNotIn('client.redis', self.app.extensions)
+        redis = self.app.redis
+        self.assertIs(self.app.redis, redis)
+        self.assertIs(self.app.task_queue.connection, redis)
+
+    def test_recreated_after_fork(self):
+        redis = self.app.redis
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(self.app.redis, redis)
+
+    def test_replace(self):
+        client = object()
+        self.app.elasticsearch = client
+        self.assertIs(self.app.elasticsearch, client)
+
+    def test_tasks_use_current_app(self):
+        from app import tasks
+        with self.app.app_context():
+            self.assertIs(tasks.app._get_current_object(), self.app)
+        self.assertIsNone(tasks._app)
+
+
+class JobLatencyTest(unittest.TestCase):
+    def test_summary(self):
+        latency = JobLatency(size=10)
+        start = datetime(2023, 1, 1)
+        for i in range(20):
+            latency.record(mock.Mock(
+                enqueued_at=start, started_at=start + timedelta(seconds=i),
+                ended_at=start + timedelta(seconds=i + 1)))
+        latency.record(mock.Mock(enqueued_at=start, started_at=None,
+                                 ended_at=None))
+        summary = latency.summary()
+        self.assertEqual(summary['jobs'], 20)
+        self.assertEqual(summary['wait_p50'], 15)
+        self.assertEqual(summary['wait_p95'], 19)
+        self.assertEqual(summary['run_p95'], 1)
+
+
+class AsyncAPITest(unittest.TestCase):
+    def setUp(self):
+        # an in-memory database is not shared with the async engine
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        class AsyncConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir.name, 'app.db')
+
+        self.app = create_app(AsyncConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        self.u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.u1, self.u2, self.u3])
+        self.u1.follow(self.u2)
+        db.session.add_all([Post(body='post {}'.format(i),
+                                 author=(self.u1, self.u2, self.u3)[i % 3])
+                            for i in range(9)])
+        token = self.u1.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + token.access_jwt_token}
+
+    def tearDown(self):
+        async_to_sync(get_async_engine().dispose)()
+        db.session.remove()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def get(self, url):
+        return self.app.test_client().get(url, headers=self.headers)
+
+    def test_feed_pages(self):
+        response = self.get('/api/async/feed?limit=4')
+        self.assertEqual(response.status_code, 200)
+        page = response.get_json()
+        self.assertEqual([post['body'] for post in page['data']],
+                         ['post 7', 'post 6', 'post 4', 'post 3'])
+        response = self.get('/api/async/feed?limit=4&after={}'.format(
+            page['pagination']['after']))
+        page = response.get_json()
+        self.assertEqual([post['body'] for post in page['data']],
+                         ['post 1', 'post 0'])
+        self.assertIsNone(page['pagination']['after'])
+
+    def test_same_as_sync_api(self):
+        url = '/api/users/{}/posts?limit=2'.format(self.u2.id)
+        self.assertEqual(self.get(url).get_json(),
+                         self.get(url.replace('/api', '/api/async')).get_json())
+        self.assertEqual(self.get('/api/async/users/99/posts').status_code,
+                         404)
+        user = self.get('/api/async/users/{}'.format(self.u2.id)).get_json()
+        self.assertEqual((user['post_count'], user['follower_count']), (3, 1))
+
+    def test_notifications(self):
+        self.u1.add_notification('unread_message_count', 3)
+        db.session.commit()
+        response = self.get('/api/async/notifications')
+        self.assertEqual([(n['name'], n['data']) for n in response.get_json()],
+                         [('unread_message_count', 3)])
+
+    def test_views_share_event_loop(self):
+        import asyncio
+
+        async def wait():
+            await asyncio.sleep(0.2)
+            return asyncio.get_running_loop()
+
+        loops = []
+        threads = [threading.Thread(
+            target=lambda: loops.append(async_to_sync(wait)()))
+            for i in range(5)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(len(set(loops)), 1)
+
+
+class AdmissionControlTest(unittest.TestCase):
+    def setUp(self):
+        class AdmissionConfig(TestConfig):
+            ADMISSION_LIMITS = {
+                'api.get_unread_message_count': {'concurrency': 1,
+                                                  'user_rate': 1,
+                                                  'user_burst': 2},
+                'main.index': {'user_rate': 1, 'user_burst': 1}}
+
+        self.app = create_app(AdmissionConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + token.access_jwt_token}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_counts(self, headers=None):
+        return self.app.test_client().get(
+            '/api/users/me/unread_message_count',
+            headers=headers or self.headers)
+
+    def test_token_bucket(self):
+        limiter = MemoryLimiter()
+        self.assertEqual([limiter.take('k', 10, 2) for i in range(2)], [0, 0])
+        self.assertAlmostEqual(limiter.take('k', 10, 2), 0.1, places=2)
+        time.sleep(0.11)
+        self.assertEqual(limiter.take('k', 10, 2), 0)
+
+    def test_rate_limit_per_client(self):
+        self.assertEqual(self.get_counts().status_code, 200)
+        self.assertEqual(self.get_counts().status_code, 200)
+        response = self.get_counts()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        # another client has a bucket of its own
+        response = self.get_counts({'Authorization': 'Bearer other'})
+        self.assertEqual(response.status_code, 401)
+        # but not another token of the same user
+        token = db.session.get(User, 1).generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        response = self.get_counts(
+            {'Authorization': 'Bearer ' + token.access_jwt_token})
+        self.assertEqual(response.status_code, 429)
+
+    def test_web_client_cannot_pick_its_bucket(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/index').status_code, 302)
+        response = client.get('/index', headers={'Authorization': 'x1'})
+        self.assertEqual(response.status_code, 429)
+
+    def test_concurrency_limit(self):
+        admission = get_admission_control()
+        slot = admission.limiter.acquire('api.get_unread_message_count', 1)
+        response = self.get_counts()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        admission.release('api.get_unread_message_count', slot)
+        self.assertEqual(self.get_counts().status_code, 200)
+        self.assertEqual(admission.stats()['api.get_unread_message_count'],
+                         {'in_flight': 0, 'rejected': 1})
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['BREAKER_FAILURE_THRESHOLD'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_states(self):
+        breaker = CircuitBreaker('test', failure_threshold=2,
+                                 reset_timeout=0.05)
+
+        def fail():
+            raise OSError()
+
+        for i in range(2):
+            self.assertRaises(OSError, breaker.call, fail)
+        self.assertEqual(breaker.stats()['state'], 'open')
+        self.assertRaises(CircuitOpen, breaker.call, lambda: 1)
+        time.sleep(0.06)
+        self.assertEqual(breaker.stats()['state'], 'half_open')
+        self.assertRaises(OSError, breaker.call, fail)
+        self.assertEqual(breaker.stats()['state'], 'open')
+        time.sleep(0.06)
+        self.assertEqual(breaker.call(lambda: 1), 1)
+        self.assertEqual(breaker.stats()['state'], 'closed')
+        self.assertEqual(breaker.stats()['times_opened'], 2)
+
+    def test_search_fallback(self):
+        from elasticsearch import ConnectionError
+        es = mock.Mock()
+        es.search.side_effect = ConnectionError('down')
+        self.app.elasticsearch = es
+        for i in range(3):
+            self.assertEqual(query_index('post', 'hello', 1, 10), ([], 0))
+        self.assertEqual(es.search.call_count, 2)
+        self.assertEqual(breaker_stats()['elasticsearch']['state'], 'open')
+
+    def test_untranslated_fallback(self):
+        from requests import ConnectionError
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        with mock.patch('app.translate._call_translator',
+                        side_effect=ConnectionError()) as translator:
+            for i in range(3):
+                self.assertEqual(translate('xin chao', 'vi', 'en'),
+                                 'xin chao')
+        self.assertEqual(translator.call_count, 2)
+
+    def test_progress_unknown(self):
+        from redis.exceptions import ConnectionError
+        from app.models import Task
+        task = Task(id='job', name='export_posts')
+        with mock.patch('rq.job.Job.fetch', side_effect=ConnectionError()):
+            self.assertIsNone(task.get_progress())
+            self.assertIsNone(task.get_rq_job())
+            self.assertIsNone(task.get_progress())
+        self.assertEqual(breaker_stats()['redis']['rejected'], 1)
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def topics(self):
+        return [event.topic for event in OutboxEvent.query.order_by(
+            OutboxEvent.id)]
+
+    def test_search_events(self):
+        self.app.config['ELASTICSEARCH_URL'] = 'http://localhost:9200'
+        es = self.app.elasticsearch = mock.Mock()
+        post = Post(body='hello', author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(self.topics(), ['search.index'])
+        es.index.assert_not_called()
+        self.assertEqual(dispatch(), (1, 0))
+        es.index.assert_called_once_with(index='post', id=post.id,
+                                         body={'body': 'hello'})
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.topics(), ['search.remove'])
+        dispatch()
+        es.delete.assert_called_once_with(index='post', id=post.id)
+        self.assertEqual(self.topics(), [])
+
+    def test_dispatcher_starts_with_app(self):
+        class ThreadConfig(TestConfig):
+            OUTBOX_DISPATCHER = 'thread'
+
+        with mock.patch.object(OutboxDispatcher, 'start') as start:
+            app = create_app(ThreadConfig)
+        start.assert_called_once_with()
+        self.assertIs(app.extensions['outbox_dispatcher'].app, app)
+
+    def test_rolled_back_events_are_lost(self):
+        self.user.launch_task('export_posts', 'Exporting posts...')
+        db.session.rollback()
+        self.assertEqual(self.topics(), [])
+
+    def test_task_enqueued_once(self):
+        queue = self.app.task_queue = mock.Mock()
+        task = self.user.launch_task('export_posts', 'Exporting posts...')
+        db.session.commit()
+        with mock.patch('rq.job.Job.exists', return_value=False):
+            self.assertEqual(dispatch(), (1, 0))
+        queue.enqueue.assert_called_once_with(
+            'app.tasks.export_posts', self.user.id, job_id=task.id)
+        # a second delivery of the same event does nothing
+        db.session.add(OutboxEvent.create('task.enqueue', {
+            'task_id': task.id, 'name': 'export_posts',
+            'args': [self.user.id], 'kwargs': {}}))
+        db.session.commit()
+        with mock.patch('rq.job.Job.exists', return_value=True):
+            self.assertEqual(dispatch(), (1, 0))
+        self.assertEqual(queue.enqueue.call_count, 1)
+
+    def test_password_reset_email(self):
+        from app import mail
+        from app.auth.email import send_password_reset_email
+        with self.app.test_request_context(base_url='https://blog.example'):
+            send_password_reset_email(self.user)
+        event = OutboxEvent.query.one()
+        self.assertEqual(event.topic, 'email.password_reset')
+        self.assertEqual(set(event.get_payload()),
+                         {'user_id', 'locale', 'url_root'})
+        with mail.record_messages() as outbox:
+            self.assertEqual(dispatch(), (1, 0))
+        self.assertEqual(outbox[0].recipients, ['john@example.com'])
+        link = outbox[0].body.split('https://blog.example/auth/'
+                                    'reset_password/')[1].split()[0]
+        self.assertEqual(jwt.decode(link, self.app.config['SECRET_KEY'],
+                                    algorithms=['HS256'])['reset_email'],
+                         'john@example.com')
+
+    def test_prune_failed(self):
+        old = OutboxEvent.create('unknown', {})
+        old.created_at -= 8 * 24 * 60 * 60
+        db.session.add_all([old, OutboxEvent.create('unknown', {})])
+        db.session.commit()
+        # the old one failed too many times
+        old.available_at = None
+        db.session.commit()
+        self.assertEqual(prune_failed(), 1)
+        self.assertEqual(self.topics(), ['unknown'])
+
+    def test_retries(self):
+        self.app.config['OUTBOX_MAX_ATTEMPTS'] = 2
+        self.app.config['OUTBOX_RETRY_BACKOFF'] = 0
+        db.session.add(OutboxEvent.create('unknown', {}))
+        db.session.commit()
+        self.assertEqual(dispatch(), (0, 1))
+        self.assertEqual(outbox_stats()['pending'], 1)
+        self.assertEqual(dispatch(), (0, 1))
+        self.assertEqual(dispatch(), (0, 0))
+        stats = outbox_stats()
+        self.assertEqual((stats['pending'], stats['failed']), (0, 1))
+        self.assertIn('no handler', OutboxEvent.query.one().last_error)
+        self.assertEqual(retry_failed(), 1)
+        self.assertEqual(outbox_stats()['pending'], 1)
+
+
+class DeltaFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        self.u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.u1, self.u2, self.u3])
+        self.u1.follow(self.u2)
+        db.session.add_all([Post(body='post {}'.format(i),
+                                 author=(self.u1, self.u2, self.u3)[i % 3])
+                            for i in range(6)])
+        token = self.u1.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + token.access_jwt_token}
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, author, body):
+        db.session.add(Post(body=body, author=author))
+        db.session.commit()
+
+    def test_only_new_posts(self):
+        page = self.client.get('/api/feed', headers=self.headers).get_json()
+        self.assertEqual([post['body'] for post in page['data']],
+                         ['post 4', 'post 3', 'post 1', 'post 0'])
+        since_id = page['pagination']['since_id']
+        self.post(self.u3, 'not followed')
+        self.post(self.u2, 'new')
+        self.post(self.u1, 'newer')
+        page = self.client.get('/api/feed?since_id={}&limit=1'.format(
+            since_id), headers=self.headers).get_json()
+        self.assertEqual([post['body'] for post in page['data']], ['newer'])
+        # the gap is filled with the next pages, the cursor stays
+        after, new_since_id = (page['pagination']['after'],
+                               page['pagination']['since_id'])
+        page = self.client.get('/api/feed?since_id={}&after={}'.format(
+            since_id, after), headers=self.headers).get_json()
+        self.assertEqual([post['body'] for post in page['data']], ['new'])
+        self.assertEqual(page['pagination']['since_id'], since_id)
+        page = self.client.get('/api/feed?since_id={}'.format(new_since_id),
+                               headers=self.headers).get_json()
+        self.assertEqual(page['data'], [])
+        self.assertEqual(page['pagination']['since_id'], new_since_id)
+
+    def test_since_ts(self):
+        cursor = datetime.utcnow()
+        self.post(self.u2, 'new')
+        page = self.client.get('/api/feed?since_ts={}Z'.format(
+            cursor.isoformat()), headers=self.headers).get_json()
+        self.assertEqual([post['body'] for post in page['data']], ['new'])
+        self.assertEqual(self.client.get('/api/feed?since_ts=yesterday',
+                                         headers=self.headers).status_code,
+                         400)
+
+    def test_count(self):
+        since_id = db.session.scalar(db.select(db.func.max(Post.id)))
+        url = '/api/feed?since_id={}'.format(since_id)
+        response = self.client.head(url, headers=self.headers)
+        self.assertEqual(response.headers['X-New-Posts'], '0')
+        self.assertEqual(response.data, b'')
+        self.post(self.u3, 'not followed')
+        self.post(self.u2, 'new')
+        self.post(self.u2, 'newer')
+        self.app.config['FEED_COUNT_LIMIT'] = 1
+        response = self.client.head(url, headers=self.headers)
+        self.assertEqual(response.headers['X-New-Posts'], '1')
+
+    def test_no_change_poll_is_one_probe(self):
+        since_id = db.session.scalar(db.select(db.func.max(Post.id)))
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda *args: statements.append(args[2:4]))
+        self.client.get('/api/feed?since_id={}'.format(since_id),
+                        headers=self.headers)
+        post_statements = [(sql, params) for sql, params in statements
+                           if 'FROM post' in sql]
+        self.assertEqual(len(post_statements), 1)
+        sql, params = post_statements[0]
+        plan = db.session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + sql, params).all()
+        self.assertIn('SEARCH post USING INTEGER PRIMARY KEY',
+                      ' '.join(row[-1] for row in plan))
+        self.assertNotIn('SCAN post', ' '.join(row[-1] for row in plan))
+
+
+class SnowflakeTest(unittest.TestCase):
+    def setUp(self):
+        class SnowflakeConfig(TestConfig):
+            SNOWFLAKE_IDS = '1'
+            SNOWFLAKE_WORKER_ID = '7'
+
+        self.app = create_app(SnowflakeConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_ids_are_unique_and_ordered(self):
+        generator = SnowflakeGenerator(5)
+        ids = []
+        threads = [threading.Thread(target=lambda: ids.extend(
+            generator.next_id() for i in range(5000))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(ids)), 20000)
+        self.assertEqual(set((id >> 12) & 1023 for id in ids), {5})
+        # more than 4096 ids in a millisecond, or a clock that goes back,
+        # do not break the order
+        generator.last += 10000
+        id = generator.next_id()
+        self.assertGreater(id, max(ids))
+        self.assertAlmostEqual(snowflake_time(max(ids)), datetime.utcnow(),
+                               delta=timedelta(seconds=5))
+        self.assertRaises(ValueError, SnowflakeGenerator, 1024)
+
+    def test_worker_id_is_required(self):
+        class NoWorkerConfig(TestConfig):
+            SNOWFLAKE_IDS = '1'
+
+        self.assertRaises(RuntimeError, create_app, NoWorkerConfig)
+
+    def test_worker_id_lease(self):
+        redis = mock.Mock()
+        # the first worker id tried is taken
+        redis.set.side_effect = [False, True]
+        with mock.patch('threading.Thread'):
+            lease = WorkerIdLease(redis, 30)
+        taken, leased = [call[0][0] for call in redis.set.call_args_list]
+        self.assertNotEqual(taken, leased)
+        self.assertEqual(leased, 'snowflake-worker:{}'.format(
+            lease.worker_id))
+        generator = SnowflakeGenerator(lease.worker_id, lease)
+        self.assertEqual((generator.next_id() >> 12) & 1023, lease.worker_id)
+        # another process got the id after a renewal was missed
+        redis.register_script.return_value.return_value = 0
+        lease.renew()
+        self.assertFalse(lease.held())
+        self.assertRaises(RuntimeError, generator.next_id)
+
+    def test_models(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        # existing rows keep their ids, new ones sort after them
+        old = Post(id=1, body='old', author=u,
+                   timestamp=datetime.utcnow() - timedelta(days=1))
+        db.session.add(old)
+        db.session.commit()
+        posts = [Post(body='post {}'.format(i), author=u) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual((posts[0].id >> 12) & 1023, 7)
+        self.assertEqual(u.followed_posts().all(), posts[::-1] + [old])
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add(u2)
+        db.session.commit()
+        u.send_message(u2, 'hi')
+        u.send_message(u2, 'how are you?')
+        db.session.commit()
+        messages = Thread.between(u, u2).messages_page()
+        self.assertEqual([m.body for m in messages], ['how are you?', 'hi'])
+        self.assertGreater(messages[1].id, 1 << 22)
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        class ArchiveConfig(TestConfig):
+            ARCHIVE_DATABASE_URL = 'sqlite:///' + os.path.join(
+                self.tmpdir.name, 'archive.db')
+
+        self.app = create_app(ArchiveConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        create_archive_tables(db)
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+        old = datetime.utcnow() - timedelta(days=400)
+        db.session.add_all(
+            [Post(body='old {}'.format(i), author=self.u1, timestamp=old)
+             for i in range(3)] +
+            [Post(body='new {}'.format(i), author=self.u1) for i in range(2)])
+        for i in range(3):
+            self.u1.send_message(self.u2, 'message {}'.format(i))
+        db.session.commit()
+        db.session.execute(db.update(PrivateMessage).values(timestamp=old))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def test_posts(self):
+        self.assertEqual(PostArchive.archive(365, batch_size=2), 3)
+        self.assertEqual(Post.query.count(), 2)
+        # the rows are in the archive database
+        with db.engines['archive'].connect() as connection:
+            self.assertEqual(connection.exec_driver_sql(
+                'SELECT count(*) FROM post_archive').scalar(), 3)
+        self.assertEqual(PostArchive.archive(365), 0)
+        token = self.u1.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': 'Bearer ' + token.access_jwt_token}
+        url = '/api/users/{}/posts?limit=3'.format(self.u1.id)
+        page = client.get(url, headers=headers).get_json()
+        self.assertEqual([post['body'] for post in page['data']],
+                         ['new 1', 'new 0', 'old 2'])
+        self.assertEqual(page['data'][2]['author']['username'], 'john')
+        page = client.get(url + '&after={}'.format(
+            page['pagination']['after']), headers=headers).get_json()
+        self.assertEqual([post['body'] for post in page['data']],
+                         ['old 1', 'old 0'])
+
+    def test_interrupted_run(self):
+        # copied to the archive, but not deleted from the post table yet
+        post = Post.query.filter_by(body='old 0').one()
+        db.session.add(PostArchive(id=post.id, body=post.body,
+                                   timestamp=post.timestamp,
+                                   user_id=post.user_id))
+        db.session.commit()
+        self.assertEqual(PostArchive.archive(365), 3)
+        self.assertEqual(PostArchive.query.count(), 3)
+
+    def test_messages(self):
+        # the last message of the thread stays for the inbox
+        self.assertEqual(MessageArchive.archive(365), 2)
+        self.assertEqual(self.u2.conversations()[0][1].body, 'message 2')
+        thread = Thread.between(self.u1, self.u2)
+        self.assertEqual([m.body for m in thread.messages_page(per_page=2)],
+                         ['message 2', 'message 1'])
+        page = thread.messages_page(before=thread.messages_page()[1].id)
+        self.assertEqual([(m.body, m.author.username) for m in page],
+                         [('message 0', 'john')])
+
+
+class RowProjectionTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        self.u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([self.u1, self.u2, self.u3])
+        self.u1.follow(self.u2)
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i),
+                                 author=(self.u1, self.u2, self.u3)[i % 3],
+                                 timestamp=now + timedelta(seconds=i))
+                            for i in range(6)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_same_posts_as_orm(self):
+        posts = paginate_post_rows(
+            post_rows_select(self.u1.followed_posts_where())
+            .order_by(Post.newest_first()), 1, 3)
+        orm = self.u1.followed_posts().paginate(page=1, per_page=3)
+        self.assertEqual([(p.id, p.body, p.author.username)
+                          for p in posts.items],
+                         [(p.id, p.body, p.author.username)
+                          for p in orm.items])
+        self.assertEqual((posts.total, posts.has_next), (4, True))
+        self.assertIsInstance(posts.items[0], PostRow)
+        self.assertEqual(posts.items[0].author.avatar(70),
+                         self.u2.avatar(70))
+        # the posts of an author share a row
+        self.assertIs(posts.items[0].author, posts.items[2].author)
+        self.assertEqual([p.body for p in post_rows_by_id([5, 1, 3])],
+                         ['post 4', 'post 0', 'post 2'])
+
+    def test_template(self):
+        post = post_rows_by_id([2])[0]
+        with self.app.test_request_context():
+            from flask import g, render_template
+            g.locale = 'en'
+            html = render_template('_post.html', post=post)
+        self.assertIn(self.u2.avatar(70).replace('&', '&amp;'), html)
+        self.assertIn('<span id="post2">post 1</span>', html)
+
+    def test_messages(self):
+        for i in range(3):
+            self.u1.send_message(self.u2, 'message {}'.format(i))
+        db.session.commit()
+        thread = Thread.between(self.u1, self.u2)
+        rows = message_rows(thread, per_page=2)
+        self.assertEqual([(m.body, m.author.username) for m in rows],
+                         [('message 2', 'john'), ('message 1', 'john')])
+        rows = message_rows(thread, before=rows[-1].id)
+        self.assertEqual([m.body for m in rows], ['message 0'])
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.add_all([PrivateMessage(author=(self.u1, self.u2)[i % 2],
+                                           recipient=(self.u2, self.u1)[i % 2],
+                                           body=str(i)) for i in range(5)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_resume(self):
+        seen = []
+        checkpoint = backfill.run(
+            'message.thread', batch_size=2, max_batches=2,
+            progress=lambda c: seen.append((c.last_id, c.rows_scanned)))
+        self.assertEqual(seen, [(2, 2), (4, 4)])
+        self.assertIsNone(checkpoint.finished_at)
+        self.assertIsNone(checkpoint.lease_until)
+        self.assertEqual(PrivateMessage.query.filter(
+            PrivateMessage.thread_id.is_(None)).count(), 1)
+        # rows added after the start are left to the new code
+        db.session.add(PrivateMessage(author=self.u1, recipient=self.u2,
+                                      body='new'))
+        db.session.commit()
+        checkpoint = backfill.run('message.thread', batch_size=2)
+        self.assertIsNotNone(checkpoint.finished_at)
+        self.assertEqual((checkpoint.rows_scanned, checkpoint.rows_changed),
+                         (5, 5))
+        self.assertEqual(self.u2.conversations()[0][0].unread_count, 3)
+        backfill.require_finished(db.session.connection(), 'message.thread')
+        self.assertRaises(RuntimeError, backfill.require_finished,
+                          db.session.connection(), 'post.language')
+        status = {job['name']: job for job in backfill.status()}
+        self.assertEqual(status['message.thread']['progress'], 100)
+        self.assertNotIn('progress', status['post.language'])
+
+    def test_one_runner(self):
+        backfill.run('message.thread', batch_size=2, max_batches=1)
+        db.session.execute(db.update(BackfillCheckpoint).values(
+            lease_until=time.time() + 60))
+        db.session.commit()
+        self.assertRaises(backfill.BackfillRunning, backfill.run,
+                          'message.thread')
+        self.assertRaises(LookupError, backfill.run, 'unknown')
+
+    def test_throttle(self):
+        start = time.time()
+        backfill.run('message.thread', batch_size=2, rows_per_second=10)
+        # two full batches of two rows are spaced by 0.2s
+        self.assertGreaterEqual(time.time() - start, 0.35)
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        class ExportConfig(TestConfig):
+            ADMISSION_BACKEND = 'off'
+            EXPORT_YIELD_PER = 2
+            EXPORT_CHUNK_SIZE = 100
+
+        self.app = create_app(ExportConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        self.u2.follow(self.u1)
+        # archived posts keep their ids, which are lower than the live ones
+        db.session.add_all([Post(id=i + 2, body='post {}'.format(i),
+                                 author=self.u1) for i in range(3)])
+        db.session.add(PostArchive(id=1, body='archived', user_id=1,
+                                   timestamp=datetime(2020, 1, 1)))
+        db.session.commit()
+        self.u1.send_message(self.u2, 'hi susan')
+        self.u2.send_message(self.u1, 'hi john')
+        token = self.u1.generate_auth_token()
+        db.session.add(token)
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + token.access_jwt_token}
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def export(self, query=''):
+        return self.client.get('/api/users/{}/export{}'.format(
+            self.u1.id, query), headers=self.headers)
+
+    def test_ndjson(self):
+        response = self.export()
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        records = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([(r['type'], r.get('body') or r.get('username'))
+                          for r in records],
+                         [('post', 'archived'), ('post', 'post 0'),
+                          ('post', 'post 1'), ('post', 'post 2'),
+                          ('message', 'hi susan'), ('message', 'hi john'),
+                          ('follower', 'susan')])
+        self.assertEqual((records[4]['direction'], records[4]['username']),
+                         ('sent', 'susan'))
+
+    def test_resume(self):
+        records = [json.loads(line) for line in self.export(
+            '?cursor=post:3').data.splitlines()]
+        self.assertEqual([r.get('body') for r in records[:2]],
+                         ['post 2', 'hi susan'])
+        records = [json.loads(line) for line in self.export(
+            '?cursor=message:{}'.format(records[1]['id'])).data.splitlines()]
+        self.assertEqual([r['type'] for r in records],
+                         ['message', 'follower'])
+        self.assertEqual(self.export('?cursor=likes:1').status_code, 400)
+
+    def test_resume_from_streamed_records(self):
+        records = [json.loads(line)
+                   for line in self.export().data.splitlines()]
+        for i, record in enumerate(records):
+            resumed = [json.loads(line) for line in self.export(
+                '?cursor={}:{}'.format(record['type'], record['id']))
+                .data.splitlines()]
+            self.assertEqual(resumed, records[i + 1:])
+
+    def test_csv_gzip(self):
+        import csv
+        import gzip
+        response = self.export('?format=csv&gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertIn('john-export.csv.gz',
+                      response.headers['Content-Disposition'])
+        rows = list(csv.DictReader(
+            gzip.decompress(response.data).decode('utf-8').splitlines()))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual((rows[5]['type'], rows[5]['direction'],
+                          rows[5]['body']), ('message', 'received', 'hi john'))
+
+    def test_only_own_account(self):
+        response = self.client.get('/api/users/{}/export'.format(self.u2.id),
+                                   headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file